@@ -0,0 +1,259 @@
+"""
+Benchmarks of the calm evaluation on synthetic feedin (no database needed).
+
+Usage: python benchmark_calms.py [--cells 1000] [--years 1] [--save]
+                                 [--check]
+
+Each function is run on a synthetic feedin of cells x (years * 8760) hours
+and reported with its wall time (best of repeats), its time relative to a
+reference kernel timed in the same run (see reference_kernel), peak memory
+(tracemalloc) and throughput in cell-hours per second. The relative times
+hardly depend on the machine, so they are compared with the baseline.
+With --save the results are stored as baseline. With --check the script
+exits with status 1 if a function got slower or needs more memory than the
+baseline by more than the tolerance; without it the changes are only
+printed. benchmark_baseline.json holds a baseline of the default
+configuration; for reliable checks record one with --save on the machine
+that runs them.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from get_from_db import (FeedinMatrix, create_calms_dict, calculate_calms,
+                         filter_peaks, calms_frequency,
+                         calculate_avg_wind_speed, calculate_calms_matrix,
+                         create_calm_mask, filter_calm_mask)
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+
+# Weather object with the attributes of feedinlib.weather.FeedinWeather used
+# by calculate_avg_wind_speed
+SyntheticWeather = namedtuple('SyntheticWeather', ['data', 'name'])
+
+
+def synthetic_feedin(cells=1000, years=1, calm_density=0.3, power_limit=0.05,
+                     autocorrelation=0.97, seed=0):
+    """
+    Creates a FeedinMatrix of autocorrelated random feedin (hourly, from
+    2011) of cells locations in which a share of calm_density of the hours
+    is calm (feedin < power_limit).
+    """
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2011-01-01', periods=years * 8760,
+                          freq='60min')
+    noise = rng.standard_normal((len(index), cells))
+    noise *= np.sqrt(1 - autocorrelation ** 2)
+    # AR(1) process, one time step for all cells at a time
+    for step in range(1, len(index)):
+        noise[step] += autocorrelation * noise[step - 1]
+    values = np.ascontiguousarray(noise.T)
+    # Feedin < power_limit exactly for the calm_density share of the hours
+    values -= np.quantile(values, calm_density, axis=1)[:, np.newaxis]
+    values = np.minimum(power_limit * np.exp(values), 1)
+    return FeedinMatrix(values=values, gids=np.arange(1, cells + 1),
+                        index=index)
+
+
+def benchmark_cases(feedin_matrix, power_limit=0.05):
+    """
+    Returns the benchmark cases (dictionary, keys: names, data: functions
+    without arguments) of the calm evaluation for feedin_matrix.
+    """
+    feedin = {gid: pd.Series(feedin_matrix.values[row],
+                             index=feedin_matrix.index, name='feedin_wind_pp')
+              for row, gid in enumerate(feedin_matrix.gids)}
+    calms_dict = create_calms_dict(power_limit, feedin)
+    calm_lengths = calculate_calms(calms_dict)[2]
+    calm_mask = create_calm_mask(power_limit, feedin_matrix)
+    # Wind speed of each location from the feedin as list of weather objects
+    multi_weather = [
+        SyntheticWeather(data=pd.DataFrame(
+            {'v_wind': 25 * feedin_matrix.values[row]},
+            index=feedin_matrix.index), name=gid)
+        for row, gid in enumerate(feedin_matrix.gids)]
+    return {
+        'create_calms_dict': lambda: create_calms_dict(power_limit, feedin),
+        'calculate_calms': lambda: calculate_calms(calms_dict),
+        'filter_peaks': lambda: filter_peaks(calms_dict, power_limit),
+        'calms_frequency': lambda: calms_frequency(calm_lengths, 24),
+        'calculate_avg_wind_speed':
+            lambda: calculate_avg_wind_speed(multi_weather),
+        'calculate_avg_wind_speed_matrix':
+            lambda: calculate_avg_wind_speed(feedin_matrix),
+        'create_calm_mask':
+            lambda: create_calm_mask(power_limit, feedin_matrix),
+        'calculate_calms_matrix':
+            lambda: calculate_calms_matrix(feedin_matrix, power_limit),
+        'filter_calm_mask':
+            lambda: filter_calm_mask(feedin_matrix, calm_mask, power_limit)}
+
+
+def reference_kernel(feedin_matrix):
+    """
+    Returns a function without arguments with a fixed numpy workload on
+    feedin_matrix (sorting, cumulative sums and comparisons of all values) as
+    reference for the speed of the machine.
+    """
+    values = np.asarray(feedin_matrix.values)
+
+    def kernel():
+        np.sort(values, axis=1)
+        np.cumsum(values, axis=1)
+        np.count_nonzero(values < 0.05)
+    return kernel
+
+
+def run_benchmark(function, cell_hours, repeats=3):
+    """
+    Runs function repeats times and once more with tracemalloc.
+
+    Returns
+    -------
+    result : Dictionary
+        'time' (best wall time in s), 'peak_memory' (in bytes) and
+        'throughput' (cell-hours per s).
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time': min(times), 'peak_memory': peak_memory,
+            'throughput': cell_hours / min(times)}
+
+
+def run_benchmarks(cells=1000, years=1, calm_density=0.3, power_limit=0.05,
+                   repeats=3, names=None):
+    """
+    Runs the benchmark cases (all or the given names) on synthetic feedin.
+
+    Returns
+    -------
+    results : Dictionary
+        keys: names of the cases, data: results of run_benchmark and
+        'relative_time' (time / time of reference_kernel).
+    """
+    feedin_matrix = synthetic_feedin(cells, years, calm_density, power_limit)
+    cases = benchmark_cases(feedin_matrix, power_limit)
+    cell_hours = feedin_matrix.values.size
+    reference = run_benchmark(reference_kernel(feedin_matrix), cell_hours,
+                              repeats)['time']
+    results = {}
+    for name in (names or cases):
+        results[name] = run_benchmark(cases[name], cell_hours, repeats)
+        results[name]['relative_time'] = results[name]['time'] / reference
+    return results
+
+
+def benchmark_key(cells, years, calm_density):
+    return 'cells={0} years={1} calm_density={2}'.format(cells, years,
+                                                        calm_density)
+
+
+def save_baseline(results, key, filename=BASELINE_FILE):
+    """
+    Stores results as baseline for the benchmark configuration key.
+    """
+    baseline = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            baseline = json.load(f)
+    baseline[key] = results
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare_baseline(results, key, filename=BASELINE_FILE, tolerance=0.2,
+                     min_change=None):
+    """
+    Compares results with the stored baseline of the configuration key.
+
+    Returns
+    -------
+    regressions : list
+        Names of the cases whose relative time (see run_benchmarks) or peak
+        memory is higher than in the baseline by more than tolerance (share
+        of the baseline) and whose time or peak memory also grew by more
+        than min_change (dictionary, keys: 'time' and 'peak_memory',
+        default: 0.01 s and 1 MB), so measurement noise of fast cases is
+        ignored.
+    """
+    min_change = min_change or {'time': 0.01, 'peak_memory': 1e6}
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        baseline = json.load(f).get(key, {})
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or 'relative_time' not in baseline[name]:
+            continue
+        for measure, compared in (('time', 'relative_time'),
+                                  ('peak_memory', 'peak_memory')):
+            change = result[compared] - baseline[name][compared]
+            if (change > baseline[name][compared] * tolerance and
+                    result[measure] - baseline[name][measure] >
+                    min_change[measure]):
+                regressions.append(name)
+                break
+    return regressions
+
+
+def print_results(results, baseline_key=None, filename=BASELINE_FILE):
+    baseline = {}
+    if baseline_key is not None and os.path.exists(filename):
+        with open(filename) as f:
+            baseline = json.load(f).get(baseline_key, {})
+    print('{0:<32}{1:>12}{2:>12}{3:>16}{4:>16}{5:>10}'.format(
+        'function', 'time in s', 'rel. time', 'peak mem in MB',
+        'cell-hours/s', 'vs. base'))
+    for name, result in results.items():
+        change = ''
+        if 'relative_time' in baseline.get(name, {}):
+            change = '{0:+.0%}'.format(result['relative_time'] /
+                                       baseline[name]['relative_time'] - 1)
+        print('{0:<32}{1:>12.3f}{2:>12.3g}{3:>16.1f}{4:>16.3g}{5:>10}'.format(
+            name, result['time'], result['relative_time'],
+            result['peak_memory'] / 1e6, result['throughput'], change))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the calm evaluation on synthetic feedin.')
+    parser.add_argument('--cells', type=int, default=1000)
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--calm-density', type=float, default=0.3)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--only', nargs='*', help='names of the cases')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 if slower than baseline')
+    args = parser.parse_args()
+    key = benchmark_key(args.cells, args.years, args.calm_density)
+    results = run_benchmarks(args.cells, args.years, args.calm_density,
+                             repeats=args.repeats, names=args.only)
+    print_results(results, key, args.baseline)
+    if args.save:
+        save_baseline(results, key, args.baseline)
+    else:
+        regressions = compare_baseline(results, key, args.baseline,
+                                       args.tolerance)
+        if regressions:
+            print('Slower than baseline: ' + ', '.join(regressions))
+            if args.check:
+                sys.exit(1)
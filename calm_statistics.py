@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+from get_from_db import find_calm_runs, check_calm_mask, unpack_calm_mask
+
+# Meteorological seasons of the months 1...12
+SEASONS = np.array(['DJF', 'DJF', 'MAM', 'MAM', 'MAM', 'JJA', 'JJA', 'JJA',
+                    'SON', 'SON', 'SON', 'DJF'])
+
+
+def calm_runs(calm_starts, calm_lengths):
+    """
+    Converts the calm starts and lengths of calculate_calms_matrix
+    (dictionaries, keys: gids) to flat arrays.
+
+    Returns
+    -------
+    gids : list
+        Gids of the locations.
+    rows, starts, lengths : array
+        Calms as returned by get_from_db.find_calm_runs.
+    """
+    gids = list(calm_starts.keys())
+    sizes = np.array([np.size(calm_starts[key]) for key in gids])
+    rows = np.repeat(np.arange(len(gids)), sizes)
+    starts = np.concatenate([np.ravel(calm_starts[key]) for key in gids])
+    # Locations without calms have a calm of length 0 in calm_lengths
+    lengths = np.concatenate([np.ravel(calm_lengths[key])[:size]
+                              for key, size in zip(gids, sizes)])
+    return gids, rows, starts.astype(int), lengths.astype(int)
+
+
+def calm_mask_from_runs(rows, starts, lengths, n_rows, n_steps):
+    """
+    Creates the boolean calm mask (rows: locations, columns: time steps) of
+    calms given as rows, starts and lengths.
+    """
+    marks = np.zeros(n_rows * (n_steps + 1) + 1, dtype=np.int32)
+    np.add.at(marks, rows * (n_steps + 1) + starts, 1)
+    np.add.at(marks, rows * (n_steps + 1) + starts + lengths, -1)
+    return (np.cumsum(marks)[:-1].reshape(n_rows, n_steps + 1)[:, :-1] > 0)
+
+
+def group_calm_statistics(calm_starts, calm_lengths, groups):
+    """
+    Calculates calm statistics of each location for groups of time steps
+    (e.g. months, seasons or hours of the day, one label per time step) in
+    one vectorized pass over all locations. A calm belongs to the group of
+    its first time step; the calm hours are counted in the group they occur.
+
+    Returns
+    -------
+    statistics : Dictionary
+        keys: 'longest' (longest calm), 'number' (number of calms), 'hours'
+        (calm hours), 'share' (share of the hours of the group that are
+        calm); data: DataFrame (indices: gids, columns: groups).
+    """
+    labels, group_of_step = np.unique(np.asarray(groups), return_inverse=True)
+    group_of_step = group_of_step.ravel()
+    n_groups, n_steps = len(labels), len(group_of_step)
+    gids, rows, starts, lengths = calm_runs(calm_starts, calm_lengths)
+    n_rows = len(gids)
+    cells = rows * n_groups + group_of_step[starts]
+    number = np.bincount(cells, minlength=n_rows * n_groups)
+    longest = np.zeros(n_rows * n_groups, dtype=int)
+    np.maximum.at(longest, cells, lengths)
+    calm_rows, calm_steps = np.nonzero(calm_mask_from_runs(
+        rows, starts, lengths, n_rows, n_steps))
+    hours = np.bincount(calm_rows * n_groups + group_of_step[calm_steps],
+                        minlength=n_rows * n_groups)
+    steps_per_group = np.bincount(group_of_step, minlength=n_groups)
+
+    def frame(data):
+        return pd.DataFrame(data=data.reshape(n_rows, n_groups), index=gids,
+                            columns=labels)
+    return {'longest': frame(longest), 'number': frame(number),
+            'hours': frame(hours),
+            'share': frame(hours.reshape(n_rows, n_groups) /
+                           steps_per_group.astype(float))}
+
+
+def monthly_calm_statistics(calm_starts, calm_lengths, index):
+    """
+    Calm statistics (see group_calm_statistics) per month of the time index
+    of the feedin.
+    """
+    return group_calm_statistics(calm_starts, calm_lengths,
+                                 pd.DatetimeIndex(index).month)
+
+
+def seasonal_calm_statistics(calm_starts, calm_lengths, index):
+    """
+    Calm statistics (see group_calm_statistics) per meteorological season
+    (DJF, MAM, JJA, SON).
+    """
+    return group_calm_statistics(
+        calm_starts, calm_lengths,
+        SEASONS[np.asarray(pd.DatetimeIndex(index).month) - 1])
+
+
+def hourly_calm_statistics(calm_starts, calm_lengths, index):
+    """
+    Calm statistics (see group_calm_statistics) per hour of the day.
+    """
+    return group_calm_statistics(calm_starts, calm_lengths,
+                                 pd.DatetimeIndex(index).hour)
+
+
+def rolling_calm_hours(calm_starts, calm_lengths, n_steps, window=30 * 24):
+    """
+    Returns the number of calm hours in the window of `window` time steps
+    ending at each time step (array, rows: locations, columns: time steps)
+    from cumulative sums of the calm mask. The first window - 1 time steps
+    contain the calm hours since the beginning.
+    """
+    gids, rows, starts, lengths = calm_runs(calm_starts, calm_lengths)
+    calms = calm_mask_from_runs(rows, starts, lengths, len(gids), n_steps)
+    cumulated = np.zeros((len(gids), n_steps + 1), dtype=np.int32)
+    np.cumsum(calms, axis=1, out=cumulated[:, 1:])
+    window_start = np.clip(np.arange(1, n_steps + 1) - window, 0, None)
+    return cumulated[:, 1:] - cumulated[:, window_start]
+
+
+def rolling_calm_statistics(calm_starts, calm_lengths, index,
+                            window=30 * 24):
+    """
+    Finds the window of `window` time steps (default: 30 days) with the most
+    calm hours for each location.
+
+    Returns
+    -------
+    statistics : DataFrame
+        indices: gids, columns: 'max_hours' (calm hours in the window),
+        'max_share' (share of the window that is calm), 'window_end' (last
+        time step of the window).
+    """
+    index = pd.DatetimeIndex(index)
+    hours = rolling_calm_hours(calm_starts, calm_lengths, len(index), window)
+    end = hours.argmax(axis=1)
+    max_hours = hours[np.arange(hours.shape[0]), end]
+    return pd.DataFrame(
+        data={'max_hours': max_hours,
+              'max_share': max_hours / float(min(window, len(index))),
+              'window_end': index[end]},
+        index=list(calm_starts.keys()),
+        columns=['max_hours', 'max_share', 'window_end'])
+
+
+def calm_statistics_multi(calms, index, by='month'):
+    """
+    Calculates the calm statistics grouped by 'month', 'season' or 'hour'
+    for all power limits of get_from_db.calculate_calms_multi.
+
+    Returns
+    -------
+    statistics : Dictionary
+        keys: power limits, data: statistics of group_calm_statistics.
+    """
+    functions = {'month': monthly_calm_statistics,
+                 'season': seasonal_calm_statistics,
+                 'hour': hourly_calm_statistics}
+    return {limit: functions[by](calms[limit][3], calms[limit][2], index)
+            for limit in calms}
+
+
+def coincident_calms(feedin_matrix, power_limit, capacities=None,
+                     calm_mask=None, chunk_size=500):
+    """
+    Counts for each time step the locations of a FeedinMatrix that are in
+    calm (feedin < power_limit) at the same time. The locations are reduced
+    in chunks of chunk_size gids.
+
+    Parameters
+    ----------
+    capacities : Series or array, optional
+        Installed capacity of each location (Series: indices gids, array: in
+        the order of feedin_matrix.gids). Without capacities every location
+        has the same weight.
+    calm_mask : CalmMask, optional
+        Calm mask of the feedin_matrix (see get_from_db.create_calm_mask),
+        e.g. with filtered peaks, used instead of power_limit.
+
+    Returns
+    -------
+    coincidence : DataFrame
+        indices: time steps, columns: 'cells' (number of locations in calm),
+        'share' (share of the capacity in calm).
+    """
+    if calm_mask is not None:
+        check_calm_mask(calm_mask, feedin_matrix)
+    n_rows, n_steps = feedin_matrix.values.shape
+    if capacities is None:
+        capacities = np.ones(n_rows)
+    elif isinstance(capacities, pd.Series):
+        capacities = capacities.reindex(feedin_matrix.gids).fillna(0).values
+    capacities = np.asarray(capacities, dtype=float)
+    cells = np.zeros(n_steps, dtype=np.int64)
+    capacity_in_calm = np.zeros(n_steps)
+    for first in range(0, n_rows, chunk_size):
+        rows = slice(first, first + chunk_size)
+        if calm_mask is None:
+            calms = np.asarray(feedin_matrix.values[rows]) < power_limit
+        else:
+            calms = unpack_calm_mask(calm_mask, n_steps, rows)
+        cells += calms.sum(axis=0)
+        capacity_in_calm += capacities[rows].dot(calms)
+    return pd.DataFrame(
+        data={'cells': cells, 'share': capacity_in_calm / capacities.sum()},
+        index=feedin_matrix.index, columns=['cells', 'share'])
+
+
+def coincident_calm_events(coincidence, threshold, min_length=1):
+    """
+    Extracts system-wide calms from the result of coincident_calms: periods
+    in which the share of the capacity in calm is >= threshold for at least
+    min_length time steps.
+
+    Returns
+    -------
+    events : DataFrame
+        One row per event with the columns 'start', 'end' (first and last
+        time step), 'length', 'mean_share', 'max_share' and 'max_cells'.
+    """
+    share = coincidence['share'].values
+    rows, starts, lengths = find_calm_runs((share >= threshold)[np.newaxis])
+    keep = lengths >= min_length
+    starts, lengths = starts[keep], lengths[keep]
+    columns = ['start', 'end', 'length', 'mean_share', 'max_share',
+               'max_cells']
+    if not len(starts):
+        return pd.DataFrame(columns=columns)
+    # Time steps of all events one after another
+    event_of_step = np.repeat(np.arange(len(starts)), lengths)
+    steps = (np.arange(lengths.sum()) +
+             np.repeat(starts - np.cumsum(lengths) + lengths, lengths))
+    share_sum = np.bincount(event_of_step, weights=share[steps])
+    max_share = np.full(len(starts), -np.inf)
+    np.maximum.at(max_share, event_of_step, share[steps])
+    max_cells = np.zeros(len(starts), dtype=np.int64)
+    np.maximum.at(max_cells, event_of_step,
+                  coincidence['cells'].values[steps])
+    index = coincidence.index
+    return pd.DataFrame(
+        data={'start': index[starts], 'end': index[starts + lengths - 1],
+              'length': lengths, 'mean_share': share_sum / lengths,
+              'max_share': max_share, 'max_cells': max_cells},
+        columns=columns)
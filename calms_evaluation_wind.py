@@ -1,33 +1,57 @@
-import oemof.db as db
+import os
+from multiprocessing import cpu_count
 import geoplot
 import matplotlib.pyplot as plt
 plt.style.use('ggplot')
 import numpy as np
 import pandas as pd
-# import time
-import pickle
 from feedinlib import powerplants as plants
 from get_from_db import (fetch_shape_germany, get_data, coastdat_geoplot,
-                         calculate_avg_wind_speed, calculate_calms,
-                         plot_histogram, create_calms_dict, calms_frequency,
-                         filter_peaks)
+                         coastdat_geoplot_batch, run_plot_jobs,
+                         get_geometries, germany_geometries, COASTDAT_DE,
+                         calculate_avg_wind_speed, plot_histogram,
+                         calms_frequency_table, calculate_calms_multi,
+                         create_calm_mask, filter_calm_mask,
+                         calculate_calms_mask, load_matrix_columns, cached,
+                         cache_path,
+                         dump_weather_columns, load_weather_columns,
+                         load_feedin_matrix, combine_feedin)
+from data_backends import data_backend
+from profiling import StageProfiler
+from storage_estimate import estimate_storage, read_demand
 
 # ----------------------------- Set parameters ------------------------------ #
 year = 2011  # 1998 - 2014
 power_limit = [0.03, 0.05, 0.1]  # Must be list or array even if only one entry
-load_multi_weather = True  # False if you use a year you haven't dumped yet
-load_wind_feedin = True  # False if you use a year you haven't dumped yet
-load_pv_feedin = False  # False if you use a year you haven't dumped yet
-calms_filtered_load = True  # False is you haven't dumped the dictionary yet
-conn = db.connection(section='reiner')
+processes = None  # Processes for feedin calculation (None: number of cores)
+# Weather, feedin and filtered calms are cached with keys derived from all
+# their parameters and only calculated if they are not in the cache yet
+cache_folder = 'cache'
+cache_max_size = 50e9  # Maximum size of the cache in bytes (None: no limit)
+cache_max_age = None  # Maximum age of unused data in seconds (None: no limit)
+# Weather: 'pickle' or 'columns' (one .npy file per variable)
+data_format = 'columns'
+# Data backend: 'postgis' (oemof database, connected on first use), 'local'
+# (weather stored with LocalBackend.store_weather and the bundled shapefile)
+# or 'synthetic' (stochastic weather, e.g. resolution=(0.05, 0.05) for a
+# larger grid), see data_backends
+conn = data_backend('postgis', section='reiner')
 show_plot = False
 save_figure = True
+plot_processes = None  # Processes for saving plots (None: number of cores)
 energy_source = 'Wind'  # 'Wind', 'PV' or 'Wind_PV'
+# Shares of the installed capacity of each location for 'Wind_PV'
+capacity_shares = {'Wind': 0.5, 'PV': 0.5}
 # Filter or don't filter peaks (or both)
 filter = [
     'unfiltered',  # always calculated, but only plotted if not uncommented
     'filtered'  # only calculated and plottet if not uncommented
 ]
+filter_passes = 1  # Number of filter passes, None: until no peaks are left
+# Time, memory and counts of each stage are written to report_folder (one
+# JSON file per run and stages.csv with all runs)
+report_folder = 'reports'
+profile = False  # Run each stage under cProfile (statistics in 'profiles')
 
 # ----------------------- Plots and their parameters ------------------------ #
 # The following plots are created:
@@ -58,7 +82,9 @@ tick_freq = 200  # Frequency of x-ticks
 others = [
     'average_wind_speed',
     # 'average_irradiance'  # not implemented yet
+    # 'storage_estimate'  # only for 'Wind_PV', see storage_estimate
 ]
+demand_file = 'storage_invest.csv'  # Demand (see storage_estimate.read_demand)
 save_folder3 = save_folder1
 
 # ---------------------- Weather and power plant data ----------------------- #
@@ -85,135 +111,272 @@ advent210 = {
     'tilt': 60,
     'albedo': 0.2}
 
+profiler = StageProfiler(profile=profile, year=year,
+                         energy_source=energy_source,
+                         power_limit=str(power_limit))
+
 # Get geometry for Germany for geoplot
-geom = geoplot.postgis2shapely(fetch_shape_germany(conn))
+with profiler.stage('shape'):
+    geom = geoplot.postgis2shapely(fetch_shape_germany(conn))
 # to plot smaller area
 #from shapely import geometry as geopy
 #geom = [geopy.Polygon(
     #[(12.2, 52.2), (12.2, 51.6), (13.2, 51.6), (13.2, 52.2)])]
 
 # -------------------------- Get weather objects ---------------------------- #
-print(' ')
-print('Collecting weather objects...')
-multi_weather = get_data(conn=conn, year=year, geom=geom[0],
-                         pickle_load=load_multi_weather,
-                         filename='multiweather_pickle_{0}.p'.format(year),
-                         data_type='multi_weather')
+if data_format == 'columns':
+    weather_io = {'dump': dump_weather_columns, 'load': load_weather_columns}
+else:
+    weather_io = {}
+# The feedin is stored as memory-mapped gid x hour array
+feedin_io = {'load': load_feedin_matrix, 'path_argument': True}
+weather_params = {'year': year, 'geom': geom[0]}
+if conn.cache_params:
+    weather_params['backend'] = conn.cache_params
+
+
+def load_multi_weather():
+    print('Collecting weather objects...')
+    with profiler.stage('weather'):
+        multi_weather = cached(
+            lambda: get_data(conn=conn, year=year, geom=geom[0],
+                             pickle_load=False, filename=None,
+                             data_type='multi_weather'),
+            'multi_weather', weather_params, cache_folder,
+            max_size=cache_max_size, max_age=cache_max_age, **weather_io)
+        profiler.count(cells=len(multi_weather))
+    return multi_weather
 
 # ------------------------------ Feedin data -------------------------------- #
-if (energy_source == 'Wind' or energy_source == 'Wind_PV'):
-    turbine = plants.WindPowerPlant(**enerconE126)
-    feedin = get_data(power_plant=turbine, multi_weather=multi_weather,
-                      pickle_load=load_wind_feedin,
-                      filename='windfeedin_pickle_{0}.p'.format(year),
-                      data_type='wind_feedin')
-if (energy_source == 'PV' or energy_source == 'Wind_PV'):
-    module = plants.Photovoltaic(**advent210)
-    feedin = get_data(power_plant=module, multi_weather=multi_weather,
-                      pickle_load=load_pv_feedin,
-                      filename='pv_feedin_pickle_{0}.p'.format(year),
-                      data_type='pv_feedin')
-# TODO: total sum of feedins for PV + Wind (feedin: Dictionary, keys: gids)
+print(' ')
+print('Collecting feedin...')
+with profiler.stage('feedin'):
+    feedin_matrices = {}
+    if (energy_source == 'Wind' or energy_source == 'Wind_PV'):
+        turbine = plants.WindPowerPlant(**enerconE126)
+        feedin_params = dict(weather_params, power_plant=enerconE126)
+        feedin_matrices['Wind'] = cached(
+            lambda path: get_data(power_plant=turbine,
+                                  multi_weather=load_multi_weather(),
+                                  pickle_load=False, filename=path,
+                                  data_type='wind_feedin',
+                                  processes=processes, data_format='memmap'),
+            'wind_feedin', feedin_params, cache_folder,
+            max_size=cache_max_size, max_age=cache_max_age, **feedin_io)
+    if (energy_source == 'PV' or energy_source == 'Wind_PV'):
+        module = plants.Photovoltaic(**advent210)
+        feedin_params = dict(weather_params, power_plant=advent210)
+        feedin_matrices['PV'] = cached(
+            lambda path: get_data(power_plant=module,
+                                  multi_weather=load_multi_weather(),
+                                  pickle_load=False, filename=path,
+                                  data_type='pv_feedin',
+                                  processes=processes, data_format='memmap'),
+            'pv_feedin', feedin_params, cache_folder,
+            max_size=cache_max_size, max_age=cache_max_age, **feedin_io)
+    if energy_source == 'Wind_PV':
+        # Feedin of the portfolio per installed capacity of each location
+        feedin_params = dict(weather_params,
+                             power_plant=[enerconE126, advent210],
+                             capacity_shares=capacity_shares)
+        feedin_matrix = cached(
+            lambda path: combine_feedin(
+                [feedin_matrices['Wind'], feedin_matrices['PV']],
+                [capacity_shares['Wind'], capacity_shares['PV']],
+                folder=path),
+            'wind_pv_feedin', feedin_params, cache_folder,
+            max_size=cache_max_size, max_age=cache_max_age, **feedin_io)
+    else:
+        feedin_matrix = feedin_matrices[energy_source]
+    profiler.count(cells=feedin_matrix.values.shape[0],
+                   hours=feedin_matrix.values.shape[1])
 # -------------------- Calms: Calculations and Geoplots --------------------- #
+# Geoplots are collected and rendered together at the end (keys: save folder
+# and scale parameter, data: list of (results, legend label, filename))
+geoplot_maps = {}
+# Plots that are only saved are run in a process pool at the end
+plot_jobs = []
+
+
+def add_plot_job(function, *args, **kwargs):
+    if show_plot or not save_figure:
+        function(*args, **kwargs)
+    else:
+        plot_jobs.append((function, args, kwargs))
+
+
+def add_geoplot(results_df, legend_label, filename_plot, save_folder,
+                scale=None):
+    if show_plot or not save_figure:
+        coastdat_geoplot(results_df, conn, show_plot, legend_label,
+                         save_figure, save_folder, cmapname, scale,
+                         filename_plot=filename_plot,
+                         cache_folder=cache_folder)
+    else:
+        geoplot_maps.setdefault((save_folder, scale), []).append(
+            (results_df, legend_label, filename_plot))
+
 # Calculate calms
 print('Calculating calms...')
-# t0 = time.clock()
+# Unfiltered calms for all power limits in one pass
+with profiler.stage('calms'):
+    calms_unfiltered = calculate_calms_multi(feedin_matrix, power_limit)
+    profiler.count(cells=feedin_matrix.values.shape[0],
+                   hours=feedin_matrix.values.shape[1],
+                   calms=sum(int(calms[4].sum())
+                             for calms in calms_unfiltered.values()))
 for i in range(len(power_limit)):
     print('  ...with power limit: ' + str(int(power_limit[i]*100)) + '%')
-    # Get all calms
-    calms_dict = create_calms_dict(power_limit[i], feedin)
-    dict_list = []
+    calms_list = []
     if 'unfiltered' in filter:
-        dict_list.append(calms_dict)
+        calms_list.append(calms_unfiltered[power_limit[i]])
     if 'filtered' in filter:
-        # Get all calms with filtered peaks
-        filename = 'calms_dict_filtered_pickle_{0}_{1}_{2}.p'.format(
-            year, energy_source, power_limit[i])
-        if calms_filtered_load:
-            calms_dict_filtered = pickle.load(open(filename, 'rb'))
-        else:
-            calms_dict_filtered = filter_peaks(calms_dict, power_limit[i])
-            pickle.dump(calms_dict_filtered, open(filename, 'wb'))
-        dict_list.append(calms_dict_filtered)
+        # Get all calms with filtered peaks (stored as packed calm mask)
+        calm_params = dict(feedin_params, energy_source=energy_source,
+                           power_limit=power_limit[i],
+                           filter_passes=filter_passes)
+        with profiler.stage('filter_{0}'.format(power_limit[i])):
+            calm_mask_filtered = cached(
+                lambda: filter_calm_mask(
+                    feedin_matrix,
+                    create_calm_mask(power_limit[i], feedin_matrix),
+                    power_limit[i], passes=filter_passes),
+                'calm_mask_filtered', calm_params, cache_folder,
+                max_size=cache_max_size, max_age=cache_max_age)
+            calms_list.append(calculate_calms_mask(calm_mask_filtered,
+                                                   feedin_matrix))
+            profiler.count(cells=feedin_matrix.values.shape[0],
+                           hours=feedin_matrix.values.shape[1],
+                           calms=int(calms_list[-1][4].sum()))
     # Plots
-    for k in range(len(dict_list)):
+    for k in range(len(calms_list)):
         if (k == 0 and 'unfiltered' in filter):
             string = ''
         if (k == 1 or (k == 0 and 'unfiltered' not in filter)):
             string = 'filtered'
-        calms_max, calms_min, calm_lengths = calculate_calms(dict_list[k])
+        (calms_max, calms_min, calm_lengths, calm_starts,
+         calm_counts) = calms_list[k]
         if 'longest_calms' in geoplots:
             # Geoplot of longest calms of each location
             legend_label = ('Longest calms in hours Germany ' +
                             '{0} power limit < {1}% {2} {3}'.format(
                                 year, int(power_limit[i]*100), energy_source,
                                 string))
-            coastdat_geoplot(calms_max, conn, show_plot, legend_label,
-                             save_figure, save_folder1, cmapname,
-                             scale_parameter,
-                             filename_plot='Longest_calms_' +
-                                           '{0}_{1}_{2}_{3}.png'.format(
-                                               energy_source, year,
-                                               power_limit[i], string))
+            add_geoplot(calms_max, legend_label,
+                        'Longest_calms_{0}_{1}_{2}_{3}.png'.format(
+                            energy_source, year, power_limit[i], string),
+                        save_folder1, scale_parameter)
         if 'frequency' in geoplots:
             # Creates Plot only for unfiltered calms
             if (k == 0 and 'unfiltered' in filter):
                 # Geoplot of calm lengths > certain calm length (min_lengths)
+                frequency_table = calms_frequency_table(calm_lengths,
+                                                        min_lengths)
                 for j in range(len(min_lengths)):
-                    frequencies = calms_frequency(calm_lengths, min_lengths[j])
+                    frequencies = frequency_table[[min_lengths[j]]]
+                    frequencies.columns = ['results']
                     legend_label = (
                         'Frequency of calms >= ' +
                         '{0} h in {1} power limit < {2}% {3}'.format(
                             int(min_lengths[j]), year,
                             int(power_limit[i] * 100), energy_source))
-                    coastdat_geoplot(frequencies, conn, show_plot,
-                                     legend_label, save_figure, save_folder1,
-                                     cmapname, scale_parameter,
-                                     filename_plot=
-                                     'Frequency_{0}_{1}h_{2}_{3}.png'.format(
-                                         energy_source, int(min_lengths[j]),
-                                         year, power_limit[i]))
+                    add_geoplot(frequencies, legend_label,
+                                'Frequency_{0}_{1}h_{2}_{3}.png'.format(
+                                    energy_source, int(min_lengths[j]), year,
+                                    power_limit[i]),
+                                save_folder1, scale_parameter)
         if 'longest_calms' in histograms:
             # Histogram containing longest calms of each location
             legend_label = ('Longest calms Germany ' +
                             '{0} power limit < {1}% {2} {3}'.format(
                                 year, int(power_limit[i]*100), energy_source,
                                 string))
-            plot_histogram(calms_max, show_plot, legend_label, x_label,
-                           y_label, save_folder2, save_figure, y_limit,
-                           x_limit, bin_width, tick_freq,
-                           filename_plot='Histogram_longest_calms_' +
-                                         '_{0}_{1}_{2}_{3}.png'.format(
-                                             energy_source, year,
-                                             power_limit[i], string))
+            add_plot_job(plot_histogram, calms_max, show_plot, legend_label,
+                         x_label, y_label, save_folder2, save_figure, y_limit,
+                         x_limit, bin_width, tick_freq,
+                         filename_plot='Histogram_longest_calms_' +
+                                       '_{0}_{1}_{2}_{3}.png'.format(
+                                           energy_source, year,
+                                           power_limit[i], string))
         if 'all_calms' in histograms:
-            # Histogram containing all calms of all location
-            calm_arr = np.array([])
-            for key in calm_lengths:
-                calm_arr = np.append(calm_arr, calm_lengths[key])
-            calm_df = pd.DataFrame(data=calm_arr, columns=['results'])
+            # Histogram containing all calms of all location (pre-binned)
             legend_label = ('Calms Germany ' +
                             '{0} power limit < {1}% {2} {3}'.format(
                                 year, int(power_limit[i] * 100), energy_source,
                                 string))
-            plot_histogram(calm_df, show_plot, legend_label, x_label, y_label,
-                           save_folder2, save_figure, y_limit, x_limit,
-                           bin_width, tick_freq,
-                           filename_plot='Histogram_calms_' +
-                                         '_{0}_{1}_{2}_{3}.png'.format(
-                                             energy_source, year,
-                                             power_limit[i], string))
-# print(str(time.clock() - t0) + ' seconds since t0')
+            add_plot_job(plot_histogram, calm_counts, show_plot,
+                         legend_label, x_label, y_label, save_folder2,
+                         save_figure, y_limit, x_limit, bin_width, tick_freq,
+                         filename_plot='Histogram_calms_' +
+                                       '_{0}_{1}_{2}_{3}.png'.format(
+                                           energy_source, year,
+                                           power_limit[i], string),
+                         binned=True)
 
 # --------------------------- Average wind speed ---------------------------- #
 if 'average_wind_speed' in others:
     print('Calculating average wind speed...')
-    wind_speed = calculate_avg_wind_speed(multi_weather)
+    with profiler.stage('average_wind_speed'):
+        if data_format == 'columns':
+            # Only load the wind speed
+            weather_path = cache_path('multi_weather', weather_params,
+                                      cache_folder)
+            if not os.path.exists(weather_path):
+                load_multi_weather()
+            weather_columns, metadata = load_matrix_columns(
+                weather_path, ['v_wind'])
+            wind_speed = calculate_avg_wind_speed(
+                weather_columns['v_wind'])
+        else:
+            wind_speed = calculate_avg_wind_speed(load_multi_weather())
     # Geoplot of average wind speed of each location
     legend_label = 'Average wind speed {0}'.format(year)
-    coastdat_geoplot(wind_speed, conn, show_plot, legend_label, save_figure,
-                     save_folder3, cmapname,
-                     filename_plot='Average_wind_speed_{0}'.format(year))
+    add_geoplot(wind_speed, legend_label,
+                'Average_wind_speed_{0}'.format(year), save_folder3)
+
+# ---------------------------- Storage estimate ----------------------------- #
+if 'storage_estimate' in others and energy_source == 'Wind_PV':
+    print('Estimating storage size...')
+    with profiler.stage('storage_estimate',
+                        cells=feedin_matrix.values.shape[0],
+                        hours=feedin_matrix.values.shape[1]):
+        storage = estimate_storage(feedin_matrices['Wind'],
+                                   feedin_matrices['PV'],
+                                   read_demand(demand_file))
+    for column, name in (('energy', 'capacity'), ('power', 'power')):
+        legend_label = 'Storage {0} estimate {1}'.format(name, year)
+        add_geoplot(storage[[column]].rename(columns={column: 'results'}),
+                    legend_label,
+                    'Storage_{0}_estimate_{1}'.format(name, year),
+                    save_folder3)
+
+# ------------------------- Batch geoplots and export ----------------------- #
+# All geoplots with the same folder and scale are rendered in one figure per
+# process; the geometries are fetched here so that the workers find them in
+# the cache and need no database connection
+with profiler.stage('plots'):
+    if geoplot_maps:
+        get_geometries(conn, cache_folder, **COASTDAT_DE)
+        germany_geometries(conn, cache_folder)
+    for (save_folder, scale), maps in geoplot_maps.items():
+        results = pd.concat(
+            [results_df['results'] for results_df, _, _ in maps], axis=1,
+            keys=[filename for _, _, filename in maps])
+        n_jobs = min(len(maps), plot_processes or cpu_count())
+        for columns in np.array_split(results.columns, n_jobs):
+            plot_jobs.append((coastdat_geoplot_batch,
+                              (results[columns], None), {
+                'legend_labels': {filename: label
+                                  for _, label, filename in maps},
+                'filenames': {filename: filename for _, _, filename in maps},
+                'save_folder': save_folder, 'cmapname': cmapname,
+                'scale_parameter': scale, 'cache_folder': cache_folder}))
+    if plot_jobs:
+        print('Saving {0} plot jobs...'.format(len(plot_jobs)))
+        failures = run_plot_jobs(plot_jobs, plot_processes)
+        profiler.count(plot_jobs=len(plot_jobs))
+        print('{0} plot jobs failed.'.format(len(failures)))
+print('Report: {0}'.format(profiler.write_report(report_folder)[0]))
 
 # # ---------------------------- Jahresdauerlinie ----------------------------- #
 # # Plot of "Jahresdauerlinie"
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import pandas as pd
+from get_from_db import (FeedinMatrix, find_calm_runs, calculate_feedin,
+                         load_feedin_matrix, load_weather_columns)
+
+
+def stream_feedin(folders, chunk_size=500):
+    """
+    Yields the feedin of chunks of chunk_size gids from memory-mapped feedin
+    matrices (see load_feedin_matrix), e.g. one folder per year.
+
+    Yields
+    ------
+    feedin_chunk : list
+        FeedinMatrix of the chunk for each folder (in the order of folders).
+    """
+    matrices = [load_feedin_matrix(folder) for folder in folders]
+    gids = matrices[0].gids
+    for matrix in matrices[1:]:
+        if not np.array_equal(matrix.gids, gids):
+            raise ValueError('All feedin matrices must have the same gids.')
+    for first in range(0, len(gids), chunk_size):
+        rows = slice(first, first + chunk_size)
+        yield [FeedinMatrix(values=np.asarray(matrix.values[rows]),
+                            gids=gids[rows], index=matrix.index)
+               for matrix in matrices]
+
+
+def stream_feedin_from_weather(weather_folders, power_plant, chunk_size=500,
+                               processes=1, **kwargs):
+    """
+    Yields the feedin of power_plant for chunks of chunk_size gids calculated
+    from weather dumped with dump_weather_columns (e.g. one folder per year).
+    Only the weather of one chunk is loaded at a time. kwargs are passed to
+    power_plant.feedin (e.g. installed_capacity=1).
+    """
+    gids = np.load(os.path.join(weather_folders[0], 'gids.npy'))
+    for first in range(0, len(gids), chunk_size):
+        chunk_gids = gids[first:first + chunk_size]
+        yield [calculate_feedin(power_plant,
+                                load_weather_columns(folder, chunk_gids),
+                                processes=processes, **kwargs)[0]
+               for folder in weather_folders]
+
+
+def stream_calm_runs(feedin_chunks, power_limit):
+    """
+    Finds the calms (feedin < power_limit) of each chunk of a feedin stream
+    (see stream_feedin). The periods of a chunk (e.g. years) are processed one
+    after another and calms that last beyond the end of a period are
+    continued in the next one, so calms across year boundaries are found
+    correctly.
+
+    Yields
+    ------
+    gids : array
+        Gids of the chunk.
+    rows, starts, lengths : array
+        Calms as returned by find_calm_runs; starts count the time steps from
+        the beginning of the first period.
+    """
+    for feedin_chunk in feedin_chunks:
+        gids = feedin_chunk[0].gids
+        # Calm that is still running at the end of the previous period
+        open_start = np.zeros(len(gids), dtype=int)
+        open_length = np.zeros(len(gids), dtype=int)
+        offset = 0
+        rows_list, starts_list, lengths_list = [], [], []
+        for matrix in feedin_chunk:
+            n_steps = matrix.values.shape[1]
+            rows, starts, lengths = find_calm_runs(
+                matrix.values < power_limit)
+            ends = starts + lengths
+            starts = starts + offset
+            # Continue running calms
+            continued = (starts == offset) & (open_length[rows] > 0)
+            starts[continued] = open_start[rows[continued]]
+            lengths[continued] += open_length[rows[continued]]
+            # Running calms that ended with the previous period
+            closed = open_length > 0
+            closed[rows[continued]] = False
+            rows_list.append(np.flatnonzero(closed))
+            starts_list.append(open_start[closed])
+            lengths_list.append(open_length[closed])
+            # Calms running at the end of this period are kept open
+            running = ends == n_steps
+            open_length[:] = 0
+            open_start[rows[running]] = starts[running]
+            open_length[rows[running]] = lengths[running]
+            rows_list.append(rows[~running])
+            starts_list.append(starts[~running])
+            lengths_list.append(lengths[~running])
+            offset += n_steps
+        closed = open_length > 0
+        rows_list.append(np.flatnonzero(closed))
+        starts_list.append(open_start[closed])
+        lengths_list.append(open_length[closed])
+        rows = np.concatenate(rows_list)
+        order = np.lexsort((np.concatenate(starts_list), rows))
+        yield (gids, rows[order], np.concatenate(starts_list)[order],
+               np.concatenate(lengths_list)[order])
+
+
+def aggregate_calms(calm_runs, min_lengths=(24, 48, 168), max_length=2000):
+    """
+    Aggregates a stream of calms (see stream_calm_runs) to the longest and
+    shortest calm and the frequency of calms >= each of min_lengths of each
+    location and a histogram of all calm lengths. Only the aggregated results
+    are kept, so the memory does not grow with the number of calms.
+
+    Returns
+    -------
+    results : Dictionary
+        'calms_max', 'calms_min': DataFrame (indices: gids, column
+        'results'), 'frequency': DataFrame (indices: gids, columns:
+        min_lengths), 'histogram': array with the number of calms of each
+        length 0...max_length (the last entry counts all longer calms).
+    """
+    min_lengths = np.asarray(min_lengths)
+    gids_list, maximum_list, minimum_list, frequency_list = [], [], [], []
+    histogram = np.zeros(max_length + 1, dtype=np.int64)
+    for gids, rows, starts, lengths in calm_runs:
+        n_rows = len(gids)
+        maximum = np.zeros(n_rows, dtype=int)
+        np.maximum.at(maximum, rows, lengths)
+        minimum = np.full(n_rows, np.iinfo(int).max, dtype=int)
+        np.minimum.at(minimum, rows, lengths)
+        minimum[np.bincount(rows, minlength=n_rows) == 0] = 0
+        frequency = np.zeros((n_rows, len(min_lengths)), dtype=int)
+        for k, min_length in enumerate(min_lengths):
+            frequency[:, k] = np.bincount(rows[lengths >= min_length],
+                                          minlength=n_rows)
+        histogram += np.bincount(np.minimum(lengths, max_length),
+                                 minlength=max_length + 1)
+        gids_list.append(gids)
+        maximum_list.append(maximum)
+        minimum_list.append(minimum)
+        frequency_list.append(frequency)
+    gids = np.concatenate(gids_list)
+    return {
+        'calms_max': pd.DataFrame(data=np.concatenate(maximum_list),
+                                  index=gids, columns=['results']),
+        'calms_min': pd.DataFrame(data=np.concatenate(minimum_list),
+                                  index=gids, columns=['results']),
+        'frequency': pd.DataFrame(data=np.vstack(frequency_list),
+                                  index=gids, columns=min_lengths),
+        'histogram': histogram}
+
+
+def evaluate_calms_streaming(feedin_chunks, power_limit,
+                             min_lengths=(24, 48, 168), max_length=2000):
+    """
+    Streams chunks of feedin (see stream_feedin and
+    stream_feedin_from_weather) through calm detection into the aggregated
+    results of aggregate_calms. The peak memory depends on the chunk size,
+    not on the number of locations.
+    """
+    return aggregate_calms(stream_calm_runs(feedin_chunks, power_limit),
+                           min_lengths, max_length)
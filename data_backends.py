@@ -0,0 +1,424 @@
+"""
+Data backends for get_data, fetch_geometries and fetch_shape_germany.
+
+A data backend can be passed wherever these functions expect a database
+connection (conn). Every backend provides
+
+    get_weather(geom, year)      weather objects of the cells in geom
+    weather_columns(year, ...)   weather variables as FeedinMatrix
+    fetch_geometries(**kwargs)   ids and geometries (WKT) of a table
+    fetch_shape_germany()        shape of the evaluated area (WKT)
+    cache_params                 parameters that distinguish the cached data
+                                 of the backend (None: same as the database)
+
+PostgisBackend     coastdat weather from the oemof database (connected on
+                   first use, not on import)
+LocalBackend       weather dumped with LocalBackend.store_weather and the
+                   bundled shapefile (no database)
+SyntheticBackend   stochastic weather on a regular grid of any size (no
+                   database, no files), e.g. for profiling and load tests
+"""
+import os
+import numpy as np
+import pandas as pd
+from get_from_db import (FeedinMatrix, GERMANY_SHAPEFILE, read_shapefile,
+                         read_shape_germany, fetch_geometries,
+                         fetch_shape_germany, dump_weather_columns,
+                         load_matrix_columns, weather_from_columns)
+
+# Grid of the coastDat2 weather data set
+GRID_TABLES = ('de_grid',)
+
+# Heights of the weather variables of the synthetic weather (as coastDat2)
+SYNTHETIC_DATA_HEIGHT = {
+    'dhi': 0,
+    'dirhi': 0,
+    'pressure': 0,
+    'temp_air': 2,
+    'v_wind': 10,
+    'Z0': 0}
+
+
+def data_backend(name='postgis', **kwargs):
+    """
+    Creates the data backend name ('postgis', 'local' or 'synthetic') with
+    the parameters kwargs.
+    """
+    backends = {'postgis': PostgisBackend, 'local': LocalBackend,
+                'synthetic': SyntheticBackend}
+    return backends[name](**kwargs)
+
+
+def _year_index(year):
+    return pd.date_range('{0}-01-01 00:00'.format(year),
+                         '{0}-12-31 23:00'.format(year), freq='60min',
+                         tz='UTC')
+
+
+def _cells_in(geometries, geom):
+    """
+    Returns a boolean array of the geometries (shapely) that intersect geom
+    (all if geom is None).
+    """
+    if geom is None:
+        return np.ones(len(geometries), dtype=bool)
+    from shapely.prepared import prep
+    area = prep(geom)
+    return np.array([area.intersects(cell) for cell in geometries],
+                    dtype=bool)
+
+
+def _geometry_frame(ids, geometries, kwargs):
+    """
+    Returns ids and geometries (shapely) as fetch_geometries does: column
+    id_col and 'geom' (simplified WKT), sorted by descending id.
+    """
+    id_col = kwargs.get('id_col', 'gid')
+    tolerance = float(kwargs.get('simp_tolerance', 0))
+    data = pd.DataFrame({
+        id_col: ids,
+        'geom': [geometry.simplify(tolerance).wkt
+                 for geometry in geometries]},
+        columns=[id_col, 'geom'])
+    return data.sort_values(id_col, ascending=False).reset_index(drop=True)
+
+
+def _single_weather(multi_weather, geom):
+    """
+    Returns the only weather object for point geometries (as
+    coastdat.get_weather does) and the list otherwise.
+    """
+    if geom is not None and geom.geom_type == 'Point':
+        return multi_weather[0]
+    return multi_weather
+
+
+class PostgisBackend(object):
+    """
+    Weather (coastdat) and geometries from the oemof database. The
+    connection is opened on first use with
+    oemof.db.connection(section=section) unless conn is given.
+    """
+    cache_params = None
+
+    def __init__(self, conn=None, section=None):
+        self._conn = conn
+        self.section = section
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            import oemof.db as db
+            if self.section is None:
+                self._conn = db.connection()
+            else:
+                self._conn = db.connection(section=self.section)
+        return self._conn
+
+    def __getstate__(self):
+        # Connections cannot be pickled; workers connect on their own
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    def get_weather(self, geom, year):
+        from oemof.db import coastdat
+        return coastdat.get_weather(self.conn, geom, year)
+
+    def weather_columns(self, year, geom=None, variables=None):
+        multi_weather = self.get_weather(geom, year)
+        if not isinstance(multi_weather, list):
+            multi_weather = [multi_weather]
+        multi_weather = sorted(multi_weather, key=lambda weather: weather.name)
+        gids = np.array([weather.name for weather in multi_weather])
+        variables = variables or list(multi_weather[0].data.columns)
+        return {variable: FeedinMatrix(
+            values=np.vstack([np.asarray(weather.data[variable])
+                              for weather in multi_weather]),
+            gids=gids, index=multi_weather[0].data.index)
+            for variable in variables}
+
+    def fetch_geometries(self, **kwargs):
+        return fetch_geometries(self.conn, **kwargs)
+
+    def fetch_shape_germany(self):
+        return fetch_shape_germany(self.conn)
+
+
+class LocalBackend(object):
+    """
+    Weather from folders written by store_weather (one folder per year in
+    weather_folder, see dump_weather_columns) and geometries from the
+    weather cells (grid) and the shapefile (all other tables).
+    """
+
+    def __init__(self, weather_folder='weather', shapefile=GERMANY_SHAPEFILE):
+        self.weather_folder = weather_folder
+        self.shapefile = shapefile
+
+    @property
+    def cache_params(self):
+        return {'name': 'local',
+                'weather_folder': os.path.abspath(self.weather_folder),
+                'shapefile': os.path.abspath(self.shapefile)}
+
+    def _folder(self, year):
+        return os.path.join(self.weather_folder, str(year))
+
+    def store_weather(self, multi_weather, year):
+        """
+        Stores weather objects (e.g. of PostgisBackend.get_weather) as
+        weather of year.
+        """
+        dump_weather_columns(multi_weather, self._folder(year))
+
+    def _cells(self, year=None):
+        """
+        Returns the gids and cell geometries of the stored weather of year
+        (default: the first stored year).
+        """
+        from shapely import wkt
+        if year is None:
+            year = sorted(os.listdir(self.weather_folder))[0]
+        data, metadata = load_matrix_columns(self._folder(year))
+        gids = list(data.values())[0].gids
+        return gids, [wkt.loads(metadata[str(gid)]['geometry'])
+                      for gid in gids.tolist()]
+
+    def _gids_in(self, geom, year):
+        gids, geometries = self._cells(year)
+        return gids[_cells_in(geometries, geom)]
+
+    def get_weather(self, geom, year):
+        data, metadata = load_matrix_columns(self._folder(year),
+                                             gids=self._gids_in(geom, year))
+        return _single_weather(weather_from_columns(data, metadata), geom)
+
+    def weather_columns(self, year, geom=None, variables=None):
+        gids = None if geom is None else self._gids_in(geom, year)
+        return load_matrix_columns(self._folder(year), variables, gids)[0]
+
+    def fetch_geometries(self, **kwargs):
+        if kwargs.get('table') in GRID_TABLES:
+            gids, geometries = self._cells()
+        else:
+            geometries = read_shapefile(self.shapefile)
+            gids = np.arange(1, len(geometries) + 1)
+        return _geometry_frame(gids, geometries, kwargs)
+
+    def fetch_shape_germany(self):
+        return read_shape_germany(self.shapefile)
+
+
+def _check_autocorrelation(autocorrelation):
+    if not 0 < autocorrelation < 1:
+        raise ValueError('The autocorrelation must be between 0 and 1 '
+                         '(exclusive), not {0}.'.format(autocorrelation))
+
+
+def _ar1(noise, autocorrelation, segment=64):
+    """
+    Turns white noise (rows: time steps) into an AR(1) process with unit
+    variance and the given autocorrelation (0 < autocorrelation < 1).
+    Within segments of time steps the recursion is solved as one product
+    with the lower triangular matrix of the powers autocorrelation ** (i - j)
+    (only non-negative powers, so it stays finite), so only one step per
+    segment is done in Python.
+    """
+    _check_autocorrelation(autocorrelation)
+    shape = noise.shape
+    noise = noise.reshape(len(noise), -1) * np.sqrt(1 - autocorrelation ** 2)
+    noise[0] /= np.sqrt(1 - autocorrelation ** 2)
+    lags = np.arange(segment)
+    powers = np.tril(autocorrelation ** np.abs(
+        lags[:, np.newaxis] - lags[np.newaxis, :]))
+    carry = autocorrelation ** (lags + 1)
+    for first in range(0, len(noise), segment):
+        chunk = noise[first:first + segment]
+        n = len(chunk)
+        chunk[:] = powers[:n, :n].dot(chunk)
+        if first > 0:
+            # Continue from the last value of the previous segment
+            chunk += carry[:n, np.newaxis] * noise[first - 1]
+    return noise.reshape(shape)
+
+
+class SyntheticBackend(object):
+    """
+    Stochastic hourly weather of a regular grid of cells covering bounds
+    (lon_min, lat_min, lon_max, lat_max) with cells of resolution (lon,
+    lat) degrees. The gids are numbered row by row from the south-west.
+
+    The wind speed is the absolute value of two wind components which are
+    AR(1) processes (autocorrelation per hour) of a part common to all cells
+    (spatial_correlation) and a local part; the speeds are therefore
+    Rayleigh distributed with calms that span many cells. Irradiance follows
+    the position of the sun with stochastic cloudiness, temperature and
+    pressure follow seasonal and daily cycles. The same seed and year always
+    give the same weather of a cell, regardless of the selected area.
+    """
+
+    def __init__(self, bounds=(5.5, 47.0, 15.5, 55.5),
+                 resolution=(0.2, 0.125), mean_wind_speed=(5.0, 7.5),
+                 autocorrelation=0.97, spatial_correlation=0.6, seed=0,
+                 block_size=512):
+        self.bounds = tuple(bounds)
+        self.resolution = tuple(resolution)
+        self.mean_wind_speed = tuple(mean_wind_speed)
+        _check_autocorrelation(autocorrelation)
+        self.autocorrelation = autocorrelation
+        self.spatial_correlation = spatial_correlation
+        self.seed = seed
+        self.block_size = block_size
+        self.shape = (
+            int(np.ceil((bounds[3] - bounds[1]) / resolution[1] - 1e-9)),
+            int(np.ceil((bounds[2] - bounds[0]) / resolution[0] - 1e-9)))
+
+    @property
+    def cache_params(self):
+        return {'name': 'synthetic', 'bounds': self.bounds,
+                'resolution': self.resolution,
+                'mean_wind_speed': self.mean_wind_speed,
+                'autocorrelation': self.autocorrelation,
+                'spatial_correlation': self.spatial_correlation,
+                'seed': self.seed, 'block_size': self.block_size}
+
+    @property
+    def gids(self):
+        return np.arange(1, self.shape[0] * self.shape[1] + 1)
+
+    def coordinates(self, gids):
+        """
+        Returns the longitude and latitude of the centres of the cells gids.
+        """
+        rows, columns = np.divmod(np.asarray(gids) - 1, self.shape[1])
+        return (self.bounds[0] + (columns + 0.5) * self.resolution[0],
+                self.bounds[1] + (rows + 0.5) * self.resolution[1])
+
+    def cell_geometries(self, gids):
+        from shapely.geometry import box
+        longitudes, latitudes = self.coordinates(gids)
+        half_lon, half_lat = self.resolution[0] / 2, self.resolution[1] / 2
+        return [box(lon - half_lon, lat - half_lat, lon + half_lon,
+                    lat + half_lat)
+                for lon, lat in zip(longitudes, latitudes)]
+
+    def gids_in(self, geom):
+        """
+        Returns the gids of the cells that intersect geom (all for None).
+        """
+        gids = self.gids
+        if geom is None:
+            return gids
+        # Only test the cells close to the bounding box of geom
+        lon_min, lat_min, lon_max, lat_max = geom.bounds
+        longitudes, latitudes = self.coordinates(gids)
+        near = ((np.abs(longitudes - np.clip(longitudes, lon_min, lon_max)) <
+                 self.resolution[0]) &
+                (np.abs(latitudes - np.clip(latitudes, lat_min, lat_max)) <
+                 self.resolution[1]))
+        gids = gids[near]
+        return gids[_cells_in(self.cell_geometries(gids), geom)]
+
+    def _wind_speed(self, gids, year, n_steps, mean_speed):
+        """
+        Returns the wind speed (gids x time steps) of the cells gids with the
+        given mean speeds, generated per block of block_size gids.
+        """
+        common = _ar1(np.random.RandomState((self.seed, year, 0)).
+                      standard_normal((n_steps, 2)), self.autocorrelation)
+        weight = np.sqrt(self.spatial_correlation)
+        # The mean of the absolute value of two standard normal variables
+        # is sqrt(pi / 2)
+        scale = mean_speed / np.sqrt(np.pi / 2)
+        blocks = (gids - 1) // self.block_size
+        v_wind = np.empty((len(gids), n_steps))
+        for block in np.unique(blocks):
+            in_block = np.flatnonzero(blocks == block)
+            rng = np.random.RandomState((self.seed, year, block + 1))
+            local = _ar1(rng.standard_normal((n_steps, 2 * self.block_size)),
+                         self.autocorrelation)
+            columns = 2 * ((gids[in_block] - 1) % self.block_size)
+            x = (weight * common[:, :1] +
+                 np.sqrt(1 - weight ** 2) * local[:, columns])
+            y = (weight * common[:, 1:] +
+                 np.sqrt(1 - weight ** 2) * local[:, columns + 1])
+            v_wind[in_block] = np.hypot(x, y).T * scale[in_block, np.newaxis]
+        return v_wind
+
+    def weather_columns(self, year, geom=None, variables=None, gids=None):
+        """
+        Generates the weather variables (default: all of
+        SYNTHETIC_DATA_HEIGHT) of the cells in geom (or the given gids).
+        """
+        if gids is None:
+            gids = self.gids_in(geom)
+        gids = np.asarray(gids)
+        variables = variables or list(SYNTHETIC_DATA_HEIGHT)
+        index = _year_index(year)
+        n_steps = len(index)
+        longitudes, latitudes = self.coordinates(gids)
+        north = ((latitudes - self.bounds[1]) /
+                 max(self.bounds[3] - self.bounds[1], 1e-9))
+        data = {}
+        if 'v_wind' in variables:
+            # Mean wind speed increases to the north (coast)
+            mean_speed = (self.mean_wind_speed[0] + north *
+                          (self.mean_wind_speed[1] - self.mean_wind_speed[0]))
+            data['v_wind'] = self._wind_speed(gids, year, n_steps,
+                                              mean_speed)
+        day = np.asarray(index.dayofyear, dtype=float)
+        hour = np.asarray(index.hour, dtype=float)
+        if 'dhi' in variables or 'dirhi' in variables:
+            # Position of the sun (solar time from the longitude)
+            declination = np.radians(23.44) * np.sin(
+                2 * np.pi * (day - 81) / 365)
+            hour_angle = np.radians(15 * (hour[np.newaxis, :] +
+                                          longitudes[:, np.newaxis] / 15 -
+                                          12))
+            latitude = np.radians(latitudes)[:, np.newaxis]
+            sin_elevation = np.clip(
+                np.sin(latitude) * np.sin(declination) + np.cos(latitude) *
+                np.cos(declination) * np.cos(hour_angle), 0, None)
+            clear_sky = 1000 * sin_elevation ** 1.15
+            clouds = 1 / (1 + np.exp(-_ar1(
+                np.random.RandomState((self.seed, year, 0, 1)).
+                standard_normal(n_steps), 0.9)))
+            data['dirhi'] = clear_sky * 0.8 * (1 - clouds)
+            data['dhi'] = clear_sky * (0.1 + 0.35 * clouds)
+        if 'temp_air' in variables:
+            data['temp_air'] = (
+                282 - 4 * north[:, np.newaxis] -
+                9 * np.cos(2 * np.pi * (day - 20) / 365) -
+                4 * np.cos(2 * np.pi * (hour - 15) / 24))
+        if 'pressure' in variables:
+            data['pressure'] = np.broadcast_to(
+                (101325 - 1000 * north)[:, np.newaxis], (len(gids), n_steps))
+        if 'Z0' in variables:
+            data['Z0'] = np.broadcast_to(0.15, (len(gids), n_steps))
+        return {variable: FeedinMatrix(values=data[variable], gids=gids,
+                                       index=index)
+                for variable in variables}
+
+    def get_weather(self, geom, year):
+        data = self.weather_columns(year, geom)
+        gids = data['v_wind'].gids
+        longitudes, latitudes = self.coordinates(gids)
+        metadata = {str(gid): {
+            'longitude': lon, 'latitude': lat, 'geometry': geometry.wkt,
+            'data_height': SYNTHETIC_DATA_HEIGHT}
+            for gid, lon, lat, geometry in zip(
+                gids.tolist(), longitudes, latitudes,
+                self.cell_geometries(gids))}
+        return _single_weather(weather_from_columns(data, metadata), geom)
+
+    def fetch_geometries(self, **kwargs):
+        from shapely.geometry import box
+        if kwargs.get('table') in GRID_TABLES:
+            gids = self.gids
+            return _geometry_frame(gids, self.cell_geometries(gids), kwargs)
+        return _geometry_frame([1], [box(*self.bounds)], kwargs)
+
+    def fetch_shape_germany(self):
+        from shapely.geometry import box
+        return (box(*self.bounds).wkt,)
@@ -1,20 +1,70 @@
-import oemof.db as db
-from oemof.db import coastdat
 import pandas as pd
 import numpy as np
-import geoplot
 import matplotlib.pyplot as plt
+from matplotlib.collections import PatchCollection
+from matplotlib.patches import PathPatch
 plt.style.use('ggplot')
 import pickle
 import os
-import copy
+import json
+import time
+import shutil
+import hashlib
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import namedtuple
+
+# Feedin (or weather variable) of all locations as one 2-D array with the gids
+# of the locations as rows and the time steps as columns.
+FeedinMatrix = namedtuple('FeedinMatrix', ['values', 'gids', 'index'])
+
+# Calms of all locations as packed bits (one row of bytes per location, 8 time
+# steps per byte) with the gids of the rows, which have to match the gids of
+# the FeedinMatrix the mask is used with (see check_calm_mask).
+CalmMask = namedtuple('CalmMask', ['bits', 'gids'])
+
+# Increase if the way cached data is calculated changes (invalidates caches)
+CACHE_VERSION = 2
+
+GERMANY_SHAPEFILE = os.path.join(os.path.dirname(__file__),
+                                 'germany_and_offshore',
+                                 'germany_and_offshore.shp')
+
+# Geometries of get_geometries (keys: cache_key of the query)
+_geometries = {}
+
+# Cached data used by this process (paths), never evicted by evict_cache as
+# it may still be in use (e.g. memory-mapped)
+_cache_in_use = set()
+
+# Queries of the geometries for coastdat_geoplot
+COASTDAT_DE = {
+    'table': 'de_grid',
+    'geo_col': 'geom',
+    'id_col': 'gid',
+    'schema': 'coastdat',
+    'simp_tolerance': '0.01',
+    'where_col': 'gid',
+    'where_cond': '> 0'}
+GERMANY_REGIONS = {
+    'table': 'deu3_21',
+    'geo_col': 'geom',
+    'id_col': 'region_id',
+    'schema': 'deutschland',
+    'simp_tolerance': '0.01',
+    'where_col': 'region_id',
+    'where_cond': '> 0'}
 
 
 def fetch_geometries(conn, **kwargs):
     """
     Reads the geometry and the id of all given tables and writes it to
     the 'geom'-key of each branch of the data tree.
+    conn is a database connection or a data backend (see data_backends).
     """
+    if hasattr(conn, 'fetch_geometries'):
+        return conn.fetch_geometries(**kwargs)
     sql_str = '''
         SELECT {id_col}, ST_AsText(
             ST_SIMPLIFY({geo_col},{simp_tolerance})) geom
@@ -30,44 +80,548 @@ def fetch_geometries(conn, **kwargs):
 
 def fetch_shape_germany(conn):
     """
-    Gets shape for Germany.
+    Gets shape for Germany. Without database connection (conn=None) the
+    bundled shapefile germany_and_offshore is used. conn may also be a data
+    backend (see data_backends).
     """
+    if hasattr(conn, 'fetch_shape_germany'):
+        return conn.fetch_shape_germany()
+    if conn is None:
+        return read_shape_germany()
     sql_str = '''
             SELECT ST_AsText(ST_Union(geom)) AS geom
             FROM deutschland.deu3_21'''
     return conn.execute(sql_str).fetchall()[0]
 
 
+def read_shapefile(filename=GERMANY_SHAPEFILE):
+    """
+    Reads all geometries of a shapefile (default: the bundled shapefile of
+    Germany with offshore areas) as shapely geometries.
+    """
+    import fiona
+    from shapely.geometry import shape
+    with fiona.open(filename) as shapes:
+        return [shape(feature['geometry']) for feature in shapes]
+
+
+def read_shape_germany(filename=GERMANY_SHAPEFILE):
+    """
+    Returns the union of all geometries of a shapefile (default: the bundled
+    shapefile of Germany with offshore areas) as WKT in a tuple, as
+    fetch_shape_germany.
+    """
+    from shapely.ops import unary_union
+    return (unary_union(read_shapefile(filename)).wkt,)
+
+
+def _dump_geometries(geometries, path):
+    data = geometries.copy()
+    data['geom'] = [geom.wkb_hex for geom in data['geom']]
+    data.to_csv(path, index=False)
+
+
+def _load_geometries(path):
+    from shapely import wkb
+    data = pd.read_csv(path)
+    data['geom'] = [wkb.loads(geom, hex=True) for geom in data['geom']]
+    return data
+
+
+def get_geometries(conn, cache_folder='cache', **kwargs):
+    """
+    Returns the geometries of fetch_geometries(conn, **kwargs) as shapely
+    geometries (column 'geom'). They are kept in memory and as WKB in
+    cache_folder (keyed by all kwargs: table, simplification tolerance,
+    where clause, ...), so the database is only queried once; afterwards conn
+    may be None. Geometries of data backends with cache_params (e.g. the
+    synthetic grid) are cached separately.
+    """
+    params = dict(kwargs)
+    if getattr(conn, 'cache_params', None):
+        params['backend'] = conn.cache_params
+    key = cache_key(**params)
+    if key not in _geometries:
+        def fetch():
+            import geoplot
+            geometries = fetch_geometries(conn, **kwargs)
+            geometries['geom'] = geoplot.postgis2shapely(geometries.geom)
+            return geometries
+        _geometries[key] = cached(fetch, 'geometries', params, cache_folder,
+                                  dump=_dump_geometries,
+                                  load=_load_geometries)
+    return _geometries[key].copy()
+
+
+def _feedin_worker(task):
+    """
+    Calculates the feedin of a chunk of weather objects and writes it into
+    the given rows of the shared memory block or memory-mapped .npy file of
+    calculate_feedin.
+    """
+    power_plant, multi_weather, rows, shm_name, filename, shape, kwargs = task
+    if filename is None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        values = np.ndarray(shape, dtype=float, buffer=shm.buf)
+    else:
+        values = np.load(filename, mmap_mode='r+')
+    try:
+        name = None
+        for row, weather in zip(rows, multi_weather):
+            feedin = power_plant.feedin(weather=weather, **kwargs)
+            values[row] = np.asarray(feedin, dtype=float)
+            name = getattr(feedin, 'name', None)
+    finally:
+        if filename is None:
+            del values
+            shm.close()
+        else:
+            values.flush()
+    return name
+
+
+def calculate_feedin(power_plant, multi_weather, processes=1, chunk_size=50,
+                     filename=None, **kwargs):
+    """
+    Calculates the feedin of power_plant for all weather objects of
+    multi_weather (kwargs are passed to power_plant.feedin).
+
+    With processes > 1 (None: number of cores) the weather objects are split
+    into chunks of chunk_size that are calculated in a process pool. The
+    workers write their results directly into a shared memory block, or into
+    the memory-mapped .npy file filename if given (the feedin then never has
+    to fit into memory).
+
+    Returns
+    -------
+    feedin_matrix : FeedinMatrix
+        Feedin with the rows sorted by gid (values memory-mapped if filename
+        is given).
+    name : string
+        Name of the feedin time series returned by power_plant.feedin.
+    """
+    multi_weather = sorted(multi_weather, key=lambda weather: weather.name)
+    gids = np.array([weather.name for weather in multi_weather])
+    if not len(multi_weather):
+        # No weather objects: no feedin (and no time steps)
+        values = np.empty((0, 0))
+        if filename is not None:
+            np.save(filename, values)
+            values = np.load(filename, mmap_mode='r')
+        return FeedinMatrix(values=values, gids=gids,
+                            index=pd.DatetimeIndex([])), None
+    index = multi_weather[0].data.index
+    shape = (len(multi_weather), len(index))
+    if filename is None:
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=int(np.prod(shape)) * 8)
+        shm_name = shm.name
+    else:
+        np.lib.format.open_memmap(filename, mode='w+', dtype=float,
+                                  shape=shape).flush()
+        shm_name = None
+    try:
+        tasks = [(power_plant, multi_weather[first:first + chunk_size],
+                  range(first, min(first + chunk_size, shape[0])), shm_name,
+                  filename, shape, kwargs)
+                 for first in range(0, shape[0], chunk_size)]
+        if processes == 1:
+            names = [_feedin_worker(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                names = pool.map(_feedin_worker, tasks)
+        if filename is None:
+            values = np.ndarray(shape, dtype=float, buffer=shm.buf).copy()
+        else:
+            values = np.load(filename, mmap_mode='r')
+    finally:
+        if filename is None:
+            shm.close()
+            shm.unlink()
+    return FeedinMatrix(values=values, gids=gids, index=index), names[0]
+
+
+def dump_matrix_columns(folder, columns, gids, index, metadata=None):
+    """
+    Dumps 2-D arrays (rows: gids, columns: time steps) to a folder as one
+    .npy file per column (dictionary columns, keys: column names) together
+    with the gids, the time index and optional metadata (json).
+    Single columns and gids can then be read with load_matrix_columns without
+    loading the whole data set.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for name, values in columns.items():
+        np.save(os.path.join(folder, '{0}.npy'.format(name)),
+                np.asarray(values))
+    _dump_matrix_info(folder, list(columns), gids, index, metadata)
+
+
+def _dump_matrix_info(folder, columns, gids, index, metadata=None):
+    """
+    Writes the gids, time index and info.json of dump_matrix_columns for the
+    column names columns (.npy files that are already in folder).
+    """
+    np.save(os.path.join(folder, 'gids.npy'), np.asarray(gids))
+    index = pd.DatetimeIndex(index)
+    # time stamps in UTC if the index has a time zone
+    np.save(os.path.join(folder, 'index.npy'),
+            index.values.astype('datetime64[ns]'))
+    info = {'columns': columns,
+            'timezone': str(index.tz) if index.tz else None,
+            'metadata': metadata}
+    with open(os.path.join(folder, 'info.json'), 'w') as f:
+        json.dump(info, f)
+
+
+def load_matrix_columns(folder, columns=None, gids=None, mmap_mode='r'):
+    """
+    Loads (selected columns and gids of) data dumped with dump_matrix_columns.
+    The .npy files are memory-mapped (see numpy.load), so only the selected
+    gids are read from disk.
+
+    Returns
+    -------
+    data : Dictionary
+        keys: column names, data: FeedinMatrix.
+    metadata : Dictionary or None
+        Metadata given to dump_matrix_columns.
+    """
+    with open(os.path.join(folder, 'info.json')) as f:
+        info = json.load(f)
+    index = pd.DatetimeIndex(np.load(os.path.join(folder, 'index.npy')))
+    if info['timezone']:
+        index = index.tz_localize('UTC').tz_convert(info['timezone'])
+    all_gids = np.load(os.path.join(folder, 'gids.npy'))
+    if gids is None:
+        rows = slice(None)
+    else:
+        rows = np.flatnonzero(np.isin(all_gids, gids))
+    data = {}
+    for name in (columns or info['columns']):
+        values = np.load(os.path.join(folder, '{0}.npy'.format(name)),
+                         mmap_mode=mmap_mode)
+        data[name] = FeedinMatrix(values=values[rows], gids=all_gids[rows],
+                                  index=index)
+    return data, info['metadata']
+
+
+def dump_weather_columns(multi_weather, folder):
+    """
+    Dumps the weather objects of multi_weather column-wise (one gid x time
+    array per weather variable, e.g. 'v_wind.npy') to a folder.
+    """
+    multi_weather = sorted(multi_weather, key=lambda weather: weather.name)
+    variables = list(multi_weather[0].data.columns)
+    columns = {variable: np.vstack([np.asarray(weather.data[variable])
+                                    for weather in multi_weather])
+               for variable in variables}
+    metadata = {str(weather.name): {
+        'longitude': weather.longitude, 'latitude': weather.latitude,
+        'geometry': weather.geometry.wkt, 'data_height': weather.data_height}
+        for weather in multi_weather}
+    dump_matrix_columns(folder, columns, [w.name for w in multi_weather],
+                        multi_weather[0].data.index, metadata)
+
+
+def load_weather_columns(folder, gids=None, variables=None):
+    """
+    Creates weather objects (feedinlib.weather.FeedinWeather) for the given
+    gids and weather variables (default: all) from a folder written by
+    dump_weather_columns.
+    """
+    data, metadata = load_matrix_columns(folder, variables, gids)
+    return weather_from_columns(data, metadata)
+
+
+def weather_from_columns(data, metadata):
+    """
+    Creates weather objects (feedinlib.weather.FeedinWeather) from weather
+    variables (dictionary, keys: variable names, data: FeedinMatrix with the
+    same gids) and their metadata (keys: gids as strings, data: dictionary
+    with longitude, latitude, geometry (WKT) and data_height).
+    """
+    from feedinlib.weather import FeedinWeather
+    from shapely import wkt
+    matrices = list(data.values())
+    multi_weather = []
+    for row, key in enumerate(matrices[0].gids.tolist()):
+        meta = metadata[str(key)]
+        multi_weather.append(FeedinWeather(
+            data=pd.DataFrame({variable: np.asarray(data[variable].values[row])
+                               for variable in data},
+                              index=matrices[0].index),
+            timezone=matrices[0].index.tz, longitude=meta['longitude'],
+            latitude=meta['latitude'],
+            geometry=wkt.loads(meta['geometry']),
+            data_height=meta['data_height'], name=key))
+    return multi_weather
+
+
+def dump_feedin_columns(feedin, folder):
+    """
+    Dumps a feedin dictionary (keys: gids, data: time series) as one gid x
+    time array to a folder (see dump_matrix_columns).
+    """
+    feedin_matrix = feedin_to_matrix(feedin)
+    name = getattr(feedin[feedin_matrix.gids[0]], 'name', None)
+    dump_matrix_columns(folder, {'feedin': feedin_matrix.values},
+                        feedin_matrix.gids, feedin_matrix.index,
+                        metadata={'name': name})
+
+
+def load_feedin_columns(folder, gids=None):
+    """
+    Loads (the given gids of) a feedin dictionary dumped with
+    dump_feedin_columns.
+    """
+    columns, metadata = load_matrix_columns(folder, ['feedin'], gids)
+    feedin_matrix = columns['feedin']
+    feedin = {}
+    for row, key in enumerate(feedin_matrix.gids.tolist()):
+        feedin[key] = pd.Series(feedin_matrix.values[row],
+                                index=feedin_matrix.index,
+                                name=metadata['name'])
+    return feedin
+
+
+def load_feedin_matrix(folder, gids=None, mmap_mode='r'):
+    """
+    Loads (the given gids of) a feedin dumped with dump_feedin_columns or
+    calculated with get_data(data_format='memmap') as memory-mapped
+    FeedinMatrix.
+    """
+    return load_matrix_columns(folder, ['feedin'], gids, mmap_mode)[0][
+        'feedin']
+
+
 def get_data(conn=None, power_plant=None, multi_weather=None, year=None,
              geom=None, pickle_load=True, filename='pickle_dump.p',
-             data_type='multi_weather'):
+             data_type='multi_weather', processes=1, data_format='pickle'):
+    """
+    Gets the weather objects ('multi_weather') from the database (or the data
+    backend conn, see data_backends) or the wind
+    or pv feedin ('wind_feedin', 'pv_feedin') calculated from multi_weather
+    and dumps them to filename (nothing is dumped if filename is None), or
+    loads them from filename.
+    The feedin is a dictionary (keys: gids sorted ascending) of time series
+    and can be calculated in parallel (see calculate_feedin).
+
+    With data_format='columns' the data is dumped column-wise to the folder
+    filename (without extension) instead of a pickle file (see
+    dump_weather_columns and dump_feedin_columns).
+    With data_format='memmap' the feedin is calculated directly into a
+    memory-mapped gid x time array in the folder filename and returned as
+    FeedinMatrix (see load_feedin_matrix), e.g. one folder per year for
+    multi-year analyses.
+    """
+    if data_type == 'multi_weather':
+        dump, load = dump_weather_columns, load_weather_columns
+    else:
+        dump, load = dump_feedin_columns, load_feedin_columns
     if not pickle_load:
-        if data_type == 'multi_weather':
+        if data_type == 'multi_weather' and hasattr(conn, 'get_weather'):
+            data = conn.get_weather(geom, year)
+        elif data_type == 'multi_weather':
+            from oemof.db import coastdat
             data = coastdat.get_weather(conn, geom, year)
-        if data_type == 'wind_feedin':
-            data = {}
-            for i in range(len(multi_weather)):
-                data[multi_weather[i].name] = power_plant.feedin(
-                    weather=multi_weather[i], installed_capacity=1)
-        if data_type == 'pv_feedin':
+        if data_type in ('wind_feedin', 'pv_feedin'):
+            if data_type == 'wind_feedin':
+                kwargs = {'installed_capacity': 1}
+            else:
+                kwargs = {'peak_power': 1}
+            if data_format == 'memmap':
+                folder = os.path.splitext(filename)[0]
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                data, name = calculate_feedin(
+                    power_plant, multi_weather, processes=processes,
+                    filename=os.path.join(folder, 'feedin.npy'), **kwargs)
+                _dump_matrix_info(folder, ['feedin'], data.gids, data.index,
+                                  metadata={'name': name})
+                return data
+            feedin_matrix, name = calculate_feedin(
+                power_plant, multi_weather, processes=processes, **kwargs)
             data = {}
-            for i in range(len(multi_weather)):
-                data[multi_weather[i].name] = power_plant.feedin(
-                    weather=multi_weather[i], peak_power=1)
-        pickle.dump(data, open(filename, 'wb'))
+            for row, key in enumerate(feedin_matrix.gids.tolist()):
+                data[key] = pd.Series(feedin_matrix.values[row],
+                                      index=feedin_matrix.index, name=name)
+        if filename is not None and data_format == 'columns':
+            dump(data, os.path.splitext(filename)[0])
+        elif filename is not None:
+            pickle.dump(data, open(filename, 'wb'))
     if pickle_load:
-        data = pickle.load(open(filename, 'rb'))
+        if data_format == 'memmap':
+            data = load_feedin_matrix(os.path.splitext(filename)[0])
+        elif data_format == 'columns':
+            data = load(os.path.splitext(filename)[0])
+        else:
+            data = pickle.load(open(filename, 'rb'))
+    return data
+
+
+def _cache_repr(value):
+    """
+    Converts value to something json can dump for cache_key.
+    """
+    if hasattr(value, 'wkb_hex'):  # shapely geometry
+        return value.wkb_hex
+    if isinstance(value, dict):
+        return {str(key): _cache_repr(value[key]) for key in value}
+    if isinstance(value, (list, tuple)):
+        return [_cache_repr(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def cache_key(**params):
+    """
+    Returns a hash of all parameters (e.g. year, geometry, power plant
+    specification, power limit, filter passes) that identifies cached data.
+    """
+    params = _cache_repr(dict(params, cache_version=CACHE_VERSION))
+    return hashlib.sha1(json.dumps(params, sort_keys=True,
+                                   default=str).encode()).hexdigest()
+
+
+def cache_path(name, params, cache_folder='cache'):
+    """
+    Returns the path of the cached data name with the parameters params.
+    """
+    return os.path.join(cache_folder, '{0}_{1}'.format(
+        name, cache_key(**params)))
+
+
+def _cache_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f))
+                   for root, dirs, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def evict_cache(cache_folder='cache', max_size=None, max_age=None):
+    """
+    Deletes cached data that has not been used for max_age seconds and the
+    least recently used data until the cache is not bigger than max_size
+    bytes. Data used by this process (see cached) is kept, but counts
+    towards max_size.
+    """
+    if not os.path.isdir(cache_folder):
+        return
+    entries = []
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        if '_tmp' not in name:
+            entries.append((os.path.getmtime(path), _cache_size(path), path))
+    entries.sort()
+    total_size = sum(size for used, size, path in entries)
+    for used, size, path in entries:
+        too_old = max_age is not None and time.time() - used > max_age
+        too_big = max_size is not None and total_size > max_size
+        if not (too_old or too_big) or os.path.abspath(path) in _cache_in_use:
+            continue
+        _remove_path(path)
+        total_size -= size
+
+
+def cached(compute, name, params, cache_folder='cache', dump=None, load=None,
+           max_size=None, max_age=None, path_argument=False):
+    """
+    Returns the data name with the parameters params from the cache or
+    calculates it with compute() and adds it to the cache.
+
+    The data is stored under a key derived from all parameters (see
+    cache_key), so changing any of them never returns stale data. dump(data,
+    path) and load(path) store the data (default: pickle), e.g.
+    dump_weather_columns and load_weather_columns. After adding data the
+    cache is reduced with evict_cache(cache_folder, max_size, max_age).
+    With path_argument=True compute(path) writes the data to path itself
+    (e.g. a memory-mapped feedin) and the data is then loaded with load.
+    If another process added the same data in the meantime, its data is
+    used.
+    """
+    path = cache_path(name, params, cache_folder)
+    _cache_in_use.add(os.path.abspath(path))
+    if dump is None:
+        def dump(data, path):
+            with open(path, 'wb') as f:
+                pickle.dump(data, f)
+    if load is None:
+        def load(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+    if os.path.exists(path):
+        os.utime(path)  # mark as recently used
+        return load(path)
+    if not os.path.isdir(cache_folder):
+        os.makedirs(cache_folder)
+    # Write to a temporary path first so no incomplete data is ever loaded
+    tmp_path = '{0}_tmp{1}'.format(path, os.getpid())
+    if path_argument:
+        compute(tmp_path)
+    else:
+        data = compute()
+        dump(data, tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # A directory can not replace an existing one: added concurrently
+        if not os.path.exists(path):
+            raise
+        _remove_path(tmp_path)
+    if path_argument:
+        data = load(path)
+    evict_cache(cache_folder, max_size, max_age)
     return data
 
 
+def stack_weather(multi_weather, variables, dtype=float):
+    """
+    Stacks the weather variables of a list of weather objects into one array.
+
+    Returns
+    -------
+    values : array
+        variables x locations (in the order of multi_weather) x time steps.
+    gids : array
+        gids of the locations.
+    """
+    # No weather objects: no locations and no time steps
+    n_steps = len(multi_weather[0].data.index) if len(multi_weather) else 0
+    values = np.empty((len(variables), len(multi_weather), n_steps),
+                      dtype=dtype)
+    for row, weather in enumerate(multi_weather):
+        values[:, row] = weather.data[variables].values.T
+    return values, np.array([weather.name for weather in multi_weather])
+
+
 def calculate_avg_wind_speed(multi_weather):
-    avg_wind_speed = {}
-    for i in range(len(multi_weather)):
-        avg_wind_speed[multi_weather[i].name] = np.mean(
-            multi_weather[i].data.v_wind)
-    avg_wind_speed = pd.DataFrame(data=avg_wind_speed,
-                                  index=['results']).transpose()
-    return avg_wind_speed
+    """
+    Calculates the average wind speed of each location from a list of weather
+    objects or from a FeedinMatrix of the wind speed (e.g. the 'v_wind'
+    column of load_matrix_columns). See weather_statistics for further
+    statistics.
+    """
+    if isinstance(multi_weather, FeedinMatrix):
+        values, gids = multi_weather.values, multi_weather.gids
+    else:
+        values, gids = stack_weather(multi_weather, ['v_wind'])
+        values = values[0]
+    # No locations: the mean of the (0 x 0) array would warn
+    avg = np.asarray(values).mean(axis=1) if len(gids) else np.empty(0)
+    return pd.DataFrame(data=avg, index=gids, columns=['results'])
 
 
 def create_calms_dict(power_limit, wind_feedin):
@@ -76,7 +630,11 @@ def create_calms_dict(power_limit, wind_feedin):
     locations) with the wind feedin time series (column 'feedin_wind_pp') and
     information about calms (column 'calm' - calm: value of wind feedin,
     no calm: 'no_calm').
+    For a (memory-mapped) FeedinMatrix the CalmMask of create_calm_mask is
+    returned instead.
     """
+    if isinstance(wind_feedin, FeedinMatrix):
+        return create_calm_mask(power_limit, wind_feedin)
     calms_dict = {}
     for key in wind_feedin:
         feedin = pd.DataFrame(data=wind_feedin[key])
@@ -88,7 +646,435 @@ def create_calms_dict(power_limit, wind_feedin):
     return calms_dict
 
 
-def calculate_calms(calms_dict):
+def feedin_to_matrix(feedin):
+    """
+    Stacks the feedin time series of all locations (dictionary, keys: gids of
+    locations) into a FeedinMatrix with one row per gid.
+    """
+    gids = np.array(list(feedin.keys()))
+    values = np.vstack([np.asarray(feedin[key], dtype=float).ravel()
+                        for key in gids])
+    index = pd.Series(feedin[gids[0]]).index
+    return FeedinMatrix(values=values, gids=gids, index=index)
+
+
+def _capacity_weights(weights, gids):
+    """
+    Returns the weights (scalar, array in the order of gids or Series with
+    gids as indices) as array with one entry per gid.
+    """
+    if isinstance(weights, pd.Series):
+        weights = weights.reindex(gids).fillna(0).values
+    return np.broadcast_to(np.asarray(weights, dtype=float), (len(gids),))
+
+
+def common_rows(feedin_matrices):
+    """
+    Finds the gids contained in all FeedinMatrix objects and the row of each
+    of these gids in each matrix (the gids of a matrix need not be sorted).
+    If all matrices have the same gids, their order is kept, otherwise the
+    common gids are sorted.
+
+    Returns
+    -------
+    gids : array
+        Common gids.
+    rows : list
+        Array with the rows of the common gids for each matrix.
+    """
+    gids = np.asarray(feedin_matrices[0].gids)
+    if all(np.array_equal(matrix.gids, gids) for matrix in feedin_matrices):
+        return gids, [np.arange(len(gids))] * len(feedin_matrices)
+    for matrix in feedin_matrices[1:]:
+        gids = np.intersect1d(gids, matrix.gids)
+    rows = []
+    for matrix in feedin_matrices:
+        order = np.argsort(matrix.gids)
+        rows.append(order[np.searchsorted(matrix.gids, gids, sorter=order)])
+    return gids, rows
+
+
+def combine_feedin(feedin_matrices, weights=None, chunk_size=500,
+                   folder=None):
+    """
+    Combines the feedin (per installed capacity) of several power plants of
+    the same locations, e.g. wind and pv, to the feedin of the portfolio per
+    installed capacity: the sum of the feedins weighted with the share of
+    each power plant in the installed capacity of the location. Only gids
+    contained in all FeedinMatrix objects are kept.
+
+    Parameters
+    ----------
+    weights : list, optional
+        Installed capacity of each power plant (scalar, array in the order of
+        the gids of its FeedinMatrix or Series with gids as indices);
+        normalised per gid. Default: equal capacities.
+    folder : string, optional
+        If given, the result is written to a memory-mapped feedin in folder
+        (see load_feedin_matrix) instead of memory.
+    """
+    for matrix in feedin_matrices[1:]:
+        if matrix.values.shape[1] != feedin_matrices[0].values.shape[1]:
+            raise ValueError('All feedins must have the same time steps.')
+    gids, rows = common_rows(feedin_matrices)
+    if weights is None:
+        weights = [1] * len(feedin_matrices)
+    weights = np.vstack([
+        _capacity_weights(weight, gids) if isinstance(weight, pd.Series) or
+        np.ndim(weight) == 0 else np.asarray(weight, dtype=float)[matrix_rows]
+        for weight, matrix_rows in zip(weights, rows)])
+    total = weights.sum(axis=0)
+    weights = np.divide(weights, total, out=np.zeros_like(weights),
+                        where=total > 0)
+    shape = (len(gids), feedin_matrices[0].values.shape[1])
+    if folder is None:
+        values = np.empty(shape)
+    else:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        values = np.lib.format.open_memmap(
+            os.path.join(folder, 'feedin.npy'), mode='w+', dtype=float,
+            shape=shape)
+    for first in range(0, shape[0], chunk_size):
+        chunk = slice(first, first + chunk_size)
+        values[chunk] = 0
+        for matrix, matrix_rows, weight in zip(feedin_matrices, rows,
+                                               weights):
+            values[chunk] += (weight[chunk, np.newaxis] *
+                              matrix.values[matrix_rows[chunk]])
+    index = feedin_matrices[0].index
+    if folder is not None:
+        values.flush()
+        del values
+        _dump_matrix_info(folder, ['feedin'], gids, index,
+                          metadata={'name': 'feedin'})
+        return load_feedin_matrix(folder)
+    return FeedinMatrix(values=values, gids=gids, index=index)
+
+
+def aggregate_regions(feedin_matrix, regions, capacities=1, chunk_size=500):
+    """
+    Aggregates the feedin (per installed capacity) of the locations to the
+    feedin of regions per installed capacity, weighted with the installed
+    capacity of each location. Locations without region are ignored.
+
+    Parameters
+    ----------
+    regions : Series
+        Region of each location (indices: gids).
+    capacities : scalar, array or Series
+        Installed capacity of each location (see combine_feedin).
+
+    Returns
+    -------
+    region_feedin : FeedinMatrix
+        Feedin with one row per region; gids are the region names.
+    """
+    gids = feedin_matrix.gids
+    region_of_gid = pd.Series(regions).reindex(gids)
+    known = region_of_gid.notnull().values
+    names, region_rows = np.unique(region_of_gid[known].values,
+                                   return_inverse=True)
+    weights = np.zeros(len(gids))
+    weights[known] = _capacity_weights(capacities, gids)[known]
+    region_of_row = np.full(len(gids), -1)
+    region_of_row[known] = region_rows.ravel()
+    n_steps = feedin_matrix.values.shape[1]
+    values = np.zeros((len(names), n_steps))
+    for first in range(0, len(gids), chunk_size):
+        chunk = slice(first, first + chunk_size)
+        # Weighted sum of the chunk per region as one matrix product
+        membership = (region_of_row[chunk] ==
+                      np.arange(len(names))[:, np.newaxis])
+        values += (membership * weights[chunk]).dot(
+            feedin_matrix.values[chunk])
+    total = np.bincount(region_of_row[known], weights=weights[known],
+                        minlength=len(names))
+    values /= np.where(total > 0, total, 1)[:, np.newaxis]
+    return FeedinMatrix(values=values, gids=names, index=feedin_matrix.index)
+
+
+def find_calm_runs(calm_mask):
+    """
+    Finds all calms (runs of consecutive calm hours) in a 2-D boolean array
+    (rows: locations, columns: time steps) in one pass.
+
+    Returns
+    -------
+    rows : array
+        Row (location) of each calm.
+    starts : array
+        Index of the first time step of each calm.
+    lengths : array
+        Length of each calm in time steps.
+
+    The calms are sorted by row and start.
+    """
+    calm_mask = np.asarray(calm_mask, dtype=bool)
+    if calm_mask.ndim == 1:
+        calm_mask = calm_mask[np.newaxis, :]
+    n_rows, n_steps = calm_mask.shape
+    # Pad with 'no calm' so that every calm has a rising and a falling edge
+    padded = np.zeros((n_rows, n_steps + 2), dtype=np.int8)
+    padded[:, 1:-1] = calm_mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    return rows, starts, ends - starts
+
+
+def summarise_calm_runs(rows, starts, lengths, gids):
+    """
+    Creates the longest and shortest calm and the calm lengths and calm start
+    indices of each location from the output of find_calm_runs.
+    Locations without calms get a single calm of length 0 (as in
+    calculate_calms).
+
+    Returns
+    -------
+    calms_max : DataFrame
+        indices: gids of location, data: longest calm of location.
+    calms_min : DataFrame
+        indices: gids of location, data: shortest calm of location.
+    calm_lengths : Dictionary
+        keys: gids of weather location, data: array
+        Length of the single calms for each location.
+    calm_starts : Dictionary
+        keys: gids of weather location, data: array
+        Index of the first time step of the single calms for each location.
+    calm_counts : array
+        Number of calms of all locations with each length (index: length),
+        e.g. for plot_histogram(..., binned=True).
+    """
+    n_rows = len(gids)
+    bounds = np.searchsorted(rows, np.arange(n_rows + 1))
+    counts = np.diff(bounds)
+    maximum = np.zeros(n_rows, dtype=int)
+    np.maximum.at(maximum, rows, lengths)
+    minimum = np.full(n_rows, np.iinfo(int).max, dtype=int)
+    np.minimum.at(minimum, rows, lengths)
+    minimum[counts == 0] = 0
+    calm_lengths, calm_starts = {}, {}
+    for i, key in enumerate(gids):
+        if counts[i] == 0:
+            calm_lengths[key] = np.array([0])
+        else:
+            calm_lengths[key] = lengths[bounds[i]:bounds[i + 1]]
+        calm_starts[key] = starts[bounds[i]:bounds[i + 1]]
+    calms_max = pd.DataFrame(data=maximum, index=gids, columns=['results'])
+    calms_min = pd.DataFrame(data=minimum, index=gids, columns=['results'])
+    calm_counts = np.bincount(lengths)
+    return calms_max, calms_min, calm_lengths, calm_starts, calm_counts
+
+
+def calculate_calms_matrix(feedin_matrix, power_limit, chunk_size=500):
+    """
+    Finds the calms (feedin < power_limit) of all locations of a FeedinMatrix
+    in batched passes over chunks of chunk_size locations (so a
+    memory-mapped feedin is never loaded completely). See
+    summarise_calm_runs for the returned values.
+    """
+    # Empty arrays, so a FeedinMatrix without gids gives empty results
+    rows, starts, lengths = ([np.array([], dtype=int)] for _ in range(3))
+    for first in range(0, feedin_matrix.values.shape[0], chunk_size):
+        chunk_rows, chunk_starts, chunk_lengths = find_calm_runs(
+            feedin_matrix.values[first:first + chunk_size] < power_limit)
+        rows.append(chunk_rows + first)
+        starts.append(chunk_starts)
+        lengths.append(chunk_lengths)
+    return summarise_calm_runs(np.concatenate(rows), np.concatenate(starts),
+                               np.concatenate(lengths), feedin_matrix.gids)
+
+
+def find_calm_runs_multi(values, power_limits):
+    """
+    Finds the calms of a 2-D feedin array (rows: locations, columns: time
+    steps) for several power limits in one pass.
+
+    Every time step gets the number of power limits its feedin reaches, so
+    a time step is a calm for the k-th (sorted) power limit if this level is
+    <= k (calms are nested: a calm below 3% is also a calm below 5%). Only
+    the time steps where the level changes have to be looked at, so the
+    runtime grows with the number of calms and not with the number of power
+    limits times the size of the array.
+
+    Returns
+    -------
+    runs : Dictionary
+        keys: power limits, data: tuple (rows, starts, lengths) as returned by
+        find_calm_runs.
+    """
+    limits = np.unique(power_limits)
+    values = np.asarray(values)
+    if values.ndim == 1:
+        values = values[np.newaxis, :]
+    n_rows, n_steps = values.shape
+    # Pad with a level that is no calm for any power limit
+    levels = np.full((n_rows, n_steps + 2), len(limits), dtype=np.int16)
+    levels[:, 1:-1] = np.searchsorted(limits, values, side='right')
+    levels = levels.ravel()
+    changes = np.flatnonzero(levels[1:] != levels[:-1]) + 1
+    before = levels[changes - 1]
+    after = levels[changes]
+    low = np.minimum(before, after)
+    counts = np.abs(after - before)
+    rows, columns = np.divmod(changes, n_steps + 2)
+    columns -= 1
+    # Expand every level change into the power limits it crosses and group
+    # them by power limit (stable, so the order of time steps is kept)
+    position = np.repeat(np.arange(changes.size), counts)
+    offsets = np.cumsum(counts) - counts
+    crossed = (low[position] + np.arange(position.size) -
+               np.repeat(offsets, counts)).astype(np.int16)
+    order = np.argsort(crossed, kind='stable')
+    position = position[order]
+    bounds = np.searchsorted(crossed[order], np.arange(len(limits) + 1))
+    is_start = (after < before)[position]
+    runs = {}
+    for k, limit in enumerate(limits):
+        crossing = position[bounds[k]:bounds[k + 1]]
+        start = is_start[bounds[k]:bounds[k + 1]]
+        start_positions = crossing[start]
+        runs[limit] = (rows[start_positions], columns[start_positions],
+                       columns[crossing[~start]] - columns[start_positions])
+    return runs
+
+
+def calculate_calms_multi(feedin_matrix, power_limits, chunk_size=500):
+    """
+    Finds the calms of all locations of a FeedinMatrix for all power limits
+    in one pass over chunks of chunk_size locations (so a memory-mapped
+    feedin is never loaded completely).
+
+    Returns
+    -------
+    calms : Dictionary
+        keys: power limits, data: tuple (calms_max, calms_min, calm_lengths,
+        calm_starts, calm_counts) as returned by calculate_calms_matrix.
+    """
+    limits = np.unique(power_limits)
+    runs = {limit: ([], [], []) for limit in limits}
+    for first in range(0, feedin_matrix.values.shape[0], chunk_size):
+        chunk_runs = find_calm_runs_multi(
+            feedin_matrix.values[first:first + chunk_size], limits)
+        for limit, (rows, starts, lengths) in chunk_runs.items():
+            runs[limit][0].append(rows + first)
+            runs[limit][1].append(starts)
+            runs[limit][2].append(lengths)
+    return {limit: summarise_calm_runs(
+                np.concatenate(rows or [np.array([], dtype=int)]),
+                np.concatenate(starts or [np.array([], dtype=int)]),
+                np.concatenate(lengths or [np.array([], dtype=int)]),
+                feedin_matrix.gids)
+            for limit, (rows, starts, lengths) in runs.items()}
+
+
+def create_calm_mask(power_limit, feedin_matrix, chunk_size=500):
+    """
+    Creates the CalmMask (feedin < power_limit) of all locations of a
+    FeedinMatrix. The feedin is read in chunks of chunk_size locations.
+    """
+    n_rows, n_steps = feedin_matrix.values.shape
+    bits = np.empty((n_rows, (n_steps + 7) // 8), dtype=np.uint8)
+    for first in range(0, n_rows, chunk_size):
+        rows = slice(first, first + chunk_size)
+        bits[rows] = np.packbits(
+            np.asarray(feedin_matrix.values[rows]) < power_limit, axis=1)
+    return CalmMask(bits=bits, gids=np.array(feedin_matrix.gids))
+
+
+def check_calm_mask(calm_mask, feedin_matrix):
+    """
+    Raises a ValueError if the rows of the CalmMask are not the locations of
+    the FeedinMatrix (e.g. a cached mask of another feedin) or the mask has
+    less time steps.
+    """
+    if not np.array_equal(np.asarray(calm_mask.gids),
+                          np.asarray(feedin_matrix.gids)):
+        raise ValueError('The gids of the calm mask do not match the gids '
+                         'of the feedin matrix')
+    if calm_mask.bits.shape[1] * 8 < feedin_matrix.values.shape[1]:
+        raise ValueError('The calm mask has less time steps than the feedin '
+                         'matrix')
+
+
+def unpack_calm_mask(calm_mask, n_steps, rows=None):
+    """
+    Unpacks (the given rows of) a CalmMask to a 2-D boolean array with
+    n_steps columns.
+    """
+    bits = calm_mask.bits
+    if rows is not None:
+        bits = bits[rows]
+    return np.unpackbits(bits, axis=1)[:, :n_steps].astype(bool)
+
+
+def calm_mask_of_gid(calm_mask, feedin_matrix, gid):
+    """
+    Returns the calms of one location as boolean Series (index: time index of
+    the FeedinMatrix).
+    """
+    check_calm_mask(calm_mask, feedin_matrix)
+    row = np.flatnonzero(feedin_matrix.gids == gid)
+    return pd.Series(unpack_calm_mask(calm_mask, len(feedin_matrix.index),
+                                      rows=row)[0],
+                     index=feedin_matrix.index)
+
+
+def calm_mask_from_dict(calms_dict):
+    """
+    Converts a dictionary as created by create_calms_dict or filter_peaks to
+    a CalmMask (rows in the order of the keys of calms_dict).
+    """
+    return CalmMask(
+        bits=np.packbits(np.vstack(
+            [np.asarray(calms_dict[key]['calm'] != 'no_calm')
+             for key in calms_dict]), axis=1),
+        gids=np.array(list(calms_dict)))
+
+
+def calms_dict_from_mask(calm_mask, feedin_matrix, gids=None):
+    """
+    Creates the DataFrames of create_calms_dict (columns 'feedin_wind_pp' and
+    'calm') from a CalmMask for the given gids (default: all gids).
+    Only needed for code that still works on the dictionaries.
+    """
+    check_calm_mask(calm_mask, feedin_matrix)
+    if gids is None:
+        gids = feedin_matrix.gids
+    calms_dict = {}
+    for key in gids:
+        row = np.flatnonzero(feedin_matrix.gids == key)[0]
+        feedin = feedin_matrix.values[row]
+        calms = unpack_calm_mask(calm_mask, feedin.size, rows=[row])[0]
+        calms_dict[key] = pd.DataFrame(
+            data={'feedin_wind_pp': feedin,
+                  'calm': np.where(calms, feedin.astype(object), 'no_calm')},
+            index=feedin_matrix.index, columns=['feedin_wind_pp', 'calm'])
+    return calms_dict
+
+
+def calculate_calms_mask(calm_mask, feedin_matrix, chunk_size=500):
+    """
+    Finds the calms of a CalmMask of the FeedinMatrix. The mask is unpacked
+    in chunks of chunk_size locations. See summarise_calm_runs for the
+    returned values.
+    """
+    check_calm_mask(calm_mask, feedin_matrix)
+    n_steps = feedin_matrix.values.shape[1]
+    rows, starts, lengths = ([np.array([], dtype=int)] for _ in range(3))
+    for first in range(0, len(calm_mask.gids), chunk_size):
+        chunk = unpack_calm_mask(calm_mask, n_steps,
+                                 rows=slice(first, first + chunk_size))
+        chunk_rows, chunk_starts, chunk_lengths = find_calm_runs(chunk)
+        rows.append(chunk_rows + first)
+        starts.append(chunk_starts)
+        lengths.append(chunk_lengths)
+    return summarise_calm_runs(np.concatenate(rows), np.concatenate(starts),
+                               np.concatenate(lengths), feedin_matrix.gids)
+
+
+def calculate_calms(calms_dict, feedin_matrix=None):
     """
     Returns the calm lengths of all the calms at each location and finds the
     longest and shortest calm from all the calms at each location.
@@ -102,25 +1088,49 @@ def calculate_calms(calms_dict):
     calm_lengths : Dictionary
         keys: gids of weather location, data: array
         Length of the single calms for each location.
+
+    If feedin_matrix is given, calms_dict is the packed calm mask of it (see
+    create_calms_dict) and the calms are found chunk-wise.
     """
-    calms_max, calms_min, calm_lengths = {}, {}, {}
-    for key in calms_dict:
-        df = calms_dict[key]
-        # Find calm periods
-        calms, = np.where(df['calm'] != 'no_calm')
-        calm_arrays = np.split(calms, np.where(np.diff(calms) != 1)[0] + 1)
-        # Write the calm lengths into array of dictionary calm_lengths
-        calm_lengths[key] = np.array([len(calm_arrays[i])
-                                      for i in range(len(calm_arrays))])
-        # Find the longest and shortest calm from all periods
-        maximum = max(calm_lengths[key])
-        calms_max[key] = maximum
-        minimum = min(calm_lengths[key])
-        calms_min[key] = minimum
-    # Create DataFrame
-    calms_max = pd.DataFrame(data=calms_max, index=['results']).transpose()
-    calms_min = pd.DataFrame(data=calms_min, index=['results']).transpose()
-    return calms_max, calms_min, calm_lengths
+    if feedin_matrix is not None:
+        return calculate_calms_mask(calms_dict, feedin_matrix)[:3]
+    gids = list(calms_dict.keys())
+    if not gids:
+        calm_mask = np.zeros((0, 0), dtype=bool)
+    else:
+        calm_mask = np.vstack([
+            np.asarray(calms_dict[key]['calm'] != 'no_calm') for key in gids])
+    rows, starts, lengths = find_calm_runs(calm_mask)
+    return summarise_calm_runs(rows, starts, lengths, gids)[:3]
+
+
+def calms_frequency_table(calm_lengths, min_lengths):
+    """
+    Finds the frequency of calms with length >= min_length for each location
+    and each of min_lengths in one pass (sorted calm lengths and one
+    searchsorted for all locations and minimum lengths), e.g. for exceedance
+    curves with many durations.
+
+    Returns
+    -------
+    calms_freq : DataFrame
+        indices: gids of location, columns: min_lengths.
+    """
+    gids = list(calm_lengths.keys())
+    min_lengths = np.asarray(min_lengths, dtype=float)
+    sizes = np.array([np.size(calm_lengths[key]) for key in gids], dtype=int)
+    rows = np.repeat(np.arange(len(gids)), sizes)
+    lengths = np.concatenate([np.array([], dtype=int)] +
+                             [np.ravel(calm_lengths[key]) for key in gids])
+    # Sort by location and length with one key per calm
+    thresholds = np.ceil(min_lengths).astype(np.int64)
+    width = max(lengths.max(initial=0), thresholds.max(initial=0)) + 1
+    keys = np.sort(rows * width + lengths.astype(np.int64))
+    queries = (np.arange(len(gids))[:, np.newaxis] * width +
+               np.clip(thresholds, 0, None)[np.newaxis, :])
+    ends = np.cumsum(sizes)[:, np.newaxis]
+    calms_freq = ends - np.searchsorted(keys, queries, side='left')
+    return pd.DataFrame(data=calms_freq, index=gids, columns=min_lengths)
 
 
 def calms_frequency(calm_lengths, min_length):
@@ -128,96 +1138,166 @@ def calms_frequency(calm_lengths, min_length):
     Finds the frequency of calms with length >= min_length for each
     location.
     """
-    calms_freq = {}
-    for key in calm_lengths:
-        calms_freq[key] = np.compress((calm_lengths[key] >= min_length),
-                                      calm_lengths[key]).size
-    calms_freq = pd.DataFrame(data=calms_freq, index=['results']).transpose()
-    return calms_freq
-
-
-def filter_peaks(calms_dict, power_limit):
-    """
-    Filteres the peaks from the calms using a running average.
-    """
-    # TODO: Could be run a second time with the camls_dict_filtered to filter possilble peaks again
-    calms_dict_filtered = copy.deepcopy(calms_dict)
-    for key in calms_dict_filtered:
-        df = calms_dict_filtered[key]
-        # Find calm periods
-        calms, = np.where(df['calm'] != 'no_calm')
-        calm_arrays = np.split(calms, np.where(np.diff(calms) != 1)[0] + 1)
-        # Filter out peaks
-        feedin_arr = np.array(df['feedin_wind_pp'])
-        calm_arr = np.array(df['calm'])
-        i = 0
-        while i <= (len(calm_arrays) - 1):
-            j = i + 1
-            if j > (len(calm_arrays) - 1):
-                break
-            while (sum(feedin_arr[calm_arrays[i][0]:calm_arrays[j][-1] + 1]) /
-                   len(feedin_arr[calm_arrays[i][0]:calm_arrays[j][-1] + 1])
-                   < power_limit):
-                j = j + 1
-                if j > (len(calm_arrays) - 1):
-                    break
-            calm_arr[calm_arrays[i][0]:calm_arrays[j-1][-1] + 1] = feedin_arr[
-                calm_arrays[i][0]:calm_arrays[j-1][-1] + 1]
-            i = j
-        df2 = pd.DataFrame(data=calm_arr, columns=['calm2'], index=df.index)
-        df_final = pd.concat([df, df2], axis=1)
-        df_final = df_final.drop('calm', axis=1)
-        df_final.columns = ['feedin_wind_pp', 'calm']
-        calms_dict_filtered[key] = df_final
+    calms_freq = calms_frequency_table(calm_lengths, [min_length])
+    return pd.DataFrame(data=calms_freq.values, index=calms_freq.index,
+                        columns=['results'])
+
+
+def _merge_calms(values, calms, power_limit):
+    """
+    One filter pass of filter_calms over all rows at once.
+    """
+    n_rows, n_steps = calms.shape
+    rows, starts, lengths = find_calm_runs(calms)
+    ends = starts + lengths
+    # Cumulative sums of all rows in one flat array (with leading zero)
+    cumulated = np.zeros((n_rows, n_steps + 1))
+    np.cumsum(values, axis=1, out=cumulated[:, 1:])
+    cumulated = cumulated.ravel()
+    start_pos = rows * (n_steps + 1) + starts
+    end_pos = rows * (n_steps + 1) + ends
+    # Index of the first and behind the last calm of each row
+    bounds = np.searchsorted(rows, np.arange(n_rows + 1))
+    i, last = bounds[:-1].copy(), bounds[1:]
+    j = i + 1
+    active = np.flatnonzero(i < last - 1)
+    merged_starts, merged_ends = [], []
+    # Advance all rows in lockstep: extend the chain of calms starting at i
+    # to calm j as long as the average feedin stays below the power limit
+    while active.size:
+        ia, ja = i[active], j[active]
+        extend = ((cumulated[end_pos[ja]] - cumulated[start_pos[ia]]) /
+                  (ends[ja] - starts[ia]) < power_limit)
+        j[active[extend]] += 1
+        done = active[~extend | (j[active] >= last[active])]
+        merged_starts.append(start_pos[i[done]])
+        merged_ends.append(end_pos[j[done] - 1])
+        i[done] = j[done]
+        j[done] = i[done] + 1
+        active = active[i[active] < last[active] - 1]
+    # Mark the merged chains as calm
+    marks = np.zeros(n_rows * (n_steps + 1) + 1, dtype=np.int32)
+    if merged_starts:
+        np.add.at(marks, np.concatenate(merged_starts), 1)
+        np.add.at(marks, np.concatenate(merged_ends), -1)
+    merged = np.cumsum(marks)[:-1].reshape(n_rows, n_steps + 1)[:, :-1] > 0
+    return calms | merged
+
+
+def filter_calms(values, calms, power_limit, passes=1):
+    """
+    Filteres the peaks from the calms (2-D boolean array, rows: locations,
+    columns: time steps) of all locations at once using a running average:
+    consecutive calms are merged as long as the average feedin from the
+    start of the first to the end of the last calm stays below power_limit.
+
+    The averages are taken from cumulative sums and all locations are
+    processed together. The filter is run `passes` times on its own output;
+    with passes=None it is repeated until the calms do not change anymore.
+    """
+    values = np.asarray(values, dtype=float)
+    calms = np.asarray(calms, dtype=bool)
+    if calms.ndim == 1:
+        return filter_calms(values[np.newaxis, :], calms[np.newaxis, :],
+                            power_limit, passes)[0]
+    calms_filtered = calms.copy()
+    # Only rows that changed in the last pass have to be filtered again
+    rows = np.arange(calms.shape[0])
+    n_pass = 0
+    while rows.size and (passes is None or n_pass < passes):
+        merged = _merge_calms(values[rows], calms_filtered[rows], power_limit)
+        changed = (merged != calms_filtered[rows]).any(axis=1)
+        calms_filtered[rows] = merged
+        rows = rows[changed]
+        n_pass += 1
+    return calms_filtered
+
+
+def filter_calm_mask(feedin_matrix, calm_mask, power_limit, passes=1,
+                     chunk_size=500):
+    """
+    Filteres the peaks from a CalmMask of all locations of a FeedinMatrix
+    (see filter_calms) in chunks of chunk_size locations and returns the
+    filtered CalmMask.
+    """
+    check_calm_mask(calm_mask, feedin_matrix)
+    n_steps = feedin_matrix.values.shape[1]
+    bits = np.empty_like(calm_mask.bits)
+    for first in range(0, len(calm_mask.gids), chunk_size):
+        rows = slice(first, first + chunk_size)
+        bits[rows] = np.packbits(filter_calms(
+            feedin_matrix.values[rows],
+            unpack_calm_mask(calm_mask, n_steps, rows=rows),
+            power_limit, passes), axis=1)
+    return CalmMask(bits=bits, gids=calm_mask.gids)
+
+
+def filter_peaks(calms_dict, power_limit, passes=1):
+    """
+    Filteres the peaks from the calms using a running average (see
+    filter_calms). Set passes=None to filter until no more peaks are found.
+    """
+    if not calms_dict:
+        return {}
+    feedin_arr = np.vstack([np.asarray(calms_dict[key]['feedin_wind_pp'],
+                                       dtype=float) for key in calms_dict])
+    calms = filter_calms(
+        feedin_arr, np.vstack([np.asarray(calms_dict[key]['calm'] != 'no_calm')
+                               for key in calms_dict]),
+        power_limit, passes)
+    calms_dict_filtered = {}
+    for row, key in enumerate(calms_dict):
+        df = calms_dict[key]
+        calms_dict_filtered[key] = pd.DataFrame(
+            data={'feedin_wind_pp': df['feedin_wind_pp'],
+                  'calm': np.where(calms[row], feedin_arr[row].astype(object),
+                                   'no_calm')},
+            index=df.index, columns=['feedin_wind_pp', 'calm'])
     return calms_dict_filtered
 
 
+def germany_geometries(conn, cache_folder='cache'):
+    """
+    Returns the German regions (deutschland.deu3_21) from the cache or the
+    database, or the outline of the bundled shapefile if neither is available
+    (conn=None).
+    """
+    key = cache_key(**GERMANY_REGIONS)
+    if (conn is None and key not in _geometries and not os.path.exists(
+            cache_path('geometries', GERMANY_REGIONS, cache_folder))):
+        return pd.DataFrame({'geom': read_shapefile()})
+    return get_geometries(conn, cache_folder, **GERMANY_REGIONS)
+
+
 def coastdat_geoplot(results_df, conn, show_plot=True, legend_label=None,
                      save_figure=True, save_folder='Plots',
                      cmapname='inferno_r', scale_parameter=None,
-                     filename_plot='plot.png'):
+                     filename_plot='plot.png', cache_folder='cache'):
     """
     results_df should have the coastdat region gid as index and the values
     that are plotted (average wind speed, calm length, etc.) in the column
     'results'
+    The geometries are cached (see get_geometries), so conn may be None once
+    they have been fetched.
     """
+    import geoplot
     fig = plt.figure()
     # plot coastdat cells with results
-    coastdat_de = {
-        'table': 'de_grid',
-        'geo_col': 'geom',
-        'id_col': 'gid',
-        'schema': 'coastdat',
-        'simp_tolerance': '0.01',
-        'where_col': 'gid',
-        'where_cond': '> 0'
-    }
-    coastdat_de = fetch_geometries(conn, **coastdat_de)
-    coastdat_de['geom'] = geoplot.postgis2shapely(coastdat_de.geom)
+    coastdat_de = get_geometries(conn, cache_folder, **COASTDAT_DE)
     coastdat_de = coastdat_de.set_index('gid')  # set gid as index
     coastdat_de = coastdat_de.join(results_df)  # join results
     # scale results
-    if not scale_parameter:
-        scale_parameter = max(coastdat_de['results'].dropna())
+    scale_parameter = _geoplot_scale(coastdat_de['results'], scale_parameter)
     coastdat_de['results_scaled'] = coastdat_de['results'] / scale_parameter
     coastdat_plot = geoplot.GeoPlotter(
         geom=coastdat_de['geom'], bbox=(3, 16, 47, 56),
         data=coastdat_de['results_scaled'], color='data', cmapname=cmapname)
     coastdat_plot.plot(edgecolor='')
     coastdat_plot.draw_legend(legendlabel=legend_label,
-        interval=(0, int(scale_parameter)), integer=True)
+        interval=(0, scale_parameter), integer=True)
 
     # plot Germany with regions
-    germany = {
-        'table': 'deu3_21',
-        'geo_col': 'geom',
-        'id_col': 'region_id',
-        'schema': 'deutschland',
-        'simp_tolerance': '0.01',
-        'where_col': 'region_id',
-        'where_cond': '> 0'}
-    germany = fetch_geometries(conn, **germany)
-    germany['geom'] = geoplot.postgis2shapely(germany.geom)
+    germany = germany_geometries(conn, cache_folder)
 
     coastdat_plot.geometries = germany['geom']
     coastdat_plot.plot(facecolor='', edgecolor='white', linewidth=1)
@@ -234,25 +1314,188 @@ def coastdat_geoplot(results_df, conn, show_plot=True, legend_label=None,
     return
 
 
+def _geoplot_scale(results, scale_parameter=None):
+    """
+    Returns the value that is shown with the highest color of a geoplot:
+    scale_parameter or the maximum of results (1 if there are no results
+    above 0, e.g. a map without calms).
+    """
+    if scale_parameter:
+        return float(scale_parameter)
+    maximum = np.nanmax(np.asarray(results, dtype=float), initial=-np.inf)
+    return float(maximum) if maximum > 0 else 1.0
+
+
+def _new_artists(ax, fig, draw):
+    """
+    Calls draw() and returns the collections it added to ax and the axes it
+    added to fig.
+    """
+    collections, axes = list(ax.collections), list(fig.axes)
+    draw()
+    return ([collection for collection in ax.collections
+             if collection not in collections],
+            [new_ax for new_ax in fig.axes if new_ax not in axes])
+
+
+def _cell_patches(ax, fig, plotter, geometries):
+    """
+    Draws each geometry once with the GeoPlotter plotter (so its projection
+    is used), removes the drawn artists again and returns their shapes as
+    patches and the position in geometries of each patch.
+    """
+    data = plotter.data
+    patches, rows = [], []
+    for row, geometry in enumerate(geometries):
+        plotter.geometries = [geometry]
+        plotter.data = data.iloc[[row]]
+        n_patches = len(ax.patches)
+        collections, _ = _new_artists(ax, fig,
+                                      lambda: plotter.plot(edgecolor=''))
+        new_patches = list(ax.patches)[n_patches:]
+        paths = [path for collection in collections
+                 for path in collection.get_paths()]
+        paths += [patch.get_path().transformed(patch.get_patch_transform())
+                  for patch in new_patches]
+        for artist in collections + new_patches:
+            artist.remove()
+        patches.extend(PathPatch(path) for path in paths)
+        rows.extend([row] * len(paths))
+    plotter.geometries, plotter.data = geometries, data
+    return patches, np.array(rows, dtype=int)
+
+
+def coastdat_geoplot_batch(results, conn, legend_labels=None, filenames=None,
+                           save_folder='Plots', cmapname='inferno_r',
+                           scale_parameter=None, cache_folder='cache'):
+    """
+    Plots many results on the coastdat grid and saves them as
+    coastdat_geoplot does (same GeoPlotter projection, legend and outline of
+    Germany). Figure, projected cells and the outline of Germany are created
+    once; for every map only the colours of the cells are set and the legend
+    is drawn again.
+
+    results should have the coastdat region gid as index and one column for
+    each map (average wind speed, calm length, etc.). legend_labels and
+    filenames are dictionaries with the columns as keys (default: column
+    name and '<column>.png'). If scale_parameter is None each map is scaled
+    with its maximum.
+    """
+    import geoplot
+    coastdat_de = get_geometries(conn, cache_folder, **COASTDAT_DE)
+    coastdat_de = coastdat_de.set_index('gid')
+    fig = plt.figure()
+    coastdat_plot = geoplot.GeoPlotter(
+        geom=coastdat_de['geom'], bbox=(3, 16, 47, 56),
+        data=pd.Series(0.0, index=coastdat_de.index), color='data',
+        cmapname=cmapname)
+    ax = plt.gca()
+    # cells (one collection, coloured by set_array for each map)
+    patches, rows = _cell_patches(ax, fig, coastdat_plot, coastdat_de['geom'])
+    cells = PatchCollection(patches, cmap=plt.get_cmap(cmapname),
+                            edgecolor='none')
+    cells.set_clim(0, 1)
+    ax.add_collection(cells, autolim=False)
+    # plot Germany with regions (once, above the cells)
+    coastdat_plot.geometries = germany_geometries(conn, cache_folder)['geom']
+    outline, _ = _new_artists(ax, fig, lambda: coastdat_plot.plot(
+        facecolor='', edgecolor='white', linewidth=1))
+    if outline:
+        cells.set_zorder(min(collection.get_zorder()
+                             for collection in outline) - 1)
+    plt.tight_layout()
+    plt.box(on=None)
+    legend = []
+    for column in results.columns:
+        values = coastdat_de.join(results[[column]])[column].values
+        scale = _geoplot_scale(values, scale_parameter)
+        cells.set_array(np.ma.masked_invalid(
+            np.asarray(values, dtype=float)[rows] / scale))
+        for artist in legend:
+            artist.remove()
+        plt.sca(ax)
+        label = (legend_labels or {}).get(column, column)
+        _, legend = _new_artists(ax, fig, lambda: coastdat_plot.draw_legend(
+            legendlabel=label, interval=(0, scale), integer=True))
+        filename_plot = (filenames or {}).get(column,
+                                              '{0}.png'.format(column))
+        fig.savefig(os.path.abspath(os.path.join(
+            os.path.dirname(__file__), '..', save_folder, filename_plot)))
+    plt.close(fig)
+
+
+def _init_plot_worker():
+    plt.switch_backend('Agg')
+
+
+def _run_plot_job(job):
+    function, args, kwargs = job
+    try:
+        function(*args, **kwargs)
+    except Exception:
+        return traceback.format_exc()
+
+
+def run_plot_jobs(jobs, processes=None):
+    """
+    Runs plot jobs (tuples (function, args, kwargs), e.g.
+    coastdat_geoplot_batch or plot_histogram with show_plot=False) in a
+    process pool with the non-interactive Agg backend. A failing job does not
+    stop the other jobs; the failures are printed and returned as list of
+    (job, traceback). Each job is submitted on its own, so a job that can
+    not be sent to the workers (e.g. with a database connection) only fails
+    itself.
+    Jobs must not contain a database connection, so fetch the geometries
+    (get_geometries) before and pass conn=None.
+    """
+    errors = []
+    with multiprocessing.Pool(processes,
+                              initializer=_init_plot_worker) as pool:
+        pending = [pool.apply_async(_run_plot_job, (job,)) for job in jobs]
+        for result in pending:
+            try:
+                errors.append(result.get())
+            except Exception:
+                errors.append(traceback.format_exc())
+    failures = [(job, error) for job, error in zip(jobs, errors) if error]
+    for job, error in failures:
+        print('Plot job {0} failed:'.format(job[0].__name__))
+        print(error)
+    return failures
+
+
 def plot_histogram(calms, show_plot=True, legend_label=None, x_label=None,
                    y_label=None, save_folder='Plots', save_figure=True,
                    y_limit=None, x_limit=None, bin_width=50, tick_freq=100,
-                   filename_plot='plot_histogram.png'):
+                   filename_plot='plot_histogram.png', binned=False):
     """
     calms should have the coastdat region gid as index and the values
     that are plotted in the column 'results'.
     Histogram contains longest calms of each location.
+    With binned=True calms is an array with the number of calms of each
+    length (index: length, e.g. calm_counts of calculate_calms_matrix), so
+    the single calms never have to be collected.
     """
-    # sort calms
-    calms_sorted = np.sort(np.array(calms['results']))
+    if binned:
+        counts = np.asarray(calms)
+        lengths = np.arange(counts.size)
+    else:
+        lengths = np.array(calms['results'])
+        counts = None
     # plot
     fig = plt.figure()
     if x_limit:
         x_max = x_limit
+    elif binned:
+        nonzero = np.flatnonzero(counts)
+        x_max = nonzero[-1] if nonzero.size else 0
     else:
-        x_max = max(calms_sorted)
-    plt.hist(calms_sorted, bins=np.arange(0, x_max + 1, bin_width),
-             normed=False)
+        x_max = max(lengths) if len(lengths) else 0
+    if not x_max:
+        # No calms: one empty bin
+        x_max = bin_width
+    plt.hist(lengths, bins=np.arange(0, x_max + 1, bin_width),
+             weights=counts)
     plt.xlabel(x_label)
     plt.ylabel(y_label)
     plt.xticks(np.arange(0, x_max + 1, tick_freq))
@@ -300,8 +1543,11 @@ def plot_histogram(calms, show_plot=True, legend_label=None, x_label=None,
 
 if __name__ == "__main__":
 
+    import geoplot
+    from data_backends import data_backend
     year = 2011
-    conn = db.connection(section='reiner')
+    # 'postgis', 'local' or 'synthetic' (see data_backends)
+    conn = data_backend('postgis', section='reiner')
     legend_label = 'Average wind speed'
     pickle_load = False
     # get geometry for Germany
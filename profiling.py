@@ -0,0 +1,185 @@
+"""
+Timing, memory and count instrumentation of the stages of an evaluation.
+
+    profiler = StageProfiler(year=2011)
+    with profiler.stage('calms'):
+        ...
+        profiler.count(cells=n_cells, hours=n_hours, calms=n_calms)
+    profiler.write_report('reports')
+
+Each stage records its wall and cpu time, the resident memory of the
+process at its start and end and the peak sampled in between (memory of
+worker processes is not included), and the counts given with count. With
+profile=True each stage is also run under cProfile and the statistics are
+dumped to profile_folder (nested stages are covered by the outer profile).
+"""
+import cProfile
+import datetime
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+
+def _rss():
+    """
+    Returns the resident memory of the process in bytes (peak resident
+    memory if /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        if sys.platform.startswith('linux'):
+            maxrss *= 1024
+        return maxrss
+
+
+class StageProfiler(object):
+    """
+    Records the stages of a run (see module docstring). run_info (e.g. year,
+    energy source) is stored with the report.
+    """
+
+    def __init__(self, profile=False, profile_folder='profiles',
+                 interval=0.05, **run_info):
+        self.profile = profile
+        self.profile_folder = profile_folder
+        self.interval = interval
+        self.run_info = dict(
+            run_info, started=datetime.datetime.now().isoformat(),
+            host=socket.gethostname())
+        self.records = []
+        self._active = []
+        self._profiling = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = _rss()
+            with self._lock:
+                for record in self._active:
+                    record['peak_rss'] = max(record['peak_rss'], rss)
+
+    def _start_sampler(self):
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample)
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def close(self):
+        """
+        Stops the memory sampling.
+        """
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+            self._stop.clear()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        Context manager recording the stage name; counts (e.g. cells=...)
+        can be given here or with count inside the stage.
+        """
+        self._start_sampler()
+        rss = _rss()
+        record = {'stage': name,
+                  'start': datetime.datetime.now().isoformat(),
+                  'rss_start': rss, 'peak_rss': rss, 'counts': dict(counts)}
+        with self._lock:
+            self._active.append(record)
+        profiler = None
+        if self.profile and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+        wall_time, cpu_time = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            record['wall_time'] = time.perf_counter() - wall_time
+            record['cpu_time'] = time.process_time() - cpu_time
+            record['rss_end'] = _rss()
+            with self._lock:
+                self._active.remove(record)
+                record['peak_rss'] = max(record['peak_rss'],
+                                         record['rss_end'])
+            if profiler is not None:
+                if not os.path.isdir(self.profile_folder):
+                    os.makedirs(self.profile_folder)
+                record['profile'] = os.path.join(
+                    self.profile_folder, '{0}_{1}.prof'.format(
+                        name, len(self.records)))
+                profiler.dump_stats(record['profile'])
+            self.records.append(record)
+
+    def count(self, **counts):
+        """
+        Adds counts (e.g. cells=..., hours=..., calms=...) to the innermost
+        running stage.
+        """
+        record = self._active[-1]
+        for key, value in counts.items():
+            record['counts'][key] = record['counts'].get(key, 0) + value
+
+    def report(self):
+        """
+        Returns the recorded stages as DataFrame (one row per stage, counts
+        as columns, throughput in cell-hours per second if cells and hours
+        were counted).
+        """
+        rows = []
+        for record in self.records:
+            row = {key: value for key, value in record.items()
+                   if key != 'counts'}
+            row.update(record['counts'])
+            rows.append(row)
+        report = pd.DataFrame(rows)
+        if 'cells' in report and 'hours' in report:
+            report['cell_hours_per_s'] = (report['cells'] * report['hours'] /
+                                          report['wall_time'])
+        return report
+
+    def write_report(self, folder='reports', csv_name='stages.csv'):
+        """
+        Writes the run as JSON (run information and stages, one file per
+        run) and appends its stages to the CSV file csv_name in folder, so
+        runs can be compared over time.
+
+        Returns
+        -------
+        filenames : tuple
+            Paths of the JSON and the CSV file.
+        """
+        self.close()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        json_name = os.path.join(folder, 'run_{0}.json'.format(
+            self.run_info['started'].replace(':', '-')))
+        with open(json_name, 'w') as f:
+            json.dump({'run': self.run_info, 'stages': self.records}, f,
+                      indent=2, default=str)
+        report = self.report()
+        for key, value in self.run_info.items():
+            report.insert(0, key, str(value))
+        csv_name = os.path.join(folder, csv_name)
+        if os.path.exists(csv_name):
+            report = pd.concat([pd.read_csv(csv_name), report],
+                               ignore_index=True, sort=False)
+        report.to_csv(csv_name, index=False)
+        return json_name, csv_name
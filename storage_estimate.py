@@ -0,0 +1,208 @@
+"""
+Fast estimation of the storage size needed at each location from its wind
+and pv feedin and the demand with the sequent-peak algorithm, vectorized
+over all locations and without an LP solve (see storage_invest for the
+optimisation of single locations and validate_estimate for a comparison).
+
+The energy system is the one of storage_invest.create_energysystem: wind and
+pv feedin and the grid import (limited to grid_share of the consumption per
+year) supply the demand, the storage covers the remaining deficits and is
+charged with the surplus feedin.
+"""
+import os
+import numpy as np
+import pandas as pd
+from get_from_db import FeedinMatrix, common_rows, find_calm_runs
+
+# Parameters of storage_invest.create_energysystem
+CONSUMPTION = 5165 * 1e6
+WIND_INSTALLED = 1516 * 1e3
+PV_INSTALLED = 1491 * 1e3
+GRID_SHARE = 0.75
+INFLOW_CONVERSION_FACTOR = 1
+OUTFLOW_CONVERSION_FACTOR = 0.8
+
+
+def read_demand(filename="storage_invest.csv"):
+    """
+    Returns the normalised electricity demand (sum 1) of the data file (in
+    the folder of this module).
+    """
+    full_filename = os.path.join(os.path.dirname(__file__), filename)
+    data = pd.read_csv(full_filename, sep=",")
+    return data['demand_el']/data['demand_el'].sum()
+
+
+def grid_level(deficit, grid_energy):
+    """
+    Returns the level of each row of deficit (array, rows: locations,
+    columns: time steps) up to which the grid import covers the deficit,
+    so that the import (sum of min(deficit, level)) equals grid_energy
+    (inf if grid_energy covers all deficits). The grid import is thereby
+    used for the highest deficits, which minimises the discharge power of
+    the storage.
+    """
+    level = np.full(len(deficit), np.inf)
+    # Only rows with more deficit than grid energy need the sorted deficits
+    short = np.nonzero(deficit.sum(axis=1) > grid_energy)[0]
+    if not len(short):
+        return level
+    deficit = np.sort(deficit[short], axis=1)
+    n_steps = deficit.shape[1]
+    below = np.cumsum(deficit, axis=1)
+    # Import with the level at each sorted deficit
+    imports = below - deficit + deficit * np.arange(n_steps, 0, -1)
+    last = (imports <= grid_energy).sum(axis=1) - 1
+    level[short] = np.where(
+        last >= 0,
+        (grid_energy - below[np.arange(len(short)), np.maximum(last, 0)]) /
+        (n_steps - 1 - np.minimum(last, n_steps - 2)),
+        grid_energy / n_steps)
+    return level
+
+
+def sequent_peak(net_outflow, cyclic=False):
+    """
+    Returns the storage level needed (below full) after each time step for
+    the net outflow of the storage (array, rows: locations, columns: time
+    steps), K_t = max(0, K_t-1 + net_outflow_t), calculated as
+    K_t = S_t - min(0, min(S_0...S_t)) with S the cumulative net outflow.
+    With cyclic=True the time span is repeated once and the levels of the
+    repetition are returned, so deficits at the start can be covered by
+    surpluses at the end.
+    """
+    n_steps = net_outflow.shape[1]
+    if cyclic:
+        net_outflow = np.concatenate([net_outflow, net_outflow], axis=1)
+    cumulative = np.cumsum(net_outflow, axis=1)
+    levels = cumulative - np.minimum(
+        np.minimum.accumulate(cumulative, axis=1), 0)
+    return levels[:, -n_steps:]
+
+
+def estimate_storage(wind_matrix, pv_matrix, data_demand,
+                     wind_installed=WIND_INSTALLED,
+                     pv_installed=PV_INSTALLED, consumption=CONSUMPTION,
+                     grid_share=GRID_SHARE,
+                     inflow_conversion_factor=INFLOW_CONVERSION_FACTOR,
+                     outflow_conversion_factor=OUTFLOW_CONVERSION_FACTOR,
+                     grid_allocation='peak', cyclic=False, chunk_size=100):
+    """
+    Estimates the storage capacity and power needed at each location of the
+    wind and pv feedin (FeedinMatrix per installed capacity, either may be
+    None; the locations are matched by gid, see get_from_db.common_rows) for
+    the normalised demand (sum 1, see read_demand), chunk-wise over the
+    gids.
+
+    The grid import covers the highest deficits (grid_allocation='peak', see
+    grid_level) or grid_share of the demand of each time step
+    (grid_allocation='demand'); the storage capacity is then the maximum
+    level below full of the sequent-peak algorithm (see sequent_peak) and
+    the power the maximum remaining deficit. The sequent-peak algorithm
+    starts with a full storage (the optimisation with an empty one), so
+    use cyclic=True if the time span starts with a calm.
+
+    Returns
+    -------
+    estimate : DataFrame
+        indices: gids, columns: 'energy' (storage capacity), 'power'
+        (maximum discharge power), 'longest_drawdown' (longest time in
+        steps the storage is not full) and 'grid_level' (see grid_level,
+        'peak' allocation only). For a geoplot select a column and rename
+        it to 'results'.
+    """
+    matrices = [(matrix, installed) for matrix, installed in
+                ((wind_matrix, wind_installed), (pv_matrix, pv_installed))
+                if matrix is not None]
+    gids, rows = common_rows([matrix for matrix, _ in matrices])
+    n_rows = len(gids)
+    demand = np.asarray(data_demand, dtype=float) * consumption
+    n_steps = min([len(demand)] + [matrix.values.shape[1]
+                                   for matrix, _ in matrices])
+    demand = demand[:n_steps]
+    grid_energy = grid_share * consumption * n_steps / 8760
+    result = np.full((n_rows, 4), np.nan)
+    for start in range(0, n_rows, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # Feedin minus demand
+        surplus = None
+        for (matrix, installed), matrix_rows in zip(matrices, rows):
+            feedin = np.multiply(matrix.values[matrix_rows[chunk], :n_steps],
+                                 installed, dtype=float)
+            if surplus is None:
+                surplus = feedin
+            else:
+                surplus += feedin
+        surplus -= demand
+        deficit = np.maximum(-surplus, 0)
+        np.maximum(surplus, 0, out=surplus)
+        if grid_allocation == 'peak':
+            level = grid_level(deficit, grid_energy)
+            deficit -= np.minimum(deficit, level[:, np.newaxis])
+            result[chunk, 3] = level
+        elif grid_allocation == 'demand':
+            deficit -= grid_share * demand
+            np.maximum(deficit, 0, out=deficit)
+        else:
+            raise ValueError(
+                'Unknown grid allocation {0}'.format(grid_allocation))
+        # Net outflow of the storage
+        surplus *= -inflow_conversion_factor
+        surplus += deficit / outflow_conversion_factor
+        levels = sequent_peak(surplus, cyclic)
+        result[chunk, 0] = levels.max(axis=1)
+        result[chunk, 1] = deficit.max(axis=1)
+        runs, _, lengths = find_calm_runs(levels > 0)
+        drawdown = np.zeros(len(levels), dtype=int)
+        np.maximum.at(drawdown, runs, lengths)
+        result[chunk, 2] = drawdown
+    return pd.DataFrame(data=result, index=gids,
+                        columns=['energy', 'power', 'longest_drawdown',
+                                 'grid_level'])
+
+
+def validate_estimate(wind_matrix, pv_matrix, data_demand, sample=10,
+                      seed=0, processes=None, solvername='cbc', **kwargs):
+    """
+    Compares estimate_storage (kwargs are passed to it) with the storage
+    capacity optimised with storage_invest (same model as
+    optimise_storage_size, see run_storage_sweep) at sample randomly chosen
+    locations. Needs oemof.solph and the solver.
+
+    Returns
+    -------
+    validation : DataFrame
+        indices: gids, columns: those of estimate_storage, 'storage_cap',
+        'objective' and 'error' of the optimisation (NaN if the optimisation
+        failed or succeeded, respectively; failures are printed) and 'ratio'
+        (energy / storage_cap).
+    """
+    import storage_invest
+    gids, rows = common_rows([wind_matrix, pv_matrix])
+    rng = np.random.RandomState(seed)
+    sample_rows = np.sort(rng.choice(len(gids), min(sample, len(gids)),
+                                     replace=False))
+    wind_matrix, pv_matrix = [
+        FeedinMatrix(values=np.asarray(matrix.values[rows[k][sample_rows]]),
+                     gids=gids[sample_rows], index=matrix.index)
+        for k, matrix in enumerate((wind_matrix, pv_matrix))]
+    estimate = estimate_storage(wind_matrix, pv_matrix, data_demand, **kwargs)
+    n_steps = min(len(data_demand), wind_matrix.values.shape[1])
+    optimised = storage_invest.run_storage_sweep(
+        storage_invest.sweep_cases(wind_matrix, pv_matrix), processes,
+        solvername=solvername, number_timesteps=n_steps,
+        data_demand=np.asarray(data_demand)[:n_steps])
+    # Only 'error' is given if all optimisations failed
+    optimised = optimised.set_index('gid').reindex(
+        columns=['storage_cap', 'objective', 'error'])
+    failed = optimised['error'].notnull()
+    if failed.any():
+        print('Optimisation failed for {0} of {1} locations:'.format(
+            failed.sum(), len(optimised)))
+        for gid, error in optimised.loc[failed, 'error'].items():
+            print('  {0}: {1}'.format(gid, error))
+    validation = estimate.join(optimised)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        validation['ratio'] = (validation['energy'] /
+                               validation['storage_cap'])
+    return validation
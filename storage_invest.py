@@ -41,20 +41,23 @@ from oemof.tools import helpers
 # import oemof base classes to create energy system objects
 import logging
 import os
+import multiprocessing
+import time
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import oemof.solph as solph
-from oemof import db
-from oemof.db import coastdat
+from pyomo.environ import Constraint, NonNegativeReals, Reals, Var, value
+from pyomo.opt import SolverFactory, TerminationCondition
 from shapely import geometry as geopy
 from feedinlib import powerplants as plants
+from data_backends import data_backend
+from get_from_db import common_rows, find_calm_runs
+from storage_estimate import read_demand
+import typical_periods as tp
 
 year = 2014
-
-
-conn = db.connection()
-my_weather = coastdat.get_weather(
-conn, geopy.Point(8.043, 52.279), year)  # Location Osnabrück
+location = geopy.Point(8.043, 52.279)  # Location Osnabrück
 
 #weather data
 
@@ -86,28 +89,47 @@ enerconE126 = {
 E126_power_plant = plants.WindPowerPlant(**enerconE126)
 yingli_module = plants.Photovoltaic(**yingli210)
 
-wind_feedin = E126_power_plant.feedin(weather=my_weather,
-installed_capacity=1)
-pv_feedin = yingli_module.feedin(weather=my_weather, peak_power=1)
+
+def get_feedin(backend=None):
+    """
+    Returns the wind and pv feedin (per installed capacity) at location from
+    the data backend (default: the oemof database, see data_backends).
+    """
+    if backend is None:
+        backend = data_backend('postgis')
+    my_weather = backend.get_weather(location, year)
+    wind_feedin = E126_power_plant.feedin(weather=my_weather,
+                                          installed_capacity=1)
+    pv_feedin = yingli_module.feedin(weather=my_weather, peak_power=1)
+    return wind_feedin, pv_feedin
 
 
 #conn = db.connection()
 #pol = c.next()
 #multi_weather = coastdat.get_weather(conn, germany_u['geom'][0], year)
 
-def optimise_storage_size(filename="storage_invest.csv", solvername='cbc',
-                          debug=True, number_timesteps=8760, tee_switch=True):
+def create_energysystem(wind_feedin, pv_feedin, data_demand,
+                        number_timesteps=8760, year=year,
+                        represented_timesteps=None, timestep_weights=None):
+    """
+    Creates the energy system with the wind and pv feedin (per installed
+    capacity) and the normalised demand. The grid import is limited for
+    represented_timesteps (default: number_timesteps) time steps, e.g. the
+    time span aggregated to typical periods; the variable costs of each time
+    step are multiplied with timestep_weights (e.g. the number of time steps
+    a typical time step represents) if given.
+    """
+    if represented_timesteps is None:
+        represented_timesteps = number_timesteps
+    storage_costs = 10e10
+    if timestep_weights is not None:
+        storage_costs = storage_costs * np.asarray(timestep_weights)
     logging.info('Initialize the energy system')
     date_time_index = pd.date_range('1/1/' + str(year), periods=number_timesteps,
                                     freq='H')
 
     energysystem = solph.EnergySystem(timeindex=date_time_index)
 
-    # Read data file
-    full_filename = os.path.join(os.path.dirname(__file__), filename)
-    data = pd.read_csv(full_filename, sep=",")
-    data_demand = data['demand_el']/data['demand_el'].sum()
-
     ##########################################################################
     # Create oemof object
     ##########################################################################
@@ -128,7 +150,7 @@ def optimise_storage_size(filename="storage_invest.csv", solvername='cbc',
 
     # Create commodity object for import electricity resource
     solph.Source(label='gridsource', outputs={bel: solph.Flow(
-        nominal_value=consumption * grid_share * number_timesteps / 8760,
+        nominal_value=consumption * grid_share * represented_timesteps / 8760,
         summed_max=1)})
 
     # create fixed source object for wind
@@ -154,8 +176,8 @@ def optimise_storage_size(filename="storage_invest.csv", solvername='cbc',
     # create storage transformer object for storage
     solph.Storage(
         label='storage',
-        inputs={bel: solph.Flow(variable_costs=10e10)},
-        outputs={bel: solph.Flow(variable_costs=10e10)},
+        inputs={bel: solph.Flow(variable_costs=storage_costs)},
+        outputs={bel: solph.Flow(variable_costs=storage_costs)},
         capacity_loss=0.00, initial_capacity=0,
         nominal_input_capacity_ratio=1,
         nominal_output_capacity_ratio=1,
@@ -163,6 +185,24 @@ def optimise_storage_size(filename="storage_invest.csv", solvername='cbc',
         fixed_costs=35,
         investment=solph.Investment(ep_costs=epc),
     )
+    return energysystem
+
+
+def optimise_storage_size(filename="storage_invest.csv", solvername='cbc',
+                          debug=True, number_timesteps=8760, tee_switch=True,
+                          backend=None, wind_feedin=None, pv_feedin=None,
+                          data_demand=None):
+    """
+    Optimises the storage size for the wind and pv feedin (per installed
+    capacity, default: feedin at location from backend, see get_feedin) and
+    the normalised demand (default: demand of the data file filename).
+    """
+    if wind_feedin is None or pv_feedin is None:
+        wind_feedin, pv_feedin = get_feedin(backend)
+    if data_demand is None:
+        data_demand = read_demand(filename)
+    energysystem = create_energysystem(wind_feedin, pv_feedin, data_demand,
+                                       number_timesteps)
 
     ##########################################################################
     # Optimise the energy system and plot the results
@@ -184,6 +224,346 @@ def optimise_storage_size(filename="storage_invest.csv", solvername='cbc',
     return energysystem
 
 
+def _link_typical_periods(om, typical_periods):
+    """
+    Adapts the model om of the typical periods one after another to the
+    aggregated time span: the summed_max limits are weighted with the number
+    of represented time steps (the variable costs are weighted in the energy
+    system, see create_energysystem, so om.objective is the model's own cost
+    expression), and the storage is
+    linked across the periods (Kotzur et al. 2018). The capacity of the
+    storage is the level within each typical period (starting at 0) and an
+    inter-period level is tracked for each original period in their order,
+    so storage needs of calms lasting several periods are captured. The
+    initial capacity of solph (which fixes the level at the last time step)
+    is set for the inter-period level instead, as the last typical period
+    (an extreme period, see typical_periods.cluster_periods) need not end
+    empty.
+    """
+    weights = tp.step_weights(typical_periods)
+    n_typical, period_length = typical_periods.profiles.shape[:2]
+    starts = np.arange(n_typical) * period_length
+    order = typical_periods.order
+    steps = range(len(weights))
+    block = om.InvestmentStorage
+    storages = list(block.INVESTSTORAGES)
+
+    # Weighted grid import limits
+    summed_max = list(om.Flow.summed_max.keys())
+    for i, o in summed_max:
+        om.Flow.summed_max[i, o].deactivate()
+    om.weighted_summed_max = Constraint(summed_max, rule=lambda m, i, o: (
+        sum(weights[t] * m.flow[i, o, t] for t in steps) <=
+        m.flows[i, o].summed_max * m.flows[i, o].nominal_value))
+
+    # Storage level within the typical periods, starting at 0 and negative
+    # if the storage is discharged first
+    inflow = {n: list(n.inputs)[0] for n in storages}
+    outflow = {n: list(n.outputs)[0] for n in storages}
+    for n in storages:
+        for t in steps:
+            block.capacity[n, t].domain = Reals
+            block.max_capacity[n, t].deactivate()
+            if hasattr(block, 'min_capacity'):
+                block.min_capacity[n, t].deactivate()
+        for t in starts:
+            block.balance[n, t].deactivate()
+    if hasattr(block, 'initial_capacity'):
+        for n in block.initial_capacity:
+            block.initial_capacity[n].deactivate()
+    om.period_start_balance = Constraint(
+        storages, starts.tolist(), rule=lambda m, n, t: (
+            block.capacity[n, t] ==
+            m.flow[inflow[n], n, t] * n.inflow_conversion_factor[t] -
+            m.flow[n, outflow[n], t] / n.outflow_conversion_factor[t]))
+    om.period_max_capacity = Var(storages, range(n_typical))
+    om.period_min_capacity = Var(storages, range(n_typical))
+    om.period_capacity_bounds = Constraint(
+        storages, steps, [0, 1], rule=lambda m, n, t, bound: (
+            m.period_max_capacity[n, t // period_length] >=
+            block.capacity[n, t] if bound else
+            m.period_min_capacity[n, t // period_length] <=
+            block.capacity[n, t]))
+
+    # Storage level at the start of each original period
+    periods = range(len(order))
+    om.inter_period_capacity = Var(storages, range(len(order) + 1),
+                                   within=NonNegativeReals)
+    om.inter_period_initial = Constraint(storages, rule=lambda m, n: (
+        m.inter_period_capacity[n, 0] ==
+        n.initial_capacity * block.invest[n]))
+    om.inter_period_balance = Constraint(
+        storages, periods, rule=lambda m, n, d: (
+            m.inter_period_capacity[n, d + 1] ==
+            m.inter_period_capacity[n, d] *
+            (1 - n.capacity_loss[0]) ** period_length +
+            block.capacity[n, starts[order[d]] + period_length - 1]))
+    om.inter_period_max = Constraint(storages, periods, rule=lambda m, n, d: (
+        m.inter_period_capacity[n, d] +
+        m.period_max_capacity[n, order[d]] <= block.invest[n]))
+    om.inter_period_min = Constraint(storages, periods, rule=lambda m, n, d: (
+        m.inter_period_capacity[n, d] +
+        m.period_min_capacity[n, order[d]] >= 0))
+
+
+def optimise_storage_size_reduced(
+        filename="storage_invest.csv", solvername='cbc', debug=False,
+        tee_switch=False, backend=None, wind_feedin=None, pv_feedin=None,
+        data_demand=None, n_typical_periods=12, period_length=24,
+        power_limit=0.05, max_extreme_periods=7, seed=0):
+    """
+    Optimises the storage size as optimise_storage_size with the time series
+    aggregated to n_typical_periods typical periods of period_length time
+    steps (days for 24, weeks for 168) plus the periods of the longest calm
+    of wind and pv (feedin < power_limit, at most max_extreme_periods), see
+    typical_periods.cluster_periods. The storage is linked across the
+    periods in their original order (see _link_typical_periods). Raises a
+    RuntimeError if the solve is not optimal.
+
+    Returns
+    -------
+    result : dictionary
+        'storage_cap', 'objective', 'timesteps' (of the reduced model),
+        'wall_time' (build and solve in seconds) and 'typical_periods'.
+    """
+    if wind_feedin is None or pv_feedin is None:
+        wind_feedin, pv_feedin = get_feedin(backend)
+    if data_demand is None:
+        data_demand = read_demand(filename)
+    wall_time = time.perf_counter()
+    wind_feedin, pv_feedin, data_demand = [
+        np.asarray(series, dtype=float)
+        for series in (wind_feedin, pv_feedin, data_demand)]
+    length = min(len(wind_feedin), len(pv_feedin), len(data_demand))
+    series = np.vstack([wind_feedin[:length], pv_feedin[:length],
+                        data_demand[:length]])
+    typical = tp.cluster_periods(
+        series, n_typical_periods, period_length,
+        extreme_periods=tp.calm_periods(
+            series[0] + series[1], period_length, power_limit,
+            max_extreme_periods),
+        seed=seed)
+    profiles = typical.profiles.transpose(2, 0, 1).reshape(len(series), -1)
+    energysystem = create_energysystem(
+        profiles[0], profiles[1], profiles[2], profiles.shape[1],
+        represented_timesteps=len(typical.order) * period_length,
+        timestep_weights=tp.step_weights(typical))
+
+    logging.info('Optimise the energy system with {0} typical periods'.format(
+        len(typical.weights)))
+    om = solph.OperationalModel(energysystem)
+    _link_typical_periods(om, typical)
+
+    if debug:
+        filename = os.path.join(
+            helpers.extend_basic_path('lp_files'),
+            'storage_invest_reduced.lp')
+        logging.info('Store lp-file in {0}.'.format(filename))
+        om.write(filename, io_options={'symbolic_solver_labels': True})
+
+    _check_termination(SolverFactory(solvername).solve(om, tee=tee_switch))
+    storage = energysystem.groups['storage']
+    return {'storage_cap': value(om.InvestmentStorage.invest[storage]),
+            'objective': value(om.objective),
+            'timesteps': profiles.shape[1],
+            'wall_time': time.perf_counter() - wall_time,
+            'typical_periods': typical}
+
+
+def aggregation_error_report(wind_feedin, pv_feedin, data_demand=None,
+                             n_typical_periods=(6, 12, 24),
+                             period_length=24, solvername='cbc',
+                             filename="storage_invest.csv",
+                             power_limit=0.05, **kwargs):
+    """
+    Compares optimise_storage_size_reduced for each number of typical periods
+    with the full-resolution optimisation of the same time series (kwargs
+    are passed to optimise_storage_size_reduced).
+
+    Returns
+    -------
+    report : DataFrame
+        indices: 'full' and the numbers of typical periods, columns:
+        'storage_cap', 'objective', 'timesteps', 'wall_time', the relative
+        errors 'storage_cap_error' and 'objective_error', 'speedup', the root
+        mean square errors of the aggregated time series 'rmse_wind',
+        'rmse_pv', 'rmse_demand' and 'longest_calm' (hours of wind and pv
+        feedin < power_limit in the aggregated time series).
+    """
+    if data_demand is None:
+        data_demand = read_demand(filename)
+    series = np.vstack([np.asarray(s, dtype=float)[:len(wind_feedin)]
+                        for s in (wind_feedin, pv_feedin, data_demand)])
+
+    def longest_calm(wind, pv):
+        lengths = find_calm_runs(wind + pv < power_limit)[2]
+        return lengths.max() if len(lengths) else 0
+
+    wall_time = time.perf_counter()
+    model = StorageModel(solvername, series.shape[1],
+                         data_demand=series[2])
+    model.update(series[0], series[1])
+    full = model.solve()
+    full.update(timesteps=series.shape[1],
+                wall_time=time.perf_counter() - wall_time,
+                longest_calm=longest_calm(series[0], series[1]))
+    rows = {'full': full}
+    for n in n_typical_periods:
+        result = optimise_storage_size_reduced(
+            solvername=solvername, wind_feedin=series[0],
+            pv_feedin=series[1], data_demand=series[2],
+            n_typical_periods=n, period_length=period_length,
+            power_limit=power_limit, **kwargs)
+        aggregated = tp.expand_periods(result.pop('typical_periods'))
+        length = aggregated.shape[1]
+        for name, row, original in zip(('wind', 'pv', 'demand'),
+                                       aggregated, series):
+            result['rmse_' + name] = np.sqrt(
+                ((row - original[:length]) ** 2).mean())
+        result['longest_calm'] = longest_calm(aggregated[0], aggregated[1])
+        rows[n] = result
+    report = pd.DataFrame(rows).T.astype(float)
+    for column in ('storage_cap', 'objective'):
+        report[column + '_error'] = report[column] / full[column] - 1
+    report['speedup'] = full['wall_time'] / report['wall_time']
+    return report
+
+
+def _check_termination(results):
+    """
+    Raises a RuntimeError if the solve of results did not end optimal (the
+    variables then still hold the values of the previous solve).
+    """
+    condition = results.solver.termination_condition
+    if condition != TerminationCondition.optimal:
+        raise RuntimeError(
+            'Solve not optimal: {0} ({1})'.format(condition,
+                                                  results.solver.status))
+
+
+class StorageModel(object):
+    """
+    Storage optimisation model that is built once and solved for many cases
+    (locations, years): only the fixed flows of wind, pv and demand are
+    updated between the solves, and the solver object is reused (persistent
+    solvers such as 'gurobi_persistent' keep the model and only receive the
+    changed variables).
+    """
+
+    def __init__(self, solvername='cbc', number_timesteps=8760,
+                 filename="storage_invest.csv", data_demand=None):
+        if data_demand is None:
+            data_demand = read_demand(filename)
+        self.number_timesteps = number_timesteps
+        zeros = np.zeros(number_timesteps)
+        self.energysystem = create_energysystem(
+            zeros, zeros, np.asarray(data_demand)[:number_timesteps],
+            number_timesteps)
+        self.om = solph.OperationalModel(self.energysystem)
+        self.nodes = self.energysystem.groups
+        self.bus = self.nodes['electricity']
+        self.storage = self.nodes['storage']
+        self.solver = SolverFactory(solvername)
+        self.persistent = hasattr(self.solver, 'set_instance')
+        if self.persistent:
+            self.solver.set_instance(self.om)
+
+    def _fix_flow(self, source, target, values):
+        """
+        Fixes the flow from source to target to values (per nominal value).
+        """
+        nominal_value = self.om.flows[source, target].nominal_value
+        values = np.asarray(values, dtype=float)[:self.number_timesteps]
+        for t, value in enumerate(values):
+            var = self.om.flow[source, target, t]
+            var.fix(value * nominal_value)
+            if self.persistent:
+                self.solver.update_var(var)
+
+    def update(self, wind_feedin, pv_feedin, data_demand=None):
+        """
+        Sets the wind and pv feedin (per installed capacity) and optionally
+        the normalised demand of the next solve.
+        """
+        self._fix_flow(self.nodes['wind'], self.bus, wind_feedin)
+        self._fix_flow(self.nodes['pv'], self.bus, pv_feedin)
+        if data_demand is not None:
+            self._fix_flow(self.bus, self.nodes['demand'], data_demand)
+
+    def solve(self, tee=False):
+        """
+        Solves the model and returns the optimal storage capacity and the
+        objective. Raises a RuntimeError if the solve is not optimal.
+        """
+        _check_termination(self.solver.solve(self.om, tee=tee))
+        return {
+            'storage_cap': value(
+                self.om.InvestmentStorage.invest[self.storage]),
+            'objective': value(self.om.objective)}
+
+
+# Model of each process of run_storage_sweep
+_sweep_model = None
+
+
+def _init_sweep_worker(model_kwargs):
+    global _sweep_model
+    _sweep_model = StorageModel(**model_kwargs)
+
+
+def _run_sweep_case(case):
+    """
+    Solves one case of run_storage_sweep with the model of the process.
+    """
+    case = dict(case)
+    wind_feedin, pv_feedin = case.pop('wind_feedin'), case.pop('pv_feedin')
+    data_demand = case.pop('data_demand', None)
+    try:
+        _sweep_model.update(wind_feedin, pv_feedin, data_demand)
+        case.update(_sweep_model.solve())
+    except Exception as e:
+        case['error'] = repr(e)
+    return case
+
+
+def sweep_cases(wind_matrix, pv_matrix, **info):
+    """
+    Yields the cases of run_storage_sweep for all gids of both the wind and
+    the pv feedin (FeedinMatrix, e.g. of get_data with data_format='memmap',
+    matched by gid, see get_from_db.common_rows); info (e.g. year=2011) is
+    added to each case.
+    """
+    gids, (wind_rows, pv_rows) = common_rows([wind_matrix, pv_matrix])
+    for gid, wind_row, pv_row in zip(gids.tolist(), wind_rows, pv_rows):
+        yield dict(info, gid=gid,
+                   wind_feedin=np.asarray(wind_matrix.values[wind_row]),
+                   pv_feedin=np.asarray(pv_matrix.values[pv_row]))
+
+
+def run_storage_sweep(cases, processes=None, chunksize=1, **model_kwargs):
+    """
+    Optimises the storage size for many cases (e.g. all gids and years, see
+    sweep_cases). Each case is a dictionary with 'wind_feedin', 'pv_feedin',
+    optionally 'data_demand' and any further information (e.g. gid, year).
+    Every process builds the model once (model_kwargs are passed to
+    StorageModel) and solves its cases one after another.
+
+    Returns
+    -------
+    results : DataFrame
+        One row per case with its information, 'storage_cap', 'objective'
+        and 'error' (if the solve failed).
+    """
+    if processes == 1:
+        _init_sweep_worker(model_kwargs)
+        results = [_run_sweep_case(case) for case in cases]
+    else:
+        with multiprocessing.Pool(processes, _init_sweep_worker,
+                                  (model_kwargs,)) as pool:
+            results = list(pool.imap(_run_sweep_case, cases, chunksize))
+    return pd.DataFrame(results)
+
+
 def get_result_dict(energysystem):
     logging.info('Check the results')
     storage = energysystem.groups['storage']
@@ -0,0 +1,8 @@
+import os
+import sys
+import matplotlib
+
+# Plots are only drawn, never shown
+matplotlib.use('Agg')
+# The modules live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,150 @@
+"""
+Equivalence of the vectorized calm functions with the per-location
+implementations of the baseline, which are kept here as references.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from get_from_db import (calculate_calms, calculate_calms_mask,
+                         calculate_calms_matrix, calm_mask_from_dict,
+                         calms_frequency, calms_frequency_table,
+                         create_calm_mask, create_calms_dict, filter_peaks)
+from test_calm_mask import feedin_dict
+from test_calms import random_feedin
+
+
+def baseline_calculate_calms(calms_dict):
+    calms_max, calms_min, calm_lengths = {}, {}, {}
+    for key in calms_dict:
+        df = calms_dict[key]
+        calms, = np.where(df['calm'] != 'no_calm')
+        calm_arrays = np.split(calms, np.where(np.diff(calms) != 1)[0] + 1)
+        calm_lengths[key] = np.array([len(calm_arrays[i])
+                                      for i in range(len(calm_arrays))])
+        calms_max[key] = max(calm_lengths[key])
+        calms_min[key] = min(calm_lengths[key])
+    calms_max = pd.DataFrame(data=calms_max, index=['results']).transpose()
+    calms_min = pd.DataFrame(data=calms_min, index=['results']).transpose()
+    return calms_max, calms_min, calm_lengths
+
+
+def baseline_calms_frequency(calm_lengths, min_length):
+    calms_freq = {}
+    for key in calm_lengths:
+        calms_freq[key] = np.compress((calm_lengths[key] >= min_length),
+                                      calm_lengths[key]).size
+    calms_freq = pd.DataFrame(data=calms_freq, index=['results']).transpose()
+    return calms_freq
+
+
+def baseline_filter_peaks(calms_dict, power_limit):
+    calms_dict_filtered = {}
+    for key in calms_dict:
+        df = calms_dict[key]
+        calms, = np.where(df['calm'] != 'no_calm')
+        calm_arrays = np.split(calms, np.where(np.diff(calms) != 1)[0] + 1)
+        feedin_arr = np.array(df['feedin_wind_pp'])
+        calm_arr = np.array(df['calm'])
+        i = 0
+        while i <= (len(calm_arrays) - 1):
+            j = i + 1
+            if j > (len(calm_arrays) - 1):
+                break
+            while (sum(feedin_arr[calm_arrays[i][0]:calm_arrays[j][-1] + 1]) /
+                   len(feedin_arr[calm_arrays[i][0]:calm_arrays[j][-1] + 1])
+                   < power_limit):
+                j = j + 1
+                if j > (len(calm_arrays) - 1):
+                    break
+            calm_arr[calm_arrays[i][0]:calm_arrays[j-1][-1] + 1] = feedin_arr[
+                calm_arrays[i][0]:calm_arrays[j-1][-1] + 1]
+            i = j
+        calms_dict_filtered[key] = pd.DataFrame(
+            data={'feedin_wind_pp': df['feedin_wind_pp'], 'calm': calm_arr},
+            index=df.index, columns=['feedin_wind_pp', 'calm'])
+    return calms_dict_filtered
+
+
+def calms_dicts():
+    feedin = random_feedin(n_rows=12, n_steps=700)
+    values = feedin.values.copy()
+    values[1] = 0  # calm over the whole time span
+    values[2, ::2] = 0.5  # calms of length 1
+    values[3, -5:] = 0  # calm at the end
+    feedin = feedin._replace(values=values)
+    return [create_calms_dict(limit, feedin_dict(feedin))
+            for limit in (0.01, 0.05, 0.1)]
+
+
+@pytest.mark.parametrize('calms_dict', calms_dicts())
+def test_calculate_calms(calms_dict):
+    calms = calculate_calms(calms_dict)
+    expected = baseline_calculate_calms(calms_dict)
+    for k in (0, 1):
+        np.testing.assert_array_equal(calms[k].index, expected[k].index)
+        np.testing.assert_array_equal(calms[k]['results'],
+                                      expected[k]['results'])
+    assert list(calms[2]) == list(expected[2])
+    for key in expected[2]:
+        np.testing.assert_array_equal(calms[2][key], expected[2][key])
+
+
+LIMITS_AND_CALMS = list(zip((0.01, 0.05, 0.1), calms_dicts()))
+
+
+@pytest.mark.parametrize('limit, calms_dict', LIMITS_AND_CALMS)
+def test_filter_peaks(limit, calms_dict):
+    filtered = filter_peaks(calms_dict, limit)
+    expected = baseline_filter_peaks(calms_dict, limit)
+    np.testing.assert_array_equal(calm_mask_from_dict(filtered).bits,
+                                  calm_mask_from_dict(expected).bits)
+    for key in expected:
+        np.testing.assert_array_equal(
+            filtered[key]['calm'].astype(str),
+            expected[key]['calm'].astype(str))
+
+
+@pytest.mark.parametrize('limit, calms_dict', LIMITS_AND_CALMS)
+def test_filter_peaks_passes(limit, calms_dict):
+    expected = [calms_dict]
+    while len(expected) < 3 or not np.array_equal(
+            calm_mask_from_dict(expected[-1]).bits,
+            calm_mask_from_dict(expected[-2]).bits):
+        expected.append(baseline_filter_peaks(expected[-1], limit))
+    for passes in (2, None):
+        filtered = filter_peaks(calms_dict, limit, passes)
+        np.testing.assert_array_equal(
+            calm_mask_from_dict(filtered).bits,
+            calm_mask_from_dict(expected[passes or -1]).bits)
+
+
+@pytest.mark.parametrize('calms_dict', calms_dicts())
+def test_calms_frequency_table(calms_dict):
+    calm_lengths = baseline_calculate_calms(calms_dict)[2]
+    min_lengths = [0, 1, 2, 2.5, 5, 24, 699, 700, 701]
+    table = calms_frequency_table(calm_lengths, min_lengths)
+    np.testing.assert_array_equal(table.index, list(calm_lengths))
+    for min_length in min_lengths:
+        expected = baseline_calms_frequency(calm_lengths, min_length)
+        np.testing.assert_array_equal(table[min_length], expected['results'])
+        np.testing.assert_array_equal(
+            calms_frequency(calm_lengths, min_length)['results'],
+            expected['results'])
+
+
+def test_without_locations():
+    expected = baseline_calculate_calms({})
+    feedin = random_feedin(n_rows=1)
+    feedin = feedin._replace(values=feedin.values[:0], gids=feedin.gids[:0])
+    for calms in (calculate_calms({}), calculate_calms_matrix(feedin, 0.1),
+                  calculate_calms_mask(create_calm_mask(0.1, feedin),
+                                       feedin)):
+        for k in (0, 1):
+            assert calms[k].empty
+            assert list(calms[k].columns) == list(expected[k].columns)
+        assert calms[2] == expected[2] == {}
+    assert calms_frequency({}, 24).empty
+    assert list(calms_frequency({}, 24).columns) == list(
+        baseline_calms_frequency({}, 24).columns)
+    assert calms_frequency_table({}, [1, 24]).shape == (0, 2)
+    assert filter_peaks({}, 0.1) == baseline_filter_peaks({}, 0.1) == {}
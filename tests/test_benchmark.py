@@ -0,0 +1,36 @@
+import pytest
+from benchmark_calms import compare_baseline, run_benchmarks, save_baseline
+
+
+def result(time, relative_time, peak_memory=1e7):
+    return {'time': time, 'relative_time': relative_time,
+            'peak_memory': peak_memory, 'throughput': 1 / time}
+
+
+def test_compare_relative_times(tmpdir):
+    filename = str(tmpdir.join('baseline.json'))
+    save_baseline({'a': result(1., 2.), 'b': result(1., 2.),
+                   'c': result(1., 2.), 'd': result(0.001, 2.)}, 'key',
+                  filename)
+    results = {
+        # Slower machine: the reference kernel is slower as well
+        'a': result(3., 2.1),
+        # Slower relative to the reference
+        'b': result(1.5, 3.),
+        # More memory
+        'c': result(1., 2., peak_memory=2e7),
+        # Slower, but less than min_change
+        'd': result(0.002, 4.)}
+    assert compare_baseline(results, 'key', filename) == ['b', 'c']
+    assert compare_baseline(results, 'other', filename) == []
+    assert compare_baseline(results, 'key', str(tmpdir.join('none'))) == []
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(cells=5, years=1, repeats=1,
+                             names=['calculate_calms_matrix'])
+    assert list(results) == ['calculate_calms_matrix']
+    measures = results['calculate_calms_matrix']
+    assert measures['relative_time'] > 0
+    assert measures['throughput'] == pytest.approx(5 * 8760 /
+                                                   measures['time'])
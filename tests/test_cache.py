@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import get_from_db
+from get_from_db import cache_key, cache_path, cached, evict_cache
+
+
+def test_cache_key_depends_on_all_parameters():
+    assert cache_key(year=2011, limit=0.05) == cache_key(limit=0.05,
+                                                         year=2011)
+    assert cache_key(year=2011) != cache_key(year=2012)
+    assert (cache_key(values=np.arange(3)) !=
+            cache_key(values=np.arange(1, 4)))
+
+
+def test_cached_computes_once(tmpdir):
+    folder = str(tmpdir)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'a': 1}
+
+    assert cached(compute, 'data', {'year': 2011}, folder) == {'a': 1}
+    assert cached(compute, 'data', {'year': 2011}, folder) == {'a': 1}
+    assert len(calls) == 1
+
+
+def test_evict_cache_keeps_data_in_use(tmpdir, monkeypatch):
+    folder = str(tmpdir)
+    monkeypatch.setattr(get_from_db, '_cache_in_use', set())
+    cached(lambda: np.zeros(1000), 'weather', {'year': 2011}, folder)
+    # Data of another run, least recently used
+    old = os.path.join(folder, 'feedin_old')
+    with open(old, 'wb') as f:
+        f.write(b'0' * 100)
+    os.utime(old, (0, 0))
+    cached(lambda: np.zeros(1000), 'feedin', {'year': 2011}, folder,
+           max_size=1)
+    assert not os.path.exists(old)
+    assert os.path.exists(cache_path('weather', {'year': 2011}, folder))
+    assert os.path.exists(cache_path('feedin', {'year': 2011}, folder))
+    evict_cache(folder, max_age=0)
+    assert len(os.listdir(folder)) == 2
+
+
+def test_cached_directory_added_concurrently(tmpdir):
+    folder = str(tmpdir)
+    params = {'year': 2011}
+    path = cache_path('columns', params, folder)
+
+    def write(target, value):
+        os.makedirs(target)
+        np.save(os.path.join(target, 'v.npy'), np.array([value]))
+
+    def compute(tmp_path):
+        write(tmp_path, 2)
+        # Another process adds the same data before this one is finished
+        write(path, 1)
+
+    data = cached(compute, 'columns', params, folder,
+                  load=lambda p: np.load(os.path.join(p, 'v.npy')),
+                  path_argument=True)
+    np.testing.assert_array_equal(data, [1])
+    assert os.listdir(folder) == [os.path.basename(path)]
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+from get_from_db import (CalmMask, FeedinMatrix, cached, calculate_calms,
+                         calculate_calms_mask, calculate_calms_matrix,
+                         calm_mask_from_dict, calm_mask_of_gid,
+                         calms_dict_from_mask, create_calm_mask,
+                         create_calms_dict, filter_calm_mask, filter_peaks,
+                         unpack_calm_mask)
+from calm_statistics import coincident_calms
+from test_calms import random_feedin
+
+
+def feedin_dict(feedin_matrix):
+    return {gid: pd.Series(feedin_matrix.values[row],
+                           index=feedin_matrix.index, name='feedin_wind_pp')
+            for row, gid in enumerate(feedin_matrix.gids)}
+
+
+def assert_calms_equal(calms, expected):
+    pd.testing.assert_frame_equal(calms[0], expected[0], check_dtype=False)
+    pd.testing.assert_frame_equal(calms[1], expected[1], check_dtype=False)
+    assert list(calms[2]) == list(expected[2])
+    for gid in expected[2]:
+        np.testing.assert_array_equal(calms[2][gid], expected[2][gid])
+
+
+@pytest.mark.parametrize('n_steps', [200, 203])
+def test_create_calm_mask(n_steps):
+    feedin = random_feedin(n_steps=n_steps)
+    calm_mask = create_calm_mask(0.1, feedin, chunk_size=3)
+    assert calm_mask.bits.shape == (7, (n_steps + 7) // 8)
+    np.testing.assert_array_equal(calm_mask.gids, feedin.gids)
+    np.testing.assert_array_equal(unpack_calm_mask(calm_mask, n_steps),
+                                  feedin.values < 0.1)
+    np.testing.assert_array_equal(
+        calm_mask_of_gid(calm_mask, feedin, 103).values,
+        feedin.values[3] < 0.1)
+
+
+def test_calm_mask_matches_calms_dict():
+    feedin = random_feedin()
+    calms_dict = create_calms_dict(0.1, feedin_dict(feedin))
+    calm_mask = create_calm_mask(0.1, feedin)
+    expected = calculate_calms(calms_dict)
+    assert_calms_equal(calculate_calms(calm_mask, feedin), expected)
+    assert_calms_equal(calculate_calms_mask(calm_mask, feedin, chunk_size=2),
+                       expected)
+    assert_calms_equal(calculate_calms_matrix(feedin, 0.1), expected)
+    from_dict = calm_mask_from_dict(calms_dict)
+    np.testing.assert_array_equal(from_dict.bits, calm_mask.bits)
+    np.testing.assert_array_equal(from_dict.gids, calm_mask.gids)
+    for gid, df in calms_dict_from_mask(calm_mask, feedin).items():
+        pd.testing.assert_frame_equal(df, calms_dict[gid], check_dtype=False,
+                                      check_names=False)
+
+
+@pytest.mark.parametrize('passes', [1, None])
+def test_filter_calm_mask_matches_filter_peaks(passes):
+    feedin = random_feedin(n_steps=500)
+    calms_dict = filter_peaks(create_calms_dict(0.1, feedin_dict(feedin)),
+                              0.1, passes)
+    calm_mask = filter_calm_mask(feedin, create_calm_mask(0.1, feedin), 0.1,
+                                 passes, chunk_size=3)
+    np.testing.assert_array_equal(calm_mask.bits,
+                                  calm_mask_from_dict(calms_dict).bits)
+    assert_calms_equal(calculate_calms_mask(calm_mask, feedin),
+                       calculate_calms(calms_dict))
+
+
+def test_calm_mask_of_other_feedin():
+    feedin = random_feedin()
+    calm_mask = create_calm_mask(0.1, feedin)
+    shuffled = FeedinMatrix(values=feedin.values[::-1],
+                            gids=feedin.gids[::-1], index=feedin.index)
+    subset = FeedinMatrix(values=feedin.values[:3], gids=feedin.gids[:3],
+                          index=feedin.index)
+    for other in (shuffled, subset):
+        with pytest.raises(ValueError):
+            calculate_calms_mask(calm_mask, other)
+        with pytest.raises(ValueError):
+            filter_calm_mask(other, calm_mask, 0.1)
+        with pytest.raises(ValueError):
+            coincident_calms(other, 0.1, calm_mask=calm_mask)
+    longer = FeedinMatrix(values=np.hstack([feedin.values] * 2),
+                          gids=feedin.gids, index=feedin.index.append(
+                              feedin.index + pd.Timedelta('365D')))
+    with pytest.raises(ValueError):
+        calculate_calms_mask(calm_mask, longer)
+
+
+def test_cached_calm_mask_keeps_gids(tmpdir):
+    feedin = random_feedin()
+    folder = str(tmpdir)
+    cached(lambda: create_calm_mask(0.1, feedin), 'calm_mask', {'a': 1},
+           folder)
+    calm_mask = cached(lambda: None, 'calm_mask', {'a': 1}, folder)
+    assert isinstance(calm_mask, CalmMask)
+    np.testing.assert_array_equal(calm_mask.gids, feedin.gids)
+    other = FeedinMatrix(values=feedin.values[1:], gids=feedin.gids[1:],
+                         index=feedin.index)
+    with pytest.raises(ValueError):
+        calculate_calms_mask(calm_mask, other)
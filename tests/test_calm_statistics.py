@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+from calm_statistics import (calm_statistics_multi, coincident_calm_events,
+                             coincident_calms, group_calm_statistics,
+                             rolling_calm_hours, rolling_calm_statistics,
+                             seasonal_calm_statistics)
+from get_from_db import (calculate_calms_matrix, calculate_calms_multi,
+                         create_calm_mask, filter_calm_mask,
+                         unpack_calm_mask)
+from test_calms import loop_calm_runs, random_feedin
+
+
+def feedin_and_calms(power_limit=0.05):
+    feedin = random_feedin(n_steps=24 * 60)
+    feedin = feedin._replace(index=pd.date_range(
+        '2/15/2011', periods=24 * 60, freq='60min'))
+    calms = calculate_calms_matrix(feedin, power_limit)
+    return feedin, calms[3], calms[2]
+
+
+def loop_group_statistics(mask, groups):
+    labels = np.unique(groups)
+    rows, starts, lengths = loop_calm_runs(mask)
+    statistics = {name: np.zeros((len(mask), len(labels)))
+                  for name in ('longest', 'number', 'hours', 'share')}
+    for row, start, length in zip(rows, starts, lengths):
+        column = np.flatnonzero(labels == groups[start])[0]
+        statistics['number'][row, column] += 1
+        statistics['longest'][row, column] = max(
+            statistics['longest'][row, column], length)
+    for column, label in enumerate(labels):
+        in_group = groups == label
+        statistics['hours'][:, column] = mask[:, in_group].sum(axis=1)
+        statistics['share'][:, column] = (
+            statistics['hours'][:, column] / in_group.sum())
+    return statistics
+
+
+@pytest.mark.parametrize('groups', ['month', 'hour', 'random'])
+def test_group_calm_statistics(groups):
+    feedin, calm_starts, calm_lengths = feedin_and_calms()
+    if groups == 'random':
+        groups = np.random.RandomState(1).choice(['a', 'b', 'c'],
+                                                 len(feedin.index))
+    else:
+        groups = np.asarray(getattr(feedin.index, groups))
+    statistics = group_calm_statistics(calm_starts, calm_lengths, groups)
+    expected = loop_group_statistics(feedin.values < 0.05, groups)
+    for name in expected:
+        np.testing.assert_array_equal(statistics[name].index, feedin.gids)
+        np.testing.assert_array_equal(statistics[name].columns,
+                                      np.unique(groups))
+        np.testing.assert_allclose(statistics[name].values, expected[name])
+
+
+def test_seasonal_and_multi_statistics():
+    feedin, calm_starts, calm_lengths = feedin_and_calms(0.1)
+    seasons = seasonal_calm_statistics(calm_starts, calm_lengths,
+                                       feedin.index)
+    assert list(seasons['hours'].columns) == ['DJF', 'MAM']
+    np.testing.assert_array_equal(seasons['hours'].sum(axis=1),
+                                  (feedin.values < 0.1).sum(axis=1))
+    multi = calm_statistics_multi(calculate_calms_multi(feedin, [0.05, 0.1]),
+                                  feedin.index, by='season')
+    for name in seasons:
+        pd.testing.assert_frame_equal(multi[0.1][name], seasons[name])
+
+
+@pytest.mark.parametrize('window', [1, 24, 30 * 24, 100 * 24])
+def test_rolling_calm_statistics(window):
+    feedin, calm_starts, calm_lengths = feedin_and_calms()
+    mask = feedin.values < 0.05
+    expected = (pd.DataFrame(mask.T.astype(int))
+                .rolling(window, min_periods=1).sum().values.T)
+    hours = rolling_calm_hours(calm_starts, calm_lengths, mask.shape[1],
+                               window)
+    np.testing.assert_array_equal(hours, expected)
+    statistics = rolling_calm_statistics(calm_starts, calm_lengths,
+                                         feedin.index, window)
+    np.testing.assert_array_equal(statistics['max_hours'],
+                                  expected.max(axis=1))
+    np.testing.assert_array_equal(
+        statistics['window_end'], feedin.index[expected.argmax(axis=1)])
+    np.testing.assert_allclose(
+        statistics['max_share'],
+        expected.max(axis=1) / min(window, mask.shape[1]))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 500])
+def test_coincident_calms(chunk_size):
+    feedin = random_feedin(n_steps=300)
+    mask = feedin.values < 0.1
+    capacities = pd.Series(np.arange(1., 8.), index=feedin.gids[::-1])
+    coincidence = coincident_calms(feedin, 0.1, capacities,
+                                   chunk_size=chunk_size)
+    np.testing.assert_array_equal(coincidence['cells'], mask.sum(axis=0))
+    weights = capacities.reindex(feedin.gids).values
+    np.testing.assert_allclose(coincidence['share'],
+                               weights.dot(mask) / weights.sum())
+    calm_mask = filter_calm_mask(feedin, create_calm_mask(0.1, feedin), 0.1)
+    filtered = coincident_calms(feedin, 0.1, calm_mask=calm_mask,
+                                chunk_size=chunk_size)
+    np.testing.assert_array_equal(
+        filtered['cells'], unpack_calm_mask(calm_mask, 300).sum(axis=0))
+    np.testing.assert_allclose(filtered['share'], filtered['cells'] / 7.)
+
+
+@pytest.mark.parametrize('threshold, min_length', [(0.4, 1), (0.4, 3),
+                                                   (0.6, 2), (1.1, 1)])
+def test_coincident_calm_events(threshold, min_length):
+    coincidence = coincident_calms(random_feedin(n_steps=300), 0.1)
+    events = coincident_calm_events(coincidence, threshold, min_length)
+    share = coincidence['share'].values
+    expected = []
+    for _, start, length in zip(*loop_calm_runs(
+            (share >= threshold)[np.newaxis])):
+        if length >= min_length:
+            steps = slice(start, start + length)
+            expected.append([coincidence.index[start],
+                             coincidence.index[start + length - 1], length,
+                             share[steps].mean(), share[steps].max(),
+                             coincidence['cells'].values[steps].max()])
+    assert len(events) == len(expected)
+    for (_, event), expected_event in zip(events.iterrows(), expected):
+        assert event['start'] == expected_event[0]
+        assert event['end'] == expected_event[1]
+        assert event['length'] == expected_event[2]
+        assert event['mean_share'] == pytest.approx(expected_event[3])
+        assert event['max_share'] == expected_event[4]
+        assert event['max_cells'] == expected_event[5]
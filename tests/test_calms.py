@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+from get_from_db import (FeedinMatrix, calculate_calms_matrix,
+                         calculate_calms_multi, find_calm_runs,
+                         find_calm_runs_multi)
+
+
+def random_feedin(n_rows=7, n_steps=200, seed=0):
+    rng = np.random.RandomState(seed)
+    values = rng.uniform(0, 0.2, (n_rows, n_steps))
+    values[0] = 0.5  # location without calms
+    return FeedinMatrix(values=values, gids=np.arange(100, 100 + n_rows),
+                        index=pd.date_range('1/1/2011', periods=n_steps,
+                                            freq='60min'))
+
+
+def loop_calm_runs(mask):
+    """
+    Calm runs of a 2-D boolean array with a plain loop (reference).
+    """
+    rows, starts, lengths = [], [], []
+    for row, series in enumerate(mask):
+        length = 0
+        for step, calm in enumerate(list(series) + [False]):
+            if calm:
+                length += 1
+            elif length:
+                rows.append(row)
+                starts.append(step - length)
+                lengths.append(length)
+                length = 0
+    return np.array(rows), np.array(starts), np.array(lengths)
+
+
+def assert_runs_equal(runs, expected):
+    for values, expected_values in zip(runs, expected):
+        np.testing.assert_array_equal(values, expected_values)
+
+
+def test_find_calm_runs():
+    mask = random_feedin().values < 0.1
+    assert_runs_equal(find_calm_runs(mask), loop_calm_runs(mask))
+    assert_runs_equal(find_calm_runs(np.array([True, True, False, True])),
+                      ([0, 0], [0, 3], [2, 1]))
+
+
+def test_find_calm_runs_multi():
+    values = random_feedin().values
+    limits = [0.1, 0.03, 0.05]
+    runs = find_calm_runs_multi(values, limits)
+    assert sorted(runs) == sorted(limits)
+    for limit in limits:
+        assert_runs_equal(runs[limit], loop_calm_runs(values < limit))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 500])
+def test_calculate_calms_multi_chunks(chunk_size):
+    feedin = random_feedin()
+    calms = calculate_calms_multi(feedin, [0.05, 0.1], chunk_size)
+    for limit in (0.05, 0.1):
+        expected = calculate_calms_matrix(feedin, limit)
+        pd.testing.assert_frame_equal(calms[limit][0], expected[0])
+        pd.testing.assert_frame_equal(calms[limit][1], expected[1])
+        for gid in feedin.gids:
+            np.testing.assert_array_equal(calms[limit][2][gid],
+                                          expected[2][gid])
+            np.testing.assert_array_equal(calms[limit][3][gid],
+                                          expected[3][gid])
+        np.testing.assert_array_equal(calms[limit][4], expected[4])
+    assert calms[0.05][0]['results'].iloc[0] == 0
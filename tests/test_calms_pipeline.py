@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from calms_pipeline import (aggregate_calms, evaluate_calms_streaming,
+                            stream_calm_runs, stream_feedin)
+from get_from_db import (FeedinMatrix, calculate_calms_matrix,
+                         calms_frequency_table, dump_matrix_columns,
+                         find_calm_runs)
+from test_calms import assert_runs_equal, random_feedin
+
+PERIODS = (50, 1, 30, 69, 50)
+
+
+def feedin_with_long_calms():
+    feedin = random_feedin(n_rows=9, n_steps=sum(PERIODS))
+    values = feedin.values.copy()
+    values[1] = 0  # one calm over all periods
+    values[2, 40:140] = 0  # calm over several period boundaries
+    values[3, :] = 0.5
+    values[3, 49:51] = 0  # calm of the single step period and its neighbours
+    values[4, ::2] = 0.5  # calms of length 1 at the period boundaries
+    return feedin._replace(values=values)
+
+
+def split_chunks(feedin, chunk_size):
+    bounds = np.cumsum((0,) + PERIODS)
+    for first in range(0, len(feedin.gids), chunk_size):
+        rows = slice(first, first + chunk_size)
+        yield [FeedinMatrix(values=feedin.values[rows, start:end],
+                            gids=feedin.gids[rows],
+                            index=feedin.index[start:end])
+               for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 500])
+def test_stream_calm_runs_across_periods(chunk_size):
+    feedin = feedin_with_long_calms()
+    runs = list(stream_calm_runs(split_chunks(feedin, chunk_size), 0.1))
+    gids = [chunk_runs[0] for chunk_runs in runs]
+    first_rows = np.cumsum([0] + [len(chunk_gids) for chunk_gids in gids])
+    rows = [chunk_runs[1] + first for chunk_runs, first in
+            zip(runs, first_rows)]
+    starts = [chunk_runs[2] for chunk_runs in runs]
+    lengths = [chunk_runs[3] for chunk_runs in runs]
+    np.testing.assert_array_equal(np.concatenate(gids), feedin.gids)
+    assert_runs_equal(
+        (np.concatenate(rows), np.concatenate(starts),
+         np.concatenate(lengths)),
+        find_calm_runs(feedin.values < 0.1))
+
+
+def test_evaluate_calms_streaming():
+    feedin = feedin_with_long_calms()
+    results = evaluate_calms_streaming(split_chunks(feedin, 4), 0.1,
+                                       min_lengths=(1, 3, 100),
+                                       max_length=60)
+    calms_max, calms_min, calm_lengths = calculate_calms_matrix(
+        feedin, 0.1)[:3]
+    np.testing.assert_array_equal(results['calms_max'], calms_max)
+    np.testing.assert_array_equal(results['calms_min'], calms_min)
+    np.testing.assert_array_equal(
+        results['frequency'],
+        calms_frequency_table(calm_lengths, (1, 3, 100)))
+    lengths = find_calm_runs(feedin.values < 0.1)[2]
+    assert results['histogram'].sum() == len(lengths)
+    assert results['histogram'][60] == (lengths >= 60).sum()
+    assert results['histogram'][0] == 0
+
+
+def test_stream_feedin(tmpdir):
+    feedin = feedin_with_long_calms()
+    folders = []
+    for k, chunk in enumerate(next(split_chunks(feedin, 500))):
+        folders.append(os.path.join(str(tmpdir), str(k)))
+        dump_matrix_columns(folders[-1], {'feedin': chunk.values},
+                            chunk.gids, chunk.index)
+    results = aggregate_calms(stream_calm_runs(stream_feedin(folders, 4),
+                                               0.1))
+    expected = evaluate_calms_streaming(split_chunks(feedin, 500), 0.1)
+    for key in ('calms_max', 'calms_min', 'frequency'):
+        pd.testing.assert_frame_equal(results[key], expected[key])
+    np.testing.assert_array_equal(results['histogram'],
+                                  expected['histogram'])
+    dump_matrix_columns(folders[0], {'feedin': feedin.values[::-1, :50]},
+                        feedin.gids[::-1], feedin.index[:50])
+    with pytest.raises(ValueError):
+        next(stream_feedin(folders))
@@ -0,0 +1,66 @@
+from collections import namedtuple
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from get_from_db import (dump_feedin_columns, dump_matrix_columns,
+                         dump_weather_columns, load_feedin_columns,
+                         load_feedin_matrix, load_matrix_columns,
+                         load_weather_columns)
+
+Weather = namedtuple('Weather', ['data', 'name', 'longitude', 'latitude',
+                                 'geometry', 'data_height'])
+
+
+@pytest.mark.parametrize('tz', [None, 'Europe/Berlin'])
+def test_matrix_columns(tmpdir, tz):
+    index = pd.date_range('1/1/2011', periods=30, freq='60min', tz=tz)
+    values = np.random.RandomState(0).uniform(0, 1, (2, 5, 30))
+    gids = np.array([7, 3, 9, 1, 4])
+    dump_matrix_columns(str(tmpdir), {'a': values[0], 'b': values[1]}, gids,
+                        index, metadata={'unit': 'W'})
+    data, metadata = load_matrix_columns(str(tmpdir), ['b'], gids=[9, 7, 2])
+    assert list(data) == ['b'] and metadata == {'unit': 'W'}
+    # Rows in the stored order
+    np.testing.assert_array_equal(data['b'].gids, [7, 9])
+    np.testing.assert_array_equal(data['b'].values, values[1, [0, 2]])
+    assert data['b'].index.equals(index)
+    # All gids are memory-mapped
+    data = load_matrix_columns(str(tmpdir))[0]
+    assert isinstance(data['a'].values, np.memmap)
+    np.testing.assert_array_equal(data['a'].values, values[0])
+
+
+def test_feedin_columns(tmpdir):
+    index = pd.date_range('1/1/2011', periods=30, freq='60min')
+    feedin = {gid: pd.Series(np.arange(30.) * gid, index=index,
+                             name='feedin_wind_pp') for gid in (5, 2, 8)}
+    dump_feedin_columns(feedin, str(tmpdir))
+    loaded = load_feedin_columns(str(tmpdir))
+    assert sorted(loaded) == [2, 5, 8]
+    for gid in feedin:
+        pd.testing.assert_series_equal(loaded[gid], feedin[gid],
+                                       check_freq=False,
+                                       check_index_type=False)
+    matrix = load_feedin_matrix(str(tmpdir), gids=[8])
+    np.testing.assert_array_equal(matrix.values, [feedin[8].values])
+
+
+def test_weather_columns(tmpdir):
+    pytest.importorskip('feedinlib')
+    from shapely.geometry import Point
+    index = pd.date_range('1/1/2011', periods=30, freq='60min', tz='UTC')
+    multi_weather = [
+        Weather(data=pd.DataFrame({'v_wind': np.arange(30.) + gid,
+                                   'temp_air': np.full(30, 280. + gid)},
+                                  index=index),
+                name=gid, longitude=gid, latitude=50., geometry=Point(gid, 50),
+                data_height={'v_wind': 10, 'temp_air': 2})
+        for gid in (4, 1)]
+    dump_weather_columns(multi_weather, str(tmpdir))
+    assert os.path.exists(os.path.join(str(tmpdir), 'v_wind.npy'))
+    loaded = load_weather_columns(str(tmpdir), gids=[4], variables=['v_wind'])
+    assert [weather.name for weather in loaded] == [4]
+    np.testing.assert_array_equal(loaded[0].data['v_wind'],
+                                  multi_weather[0].data['v_wind'])
+    assert loaded[0].geometry.equals(Point(4, 50))
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from data_backends import LocalBackend, SyntheticBackend, _ar1
+
+
+def ar1_loop(noise, autocorrelation):
+    values = np.empty_like(noise)
+    values[0] = noise[0]
+    scale = np.sqrt(1 - autocorrelation ** 2)
+    for step in range(1, len(noise)):
+        values[step] = (autocorrelation * values[step - 1] +
+                        scale * noise[step])
+    return values
+
+
+@pytest.mark.parametrize('autocorrelation', [1e-9, 0.01, 0.5, 0.97])
+def test_ar1_matches_recursion(autocorrelation):
+    noise = np.random.RandomState(0).standard_normal((300, 3))
+    values = _ar1(noise.copy(), autocorrelation, segment=64)
+    assert np.isfinite(values).all()
+    np.testing.assert_allclose(values, ar1_loop(noise, autocorrelation),
+                               atol=1e-12)
+    np.testing.assert_allclose(_ar1(noise[:, 0].copy(), autocorrelation),
+                               values[:, 0], atol=1e-12)
+
+
+@pytest.mark.parametrize('autocorrelation', [0, 1, -0.5, 1.5])
+def test_ar1_autocorrelation_range(autocorrelation):
+    with pytest.raises(ValueError):
+        _ar1(np.zeros(10), autocorrelation)
+    with pytest.raises(ValueError):
+        SyntheticBackend(autocorrelation=autocorrelation)
+
+
+def test_synthetic_weather_of_subset():
+    backend = SyntheticBackend(bounds=(6, 50, 8, 51), resolution=(0.5, 0.5))
+    full = backend.weather_columns(2011, variables=['v_wind'])['v_wind']
+    gids = full.gids[::3]
+    subset = backend.weather_columns(2011, variables=['v_wind'],
+                                     gids=gids)['v_wind']
+    np.testing.assert_array_equal(subset.gids, gids)
+    np.testing.assert_allclose(subset.values, full.values[::3])
+    assert full.values.shape == (len(backend.gids), 8760)
+
+
+def test_shape_germany_is_union_of_all_features(monkeypatch):
+    import get_from_db
+    from shapely import wkt
+    from shapely.geometry import box
+    features = [box(0, 0, 1, 1), box(1, 0, 2, 1), box(5, 5, 6, 6)]
+    monkeypatch.setattr(get_from_db, 'read_shapefile',
+                        lambda filename=None: features)
+    shape = wkt.loads(get_from_db.fetch_shape_germany(None)[0])
+    assert shape.area == pytest.approx(3)
+    assert shape.equals(
+        wkt.loads(LocalBackend().fetch_shape_germany()[0]))
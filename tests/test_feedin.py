@@ -0,0 +1,61 @@
+import os
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import pytest
+from get_from_db import calculate_feedin, get_data, load_feedin_matrix
+
+Weather = namedtuple('Weather', ['data', 'name'])
+INDEX = pd.date_range('1/1/2011', periods=5, freq='60min')
+
+
+class PowerPlant(object):
+    """
+    Feedin proportional to the wind speed (picklable for the process pool).
+    """
+
+    def feedin(self, weather, installed_capacity=1):
+        return pd.Series(weather.data['v_wind'].values / 10 *
+                         installed_capacity, index=weather.data.index,
+                         name='feedin_wind_pp')
+
+
+def multi_weather(gids=(3, 1, 2)):
+    return [Weather(data=pd.DataFrame({'v_wind': np.arange(5.0) + gid},
+                                      index=INDEX), name=gid)
+            for gid in gids]
+
+
+@pytest.mark.parametrize('processes, chunk_size', [(1, 50), (1, 2), (2, 1)])
+def test_calculate_feedin(processes, chunk_size):
+    feedin, name = calculate_feedin(PowerPlant(), multi_weather(), processes,
+                                    chunk_size, installed_capacity=1)
+    assert name == 'feedin_wind_pp'
+    np.testing.assert_array_equal(feedin.gids, [1, 2, 3])
+    np.testing.assert_allclose(feedin.values,
+                               (np.arange(5.0) + [[1], [2], [3]]) / 10)
+
+
+def test_calculate_feedin_memmap(tmpdir):
+    filename = str(tmpdir.join('feedin.npy'))
+    feedin, _ = calculate_feedin(PowerPlant(), multi_weather(), 2, 1,
+                                 filename=filename)
+    assert isinstance(feedin.values, np.memmap)
+    np.testing.assert_allclose(feedin.values[0], np.arange(1.0, 6.0) / 10)
+
+
+def test_calculate_feedin_without_weather(tmpdir):
+    feedin, name = calculate_feedin(PowerPlant(), [])
+    assert feedin.values.shape == (0, 0) and len(feedin.gids) == 0
+    assert name is None
+    feedin, _ = calculate_feedin(PowerPlant(), [],
+                                 filename=str(tmpdir.join('feedin.npy')))
+    assert feedin.values.shape == (0, 0)
+    assert get_data(power_plant=PowerPlant(), multi_weather=[],
+                    pickle_load=False, filename=None,
+                    data_type='wind_feedin') == {}
+    folder = str(tmpdir.join('memmap'))
+    get_data(power_plant=PowerPlant(), multi_weather=[], pickle_load=False,
+             filename=folder, data_type='wind_feedin', data_format='memmap')
+    assert load_feedin_matrix(folder).values.shape == (0, 0)
+    assert os.path.exists(os.path.join(folder, 'feedin.npy'))
@@ -0,0 +1,134 @@
+import os
+import sys
+import threading
+import types
+import numpy as np
+import pandas as pd
+import pytest
+from matplotlib import pyplot as plt
+from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
+from shapely import wkt
+from shapely.geometry import Point
+from data_backends import SyntheticBackend
+from get_from_db import (COASTDAT_DE, _geoplot_scale, coastdat_geoplot_batch,
+                         get_geometries, plot_histogram, run_plot_jobs)
+
+
+@pytest.mark.parametrize('calms, binned', [
+    (np.array([], dtype=int), True),
+    (np.bincount(np.array([], dtype=int)), True),
+    (np.array([3]), True),
+    (np.array([0, 0, 2, 0, 1]), True),
+    (pd.DataFrame({'results': []}), False),
+    (pd.DataFrame({'results': [0, 0]}), False),
+    (pd.DataFrame({'results': [10, 120, 0]}), False)])
+def test_plot_histogram_without_calms(calms, binned):
+    plot_histogram(calms, show_plot=False, save_figure=False, binned=binned)
+
+
+def test_geoplot_scale():
+    assert _geoplot_scale([1, 2.5, np.nan]) == 2.5
+    assert _geoplot_scale([1, 2.5], 7.5) == 7.5
+    assert _geoplot_scale([0, 0]) == 1
+    assert _geoplot_scale([np.nan]) == 1
+    assert _geoplot_scale([]) == 1
+
+
+class FakeGeoPlotter(object):
+    """
+    Records what geoplot.GeoPlotter is asked to draw and draws the cells
+    (every other one as patch, the others as collection).
+    """
+    calls = []
+
+    def __init__(self, geom, bbox, data, color, cmapname):
+        self.geometries, self.data = geom, data
+
+    def plot(self, **kwargs):
+        ax = plt.gca()
+        if 'facecolor' in kwargs:
+            ax.add_collection(PatchCollection([]))
+            self.calls.append(('outline', len(self.geometries)))
+            return
+        for geometry in self.geometries:
+            polygon = Polygon(np.array(geometry.exterior.coords))
+            if int(geometry.bounds[0] * 2) % 2:
+                ax.add_patch(polygon)
+            else:
+                ax.add_collection(PatchCollection([polygon]))
+        self.calls.append(('cells', len(self.geometries)))
+
+    def draw_legend(self, legendlabel, interval, integer):
+        plt.axes([0.1, 0.05, 0.8, 0.03])
+        self.calls.append(('legend', legendlabel, interval))
+
+
+def test_coastdat_geoplot_batch(tmpdir, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'geoplot', types.SimpleNamespace(
+        GeoPlotter=FakeGeoPlotter,
+        postgis2shapely=lambda geoms: [wkt.loads(geom) for geom in geoms]))
+    FakeGeoPlotter.calls = []
+    saved = []
+
+    def savefig(fig, filename):
+        cells = [(collection.get_paths(), collection.get_array().copy(),
+                  collection.get_clim())
+                 for collection in fig.axes[0].collections
+                 if collection.get_array() is not None]
+        saved.append((os.path.basename(filename), cells))
+    monkeypatch.setattr(Figure, 'savefig', savefig)
+    backend = SyntheticBackend(bounds=(6, 50, 8, 51), resolution=(0.5, 0.5))
+    gids = backend.gids
+    results = pd.DataFrame({'calms': np.arange(len(gids)) + 0.5,
+                            'none': np.zeros(len(gids))}, index=gids)
+    cache_folder = str(tmpdir.join('cache'))
+    coastdat_geoplot_batch(results, backend, save_folder='Plots',
+                           cache_folder=cache_folder)
+    # Cells are drawn once (one geometry at a time), not for every map
+    assert FakeGeoPlotter.calls[:len(gids)] == [('cells', 1)] * len(gids)
+    assert FakeGeoPlotter.calls[len(gids):] == [
+        ('outline', 1), ('legend', 'calms', (0, len(gids) - 0.5)),
+        ('legend', 'none', (0, 1.0))]
+    assert [name for name, _ in saved] == ['calms.png', 'none.png']
+    geometries = get_geometries(backend, cache_folder, **COASTDAT_DE)
+    for (name, cells), scale in zip(saved, (len(gids) - 0.5, 1.)):
+        assert len(cells) == 1
+        paths, colors, clim = cells[0]
+        assert clim == (0, 1)
+        assert len(paths) == len(gids)
+        # Colour of each cell is the result of the gid it shows
+        for path, color in zip(paths, colors):
+            center = Point(path.vertices[:-1].mean(axis=0))
+            gid = geometries['gid'][[geometry.contains(center) for geometry
+                                     in geometries['geom']]].iloc[0]
+            assert color == pytest.approx(results.loc[gid, name[:-4]] / scale)
+    assert not plt.get_fignums()
+
+
+def save_line(path, values):
+    fig = plt.figure()
+    plt.plot(values)
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def test_run_plot_jobs(tmpdir, capsys):
+    paths = [os.path.join(str(tmpdir), 'plot.png'),
+             os.path.join(str(tmpdir), 'missing', 'plot.png'),
+             os.path.join(str(tmpdir), 'other.png'),
+             os.path.join(str(tmpdir), 'last.png')]
+    unpicklable = threading.Lock()
+    jobs = [(save_line, (paths[0], [1, 2]), {}),
+            (save_line, (paths[1], [1, 2]), {}),
+            (save_line, (paths[2],), {}),
+            (save_line, (paths[2], [1, 2]), {'lock': unpicklable}),
+            (save_line, (paths[3], [3, 4]), {})]
+    failures = run_plot_jobs(jobs, processes=2)
+    assert os.path.exists(paths[0]) and os.path.exists(paths[3])
+    assert not os.path.exists(paths[2])
+    assert [job for job, _ in failures] == jobs[1:4]
+    assert all('Error' in error for _, error in failures)
+    assert 'pickle' in failures[2][1]
+    assert 'Plot job save_line failed' in capsys.readouterr().out
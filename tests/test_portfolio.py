@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+from get_from_db import FeedinMatrix, aggregate_regions, combine_feedin
+
+INDEX = pd.date_range('1/1/2011', periods=2, freq='60min')
+
+
+def matrix(values, gids):
+    values = np.repeat(np.asarray(values, dtype=float)[:, np.newaxis], 2,
+                       axis=1)
+    return FeedinMatrix(values=values, gids=np.array(gids), index=INDEX)
+
+
+def test_combine_feedin_sorted_gids():
+    combined = combine_feedin([matrix([1, 2, 3], [10, 20, 30]),
+                               matrix([10, 20, 30], [10, 20, 30])])
+    np.testing.assert_array_equal(combined.gids, [10, 20, 30])
+    np.testing.assert_allclose(combined.values[:, 0], [5.5, 11, 16.5])
+
+
+def test_combine_feedin_unsorted_gids():
+    wind = matrix([2, 1, 3], [20, 10, 30])
+    pv = matrix([10, 20, 30], [10, 20, 30])
+    np.testing.assert_allclose(combine_feedin([wind, pv]).values[:, 0],
+                               [5.5, 11, 16.5])
+    wind = matrix([3, 1, 2], [30, 10, 20])
+    combined = combine_feedin([wind, pv])
+    np.testing.assert_array_equal(combined.gids, [10, 20, 30])
+    np.testing.assert_allclose(combined.values[:, 0], [5.5, 11, 16.5])
+
+
+def test_combine_feedin_weights():
+    wind = matrix([3, 1, 2], [30, 10, 20])
+    pv = matrix([10, 20, 30], [10, 20, 30])
+    # Array weights follow the gid order of their matrix
+    combined = combine_feedin([wind, pv], [np.array([1, 0, 0]), 1])
+    np.testing.assert_allclose(combined.values[:, 0], [10, 20, 16.5])
+    combined = combine_feedin([wind, pv],
+                              [pd.Series([3, 1], index=[10, 20]), 1])
+    np.testing.assert_allclose(combined.values[:, 0], [3.25, 11, 30])
+
+
+def test_combine_feedin_intersection_and_memmap(tmpdir):
+    wind = matrix([1, 2, 3], [10, 20, 30])
+    pv = matrix([5, 7], [30, 20])
+    combined = combine_feedin([wind, pv], folder=str(tmpdir))
+    np.testing.assert_array_equal(combined.gids, [20, 30])
+    np.testing.assert_allclose(combined.values[:, 0], [4.5, 4])
+
+
+def test_aggregate_regions():
+    feedin = matrix([1, 2, 3, 4], [10, 20, 30, 40])
+    regions = pd.Series(['a', 'b', 'a'], index=[30, 10, 20])
+    aggregated = aggregate_regions(feedin, regions,
+                                   pd.Series([1, 1, 3], index=[10, 20, 30]))
+    np.testing.assert_array_equal(aggregated.gids, ['a', 'b'])
+    np.testing.assert_allclose(aggregated.values[:, 0], [2.75, 1])
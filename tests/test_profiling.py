@@ -0,0 +1,103 @@
+import builtins
+import json
+import os
+import resource
+import types
+import numpy as np
+import pandas as pd
+import pytest
+import profiling
+
+
+@pytest.mark.parametrize('platform, expected', [
+    ('linux', 2048 * 1024), ('darwin', 2048)])
+def test_rss_fallback_units(monkeypatch, platform, expected):
+    def no_proc(*args, **kwargs):
+        raise IOError('no /proc')
+    monkeypatch.setattr(builtins, 'open', no_proc)
+    monkeypatch.setattr(profiling.sys, 'platform', platform)
+    monkeypatch.setattr(resource, 'getrusage',
+                        lambda who: types.SimpleNamespace(ru_maxrss=2048))
+    assert profiling._rss() == expected
+
+
+def run_stages(profiler):
+    with profiler.stage('calms', cells=2):
+        profiler.count(hours=10)
+        with profiler.stage('runs'):
+            profiler.count(calms=3)
+            profiler.count(calms=4)
+        profiler.count(hours=5)
+    with profiler.stage('calms', cells=1, hours=20):
+        pass
+
+
+def test_nested_and_repeated_stages():
+    profiler = profiling.StageProfiler(year=2011)
+    run_stages(profiler)
+    profiler.close()
+    # records are appended when a stage ends, so the inner stage comes first
+    assert [r['stage'] for r in profiler.records] == ['runs', 'calms',
+                                                      'calms']
+    inner, outer, repeated = profiler.records
+    assert inner['counts'] == {'calms': 7}
+    assert outer['counts'] == {'cells': 2, 'hours': 15}
+    assert repeated['counts'] == {'cells': 1, 'hours': 20}
+    assert outer['wall_time'] >= inner['wall_time'] >= 0
+    for record in profiler.records:
+        assert record['cpu_time'] >= 0
+        assert record['peak_rss'] >= max(record['rss_start'],
+                                         record['rss_end'])
+    assert not profiler._active
+
+
+def test_failing_stage_is_recorded():
+    profiler = profiling.StageProfiler()
+    with pytest.raises(ValueError):
+        with profiler.stage('load'):
+            raise ValueError('no data')
+    profiler.close()
+    assert [r['stage'] for r in profiler.records] == ['load']
+    assert 'wall_time' in profiler.records[0]
+    assert not profiler._active
+
+
+def test_profile_of_outer_stage(tmpdir):
+    profiler = profiling.StageProfiler(profile=True,
+                                       profile_folder=str(tmpdir))
+    run_stages(profiler)
+    profiler.close()
+    inner, outer, repeated = profiler.records
+    assert 'profile' not in inner
+    for record in (outer, repeated):
+        assert os.path.isfile(record['profile'])
+    assert outer['profile'] != repeated['profile']
+
+
+def test_write_report(tmpdir):
+    folder = str(tmpdir.join('reports'))
+    profiler = profiling.StageProfiler(year=2011, source='wind')
+    run_stages(profiler)
+    json_name, csv_name = profiler.write_report(folder)
+    with open(json_name) as f:
+        run = json.load(f)
+    assert run['run']['year'] == 2011
+    assert [s['stage'] for s in run['stages']] == ['runs', 'calms', 'calms']
+    report = pd.read_csv(csv_name)
+    assert list(report['stage']) == ['runs', 'calms', 'calms']
+    assert list(report['year']) == [2011] * 3
+    assert list(report['source']) == ['wind'] * 3
+    np.testing.assert_array_equal(report['calms'], [7, np.nan, np.nan])
+    np.testing.assert_array_equal(report['hours'], [np.nan, 15, 20])
+    np.testing.assert_allclose(
+        report['cell_hours_per_s'],
+        report['cells'] * report['hours'] / report['wall_time'])
+
+    # a second run is appended to the csv file
+    profiler = profiling.StageProfiler(year=2012, source='wind')
+    with profiler.stage('calms', cells=3, hours=1):
+        pass
+    assert profiler.write_report(folder)[1] == csv_name
+    report = pd.read_csv(csv_name)
+    assert list(report['year']) == [2011] * 3 + [2012]
+    assert list(report['cells'].iloc[-2:]) == [1, 3]
@@ -0,0 +1,157 @@
+import sys
+import types
+import numpy as np
+import pandas as pd
+import pytest
+from get_from_db import FeedinMatrix
+from storage_estimate import (CONSUMPTION, GRID_SHARE, PV_INSTALLED,
+                              WIND_INSTALLED, estimate_storage, grid_level,
+                              read_demand, sequent_peak, validate_estimate)
+from test_calms import random_feedin
+
+
+def loop_sequent_peak(net_outflow):
+    levels = np.zeros_like(net_outflow)
+    for row, series in enumerate(net_outflow):
+        level = 0
+        for step, outflow in enumerate(series):
+            level = max(0, level + outflow)
+            levels[row, step] = level
+    return levels
+
+
+def bisect_level(deficit, grid_energy):
+    if deficit.sum() <= grid_energy:
+        return np.inf
+    low, high = 0., deficit.max()
+    for _ in range(200):
+        level = (low + high) / 2
+        if np.minimum(deficit, level).sum() > grid_energy:
+            high = level
+        else:
+            low = level
+    return low
+
+
+def test_sequent_peak():
+    net_outflow = np.random.RandomState(0).normal(0, 1, (5, 300))
+    net_outflow[0] = -1  # always full
+    np.testing.assert_allclose(sequent_peak(net_outflow),
+                               loop_sequent_peak(net_outflow), atol=1e-9)
+    doubled = np.hstack([net_outflow, net_outflow])
+    np.testing.assert_allclose(sequent_peak(net_outflow, cyclic=True),
+                               loop_sequent_peak(doubled)[:, 300:],
+                               atol=1e-9)
+
+
+@pytest.mark.parametrize('grid_energy', [0., 1., 30., 99., 1e3])
+def test_grid_level(grid_energy):
+    deficit = np.random.RandomState(0).exponential(1, (6, 100))
+    deficit[0] = 0
+    deficit[1] = 2  # equal deficits
+    deficit[2, 1:] = 0  # a single deficit
+    level = grid_level(deficit, grid_energy)
+    for row in range(len(deficit)):
+        expected = bisect_level(deficit[row], grid_energy)
+        if np.isinf(expected):
+            assert np.isinf(level[row])
+        else:
+            assert level[row] == pytest.approx(expected, abs=1e-9)
+            assert np.minimum(deficit[row], level[row]).sum() == \
+                pytest.approx(grid_energy)
+
+
+def loop_estimate(wind, pv, demand, grid_allocation, cyclic):
+    n_steps = wind.shape[1]
+    demand = demand * CONSUMPTION
+    grid_energy = GRID_SHARE * CONSUMPTION * n_steps / 8760
+    result = []
+    for row in range(len(wind)):
+        surplus = wind[row] * WIND_INSTALLED + pv[row] * PV_INSTALLED - demand
+        deficit = np.maximum(-surplus, 0)
+        if grid_allocation == 'peak':
+            level = bisect_level(deficit, grid_energy)
+            deficit = deficit - np.minimum(deficit, level)
+        else:
+            level = np.nan
+            deficit = np.maximum(deficit - GRID_SHARE * demand, 0)
+        net_outflow = deficit / 0.8 - np.maximum(surplus, 0)
+        if cyclic:
+            levels = loop_sequent_peak(
+                np.tile(net_outflow, 2)[np.newaxis])[0, n_steps:]
+        else:
+            levels = loop_sequent_peak(net_outflow[np.newaxis])[0]
+        drawdown, longest = 0, 0
+        for below_full in levels > 0:
+            drawdown = drawdown + 1 if below_full else 0
+            longest = max(longest, drawdown)
+        result.append([levels.max(), deficit.max(), longest, level])
+    return np.array(result)
+
+
+@pytest.mark.parametrize('grid_allocation, cyclic, chunk_size', [
+    ('peak', False, 100), ('peak', True, 2), ('demand', False, 3),
+    ('demand', True, 100)])
+def test_estimate_storage(grid_allocation, cyclic, chunk_size):
+    wind, pv = [feedin._replace(values=feedin.values * 5) for feedin in
+                (random_feedin(n_rows=5, n_steps=300, seed=1),
+                 random_feedin(n_rows=5, n_steps=300, seed=2))]
+    demand = np.random.RandomState(3).uniform(0.5, 1.5, 300)
+    # Three times the yearly consumption, more deficit than grid import
+    demand *= 3 / (demand.sum() * 8760 / 300.)
+    estimate = estimate_storage(wind, pv, demand,
+                                grid_allocation=grid_allocation,
+                                cyclic=cyclic, chunk_size=chunk_size)
+    np.testing.assert_array_equal(estimate.index, wind.gids)
+    expected = loop_estimate(wind.values, pv.values, demand,
+                             grid_allocation, cyclic)
+    np.testing.assert_allclose(estimate.values, expected, rtol=1e-6,
+                               atol=1e-3)
+
+
+def test_estimate_storage_without_pv():
+    wind = random_feedin(n_rows=3, n_steps=100)
+    demand = np.full(120, 1 / 8760.)
+    estimate = estimate_storage(wind, None, demand)
+    expected = loop_estimate(wind.values, np.zeros((3, 100)), demand[:100],
+                             'peak', False)
+    np.testing.assert_allclose(estimate.values, expected, rtol=1e-6,
+                               atol=1e-3)
+    with pytest.raises(ValueError):
+        estimate_storage(wind, None, demand, grid_allocation='unknown')
+
+
+def test_estimate_storage_matches_gids():
+    wind = random_feedin(n_rows=5, n_steps=100, seed=1)
+    pv = random_feedin(n_rows=5, n_steps=100, seed=2)
+    demand = np.full(100, 3 / 8760.)
+    expected = estimate_storage(wind, pv, demand)
+    # pv in reverse order and without the first gid, wind with another gid
+    pv = FeedinMatrix(values=pv.values[:0:-1], gids=pv.gids[:0:-1],
+                      index=pv.index)
+    wind = FeedinMatrix(values=np.vstack([wind.values, wind.values[:1]]),
+                        gids=np.append(wind.gids, 999), index=wind.index)
+    estimate = estimate_storage(wind, pv, demand, chunk_size=2)
+    pd.testing.assert_frame_equal(estimate, expected.iloc[1:])
+
+
+def test_validate_estimate_without_optimum(monkeypatch, capsys):
+    def run_storage_sweep(cases, processes, **kwargs):
+        return pd.DataFrame([{'gid': case['gid'], 'error': 'infeasible'}
+                             for case in cases])
+    monkeypatch.setitem(sys.modules, 'storage_invest', types.SimpleNamespace(
+        sweep_cases=lambda wind, pv: [{'gid': gid} for gid in wind.gids],
+        run_storage_sweep=run_storage_sweep))
+    wind = random_feedin(n_rows=5, n_steps=100, seed=1)
+    validation = validate_estimate(wind, wind, np.full(100, 1 / 8760.),
+                                   sample=3)
+    assert len(validation) == 3
+    assert validation['storage_cap'].isnull().all()
+    assert (validation['error'] == 'infeasible').all()
+    assert 'failed for 3 of 3 locations' in capsys.readouterr().out
+
+
+def test_read_demand(tmpdir):
+    filename = str(tmpdir.join('demand.csv'))
+    pd.DataFrame({'demand_el': [1., 3., 4.]}).to_csv(filename)
+    np.testing.assert_allclose(read_demand(filename), [0.125, 0.375, 0.5])
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('oemof.solph')
+pytest.importorskip('feedinlib')
+pyomo_opt = pytest.importorskip('pyomo.opt')
+if not pyomo_opt.SolverFactory('cbc').available(exception_flag=False):
+    pytest.skip('cbc solver not available', allow_module_level=True)
+
+import storage_invest  # noqa: E402
+
+
+def calm_at_end(n_days=12, calm_days=3):
+    """
+    Wind with a daily pattern and a calm in the last days, no pv and a
+    demand of three times the yearly consumption per year, so the grid
+    import can not cover the whole calm.
+    """
+    hours = np.arange(n_days * 24)
+    wind = 1.5 + 0.1 * np.sin(2 * np.pi * hours / 24)
+    wind[-calm_days * 24:] = 0
+    return wind, np.zeros_like(wind), np.full(len(hours), 3 / 8760.)
+
+
+def test_reduced_storage_with_calm_in_last_period():
+    wind, pv, demand = calm_at_end()
+    model = storage_invest.StorageModel('cbc', len(wind), data_demand=demand)
+    model.update(wind, pv)
+    full = model.solve()
+    assert full['storage_cap'] > 0
+    reduced = storage_invest.optimise_storage_size_reduced(
+        wind_feedin=wind, pv_feedin=pv, data_demand=demand,
+        n_typical_periods=4, period_length=24)
+    typical = reduced['typical_periods']
+    # The calm is the last typical period
+    assert typical.order[-1] == len(typical.weights) - 1
+    assert typical.order[-1] in typical.extreme
+    assert reduced['storage_cap'] == pytest.approx(full['storage_cap'],
+                                                   rel=1e-3)
+
+
+class FailingModel(object):
+
+    def update(self, wind_feedin, pv_feedin, data_demand=None):
+        raise ValueError('feedin of the wrong length')
+
+
+def test_sweep_case_with_failing_update(monkeypatch):
+    monkeypatch.setattr(storage_invest, '_sweep_model', FailingModel())
+    result = storage_invest._run_sweep_case(
+        {'gid': 1, 'wind_feedin': [], 'pv_feedin': []})
+    assert result['gid'] == 1
+    assert 'feedin of the wrong length' in result['error']
+    assert 'wind_feedin' not in result
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import typical_periods as tp
+
+
+def series(n_days=40, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 1, (3, n_days * 24 + 5))
+
+
+def test_split_and_expand_periods():
+    data = series()
+    periods = tp.split_periods(data)
+    assert periods.shape == (40, 24, 3)
+    np.testing.assert_array_equal(periods[2, :, 1], data[1, 48:72])
+    typical = tp.TypicalPeriods(profiles=periods, weights=np.ones(40),
+                                order=np.arange(40), extreme=np.array([]))
+    np.testing.assert_array_equal(tp.expand_periods(typical),
+                                  data[:, :40 * 24])
+
+
+def test_kmeans_separated_clusters():
+    rng = np.random.RandomState(0)
+    centers = np.array([[0., 0.], [10., 0.], [0., 10.]])
+    labels = np.repeat(np.arange(3), 20)
+    features = centers[labels] + rng.normal(0, 0.1, (60, 2))
+    found, found_centers = tp.kmeans(features, 3)
+    # Same partition up to the numbering of the clusters
+    assert len(set(zip(labels, found))) == 3
+    for cluster in range(3):
+        np.testing.assert_allclose(
+            found_centers[cluster], features[found == cluster].mean(axis=0))
+    assert len(tp.kmeans(features[:2], 3)[1]) == 2
+
+
+@pytest.mark.parametrize('n_clusters, extreme', [(5, ()), (5, (3, 17)),
+                                                 (40, ()), (8, (0, 39))])
+def test_cluster_periods(n_clusters, extreme):
+    data = series()
+    periods = tp.split_periods(data)
+    typical = tp.cluster_periods(data, n_clusters, extreme_periods=extreme)
+    n_typical = min(n_clusters, 40 - len(extreme)) + len(extreme)
+    assert len(typical.profiles) <= n_typical
+    assert typical.weights.sum() == 40
+    np.testing.assert_array_equal(
+        typical.weights, np.bincount(typical.order,
+                                     minlength=len(typical.profiles)))
+    assert tp.step_weights(typical).sum() == 40 * 24
+    # Extreme periods are kept unchanged and represent only themselves
+    np.testing.assert_array_equal(typical.order[list(extreme)],
+                                  typical.extreme)
+    np.testing.assert_array_equal(typical.weights[typical.extreme], 1)
+    for period in extreme:
+        np.testing.assert_array_equal(
+            typical.profiles[typical.order[period]], periods[period])
+    # Profiles are original periods (medoids)
+    for profile in typical.profiles:
+        assert (periods == profile).all(axis=(1, 2)).any()
+    if n_clusters >= 40:
+        np.testing.assert_array_equal(tp.expand_periods(typical),
+                                      data[:, :40 * 24])
+
+
+def test_calm_periods():
+    feedin = np.full(24 * 20, 0.5)
+    feedin[30:40] = 0  # short calm
+    feedin[24 * 5 + 20:24 * 15 + 3] = 0.01  # longest calm over 11 days
+    feedin[24 * 9:24 * 10] = 0.04
+    np.testing.assert_array_equal(tp.calm_periods(feedin, max_periods=20),
+                                  np.arange(5, 16))
+    selected = tp.calm_periods(feedin, max_periods=7)
+    assert len(selected) == 7
+    assert 9 not in selected
+    assert len(tp.calm_periods(np.ones(48))) == 0
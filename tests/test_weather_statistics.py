@@ -0,0 +1,73 @@
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import pytest
+import weather_statistics as ws
+from get_from_db import FeedinMatrix, calculate_avg_wind_speed
+
+Weather = namedtuple('Weather', ['data', 'name'])
+
+
+def multi_weather(index, gids=(5, 2, 9), seed=0):
+    rng = np.random.RandomState(seed)
+    return [Weather(data=pd.DataFrame(
+        {'v_wind': rng.uniform(0, 15, len(index)),
+         'temp_air': rng.uniform(260, 300, len(index))}, index=index),
+        name=gid) for gid in gids]
+
+
+def test_avg_wind_speed_of_weather_and_matrix():
+    index = pd.date_range('1/1/2011', periods=48, freq='60min')
+    weather = multi_weather(index)
+    expected = pd.DataFrame(
+        {'results': [w.data['v_wind'].mean() for w in weather]},
+        index=[w.name for w in weather])
+    result = calculate_avg_wind_speed(weather)
+    np.testing.assert_array_equal(result.index, expected.index)
+    np.testing.assert_allclose(result['results'], expected['results'])
+    cube = ws.weather_cube(weather)
+    matrix = FeedinMatrix(values=cube.values[cube.variables.index('v_wind')],
+                          gids=cube.gids, index=cube.index)
+    np.testing.assert_allclose(calculate_avg_wind_speed(matrix)['results'],
+                               expected['results'])
+
+
+def test_statistics_and_climatology():
+    index = pd.date_range('1/1/2011', '12/31/2012 23:00', freq='60min')
+    weather = multi_weather(index)
+    cube = ws.weather_cube(weather, ['v_wind'])
+    stats = ws.statistics(cube, chunk_size=2)
+    series = weather[1].data['v_wind']
+    assert stats.loc[2, 'mean'] == pytest.approx(series.mean())
+    assert stats.loc[2, 'std'] == pytest.approx(series.std(ddof=0))
+    assert stats.loc[2, 'p95'] == pytest.approx(series.quantile(0.95))
+    monthly = ws.climatology(cube, by='month')
+    np.testing.assert_allclose(
+        monthly.loc[2].values, series.groupby(series.index.month).mean())
+    variability = ws.interannual_variability(cube)
+    annual = series.groupby(series.index.year).mean()
+    assert variability.loc[2, 'std'] == pytest.approx(annual.std(ddof=0))
+
+
+@pytest.mark.parametrize('start, periods, hours', [
+    ('1/1/2011', 8760, 8760), ('1/1/2012', 8784, 8784),
+    ('1/1/2012', 24, 8784), ('1/1/2011', 8760 + 8784, 8772.0131)])
+def test_full_load_hours(start, periods, hours):
+    index = pd.date_range(start, periods=periods, freq='60min')
+    assert ws.hours_per_year(index) == pytest.approx(hours)
+    feedin = FeedinMatrix(values=np.full((2, periods), 0.25),
+                          gids=np.array([1, 2]), index=index)
+    result = ws.capacity_factors(feedin)
+    np.testing.assert_allclose(result['capacity_factor'], 0.25)
+    np.testing.assert_allclose(result['full_load_hours'], 0.25 * hours,
+                               rtol=1e-6)
+
+
+def test_without_weather():
+    cube = ws.weather_cube([], ['v_wind'])
+    assert cube.values.shape == (1, 0, 0)
+    assert len(cube.gids) == 0 and len(cube.index) == 0
+    assert ws.weather_cube([]).values.shape == (0, 0, 0)
+    assert ws.statistics(cube).empty
+    result = calculate_avg_wind_speed([])
+    assert result.empty and list(result.columns) == ['results']
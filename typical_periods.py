@@ -0,0 +1,151 @@
+"""
+Aggregation of time series to typical periods (e.g. days) with k-means
+clustering to shrink the storage optimisation (see
+storage_invest.optimise_storage_size_reduced).
+"""
+from collections import namedtuple
+import numpy as np
+from get_from_db import find_calm_runs
+
+# Typical periods of time series
+# profiles: array (typical periods x time steps per period x series)
+# weights: number of original periods represented by each typical period
+# order: typical period of each original period
+# extreme: typical periods that are extreme periods kept unchanged
+TypicalPeriods = namedtuple('TypicalPeriods', ['profiles', 'weights', 'order',
+                                               'extreme'])
+
+
+def split_periods(series, period_length=24):
+    """
+    Splits time series (array, rows: series, columns: time steps) into
+    periods (array: periods x time steps per period x series). Time steps
+    after the last whole period are dropped.
+    """
+    series = np.atleast_2d(np.asarray(series, dtype=float))
+    n_periods = series.shape[1] // period_length
+    return (series[:, :n_periods * period_length]
+            .reshape(len(series), n_periods, period_length)
+            .transpose(1, 2, 0))
+
+
+def kmeans(features, n_clusters, iterations=100, seed=0):
+    """
+    Clusters the rows of features with k-means (k-means++ initialisation).
+
+    Returns
+    -------
+    labels : array
+        Cluster of each row.
+    centers : array
+        Centre of each cluster (rows).
+    """
+    rng = np.random.RandomState(seed)
+    n_clusters = min(n_clusters, len(features))
+    squared_norms = (features ** 2).sum(axis=1)
+
+    def distances(centers):
+        return np.maximum(squared_norms[:, np.newaxis] -
+                          2 * features.dot(centers.T) +
+                          (centers ** 2).sum(axis=1)[np.newaxis, :], 0)
+
+    centers = features[[rng.randint(len(features))]]
+    for _ in range(1, n_clusters):
+        nearest = distances(centers).min(axis=1)
+        if nearest.sum() > 0:
+            choice = rng.choice(len(features), p=nearest / nearest.sum())
+        else:
+            choice = rng.randint(len(features))
+        centers = np.vstack([centers, features[choice]])
+    labels = None
+    for _ in range(iterations):
+        new_labels = distances(centers).argmin(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, features)
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, np.newaxis]
+    return labels, centers
+
+
+def calm_periods(feedin, period_length=24, power_limit=0.05, max_periods=7):
+    """
+    Returns the periods (indices) that overlap the longest calm (feedin <
+    power_limit) of the feedin time series; if the calm spans more than
+    max_periods periods, the max_periods periods with the lowest mean feedin
+    of them.
+    """
+    feedin = np.asarray(feedin, dtype=float)
+    rows, starts, lengths = find_calm_runs(feedin < power_limit)
+    if not len(lengths):
+        return np.array([], dtype=int)
+    longest = lengths.argmax()
+    n_periods = len(feedin) // period_length
+    periods = np.arange(starts[longest] // period_length,
+                        min((starts[longest] + lengths[longest] - 1) //
+                            period_length + 1, n_periods))
+    mean_feedin = split_periods(feedin, period_length)[periods, :, 0].mean(
+        axis=1)
+    return np.sort(periods[np.argsort(mean_feedin, kind='stable')
+                           [:max_periods]])
+
+
+def cluster_periods(series, n_clusters=12, period_length=24,
+                    extreme_periods=(), seed=0):
+    """
+    Aggregates time series (array, rows: series, e.g. wind, pv and demand)
+    to n_clusters typical periods plus the extreme periods (indices of
+    periods, e.g. of calm_periods), which are kept unchanged with a weight
+    of 1. The series are scaled to their maximum for the clustering and
+    each typical period is the medoid (the original period closest to the
+    centre) of its cluster, so the profiles are real periods.
+    """
+    periods = split_periods(series, period_length)
+    n_periods = len(periods)
+    extreme_periods = np.unique(np.asarray(extreme_periods, dtype=int))
+    scale = np.abs(periods).max(axis=(0, 1))
+    features = (periods / np.where(scale > 0, scale, 1)).reshape(
+        n_periods, -1)
+    normal = np.setdiff1d(np.arange(n_periods), extreme_periods)
+    labels, centers = kmeans(features[normal], n_clusters, seed=seed)
+    n_normal = len(centers)
+    # Medoids of the clusters
+    distances = ((features[normal][:, np.newaxis, :] -
+                  centers[np.newaxis, :, :]) ** 2).sum(axis=2)
+    distances[np.arange(len(normal)), :] += np.where(
+        labels[:, np.newaxis] == np.arange(n_normal)[np.newaxis, :], 0,
+        np.inf)
+    medoids = normal[distances.argmin(axis=0)]
+    order = np.empty(n_periods, dtype=int)
+    order[normal] = labels
+    order[extreme_periods] = n_normal + np.arange(len(extreme_periods))
+    representatives = np.concatenate([medoids, extreme_periods])
+    weights = np.bincount(order, minlength=len(representatives))
+    keep = weights > 0
+    # Renumber if clusters got empty
+    new_index = np.cumsum(keep) - 1
+    return TypicalPeriods(
+        profiles=periods[representatives[keep]], weights=weights[keep],
+        order=new_index[order],
+        extreme=new_index[n_normal + np.arange(len(extreme_periods))])
+
+
+def expand_periods(typical_periods):
+    """
+    Reconstructs the time series (array, rows: series) of the whole
+    aggregated time span from the typical periods.
+    """
+    profiles = typical_periods.profiles[typical_periods.order]
+    return profiles.transpose(2, 0, 1).reshape(profiles.shape[2], -1)
+
+
+def step_weights(typical_periods):
+    """
+    Returns the weight (number of represented original time steps) of each
+    time step of the typical periods one after another.
+    """
+    return np.repeat(typical_periods.weights,
+                     typical_periods.profiles.shape[1])
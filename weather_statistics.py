@@ -0,0 +1,215 @@
+"""
+Statistics of weather variables and feedin of all locations, calculated
+with vectorized reductions over a (variable x gid x hour) weather cube.
+"""
+import math
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from get_from_db import FeedinMatrix, stack_weather
+
+# Weather variables of all locations as one 3-D array (variables x gids x
+# time steps).
+WeatherCube = namedtuple('WeatherCube', ['values', 'variables', 'gids',
+                                         'index'])
+
+
+def weather_cube(multi_weather, variables=None, dtype=float):
+    """
+    Stacks the weather variables (default: all) of a list of weather objects
+    into a WeatherCube (gids in the order of multi_weather). An empty list
+    gives a cube without locations and time steps.
+    """
+    if not len(multi_weather):
+        index = pd.DatetimeIndex([])
+        variables = list(variables or [])
+    else:
+        index = multi_weather[0].data.index
+        variables = variables or list(multi_weather[0].data.columns)
+    values, gids = stack_weather(multi_weather, variables, dtype)
+    return WeatherCube(values=values, variables=variables, gids=gids,
+                       index=index)
+
+
+def weather_cube_from_columns(data, variables=None):
+    """
+    Stacks weather variables given as FeedinMatrix objects with the same gids
+    (dictionary, keys: variable names, e.g. of load_matrix_columns or the
+    weather_columns of a data backend) into a WeatherCube.
+    """
+    variables = variables or list(data)
+    first = data[variables[0]]
+    return WeatherCube(
+        values=np.stack([np.asarray(data[variable].values)
+                         for variable in variables]),
+        variables=variables, gids=first.gids, index=first.index)
+
+
+def concatenate_cubes(cubes):
+    """
+    Concatenates the WeatherCube objects of several years along the time
+    axis. Only the gids contained in all cubes are kept.
+    """
+    gids = cubes[0].gids
+    for cube in cubes[1:]:
+        gids = np.intersect1d(gids, cube.gids)
+    values = []
+    for cube in cubes:
+        order = np.argsort(cube.gids)
+        rows = order[np.searchsorted(cube.gids, gids, sorter=order)]
+        values.append(np.asarray(cube.values)[:, rows])
+    return WeatherCube(values=np.concatenate(values, axis=2),
+                       variables=cubes[0].variables, gids=gids,
+                       index=cubes[0].index.append(
+                           [cube.index for cube in cubes[1:]]))
+
+
+def _variable_values(data, variable):
+    """
+    Returns the gid x time array and the gids of variable of a WeatherCube
+    (or of a FeedinMatrix, variable is then ignored).
+    """
+    if isinstance(data, FeedinMatrix):
+        return data.values, data.gids
+    return data.values[data.variables.index(variable)], data.gids
+
+
+def statistics(data, variable='v_wind', percentiles=(5, 50, 95),
+               chunk_size=1000):
+    """
+    Calculates the mean, standard deviation, minimum, maximum and the given
+    percentiles over time of variable of each location of a WeatherCube
+    (or of a FeedinMatrix), chunk-wise over the gids.
+
+    Returns
+    -------
+    statistics : DataFrame
+        indices: gids, columns: 'mean', 'std', 'min', 'max' and 'p<q>' for
+        each percentile q.
+    """
+    values, gids = _variable_values(data, variable)
+    columns = (['mean', 'std', 'min', 'max'] +
+               ['p{0:g}'.format(q) for q in percentiles])
+    result = np.empty((len(gids), len(columns)))
+    for first in range(0, len(gids), chunk_size):
+        rows = slice(first, first + chunk_size)
+        chunk = np.asarray(values[rows], dtype=float)
+        result[rows, 0] = chunk.mean(axis=1)
+        result[rows, 1] = chunk.std(axis=1)
+        result[rows, 2] = chunk.min(axis=1)
+        result[rows, 3] = chunk.max(axis=1)
+        if len(percentiles):
+            result[rows, 4:] = np.percentile(chunk, percentiles, axis=1).T
+    return pd.DataFrame(data=result, index=gids, columns=columns)
+
+
+def mean(data, variable='v_wind'):
+    """
+    Returns the mean of variable of each location (DataFrame, indices: gids,
+    column 'results' as for coastdat_geoplot).
+    """
+    values, gids = _variable_values(data, variable)
+    return pd.DataFrame(data=np.asarray(values).mean(axis=1), index=gids,
+                        columns=['results'])
+
+
+def weibull_parameters(data, variable='v_wind'):
+    """
+    Estimates the shape k and scale c of the Weibull distribution of the
+    wind speed of each location from its mean and standard deviation
+    (k = (std / mean) ** -1.086, c = mean / gamma(1 + 1 / k)).
+
+    Returns
+    -------
+    parameters : DataFrame
+        indices: gids, columns: 'k', 'c'.
+    """
+    moments = statistics(data, variable, percentiles=())
+    mean_speed, std = moments['mean'].values, moments['std'].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = (std / mean_speed) ** -1.086
+        c = mean_speed / np.vectorize(math.gamma, otypes=[float])(
+            1 + 1 / np.where(np.isfinite(k) & (k > 0), k, 1))
+    k[~np.isfinite(k)] = np.nan
+    c[~np.isfinite(k)] = np.nan
+    return pd.DataFrame(data={'k': k, 'c': c}, index=moments.index,
+                        columns=['k', 'c'])
+
+
+def hours_per_year(index):
+    """
+    Returns the mean number of hours of the years covered by the time steps
+    of index (weighted with the time steps in each year), e.g. 8784 for a
+    leap year and 8760 if index is no DatetimeIndex.
+    """
+    if not isinstance(index, pd.DatetimeIndex) or not len(index):
+        return 8760.
+    years = np.asarray(index.year)
+    hours = np.where((years % 4 == 0) & ((years % 100 != 0) |
+                                         (years % 400 == 0)), 8784, 8760)
+    return float(hours.mean())
+
+
+def capacity_factors(feedin_matrix, installed_capacity=1):
+    """
+    Returns the capacity factor (mean feedin / installed capacity) and the
+    full load hours per year of each location of a FeedinMatrix (capacity
+    factor times the hours of the covered years, see hours_per_year).
+
+    Returns
+    -------
+    capacity_factors : DataFrame
+        indices: gids, columns: 'capacity_factor', 'full_load_hours'.
+    """
+    capacity_factor = (mean(feedin_matrix)['results'].values /
+                       installed_capacity)
+    return pd.DataFrame(
+        data={'capacity_factor': capacity_factor,
+              'full_load_hours':
+                  capacity_factor * hours_per_year(feedin_matrix.index)},
+        index=feedin_matrix.gids,
+        columns=['capacity_factor', 'full_load_hours'])
+
+
+def climatology(data, variable='v_wind', by='month'):
+    """
+    Calculates the multi-year climatology of variable of a WeatherCube (or
+    FeedinMatrix) spanning several years (see concatenate_cubes): the mean
+    of each location per month (by='month') or hour of the day
+    (by='hour') over all years, and per year (by='year').
+
+    Returns
+    -------
+    climatology : DataFrame
+        indices: gids, columns: months, hours or years.
+    """
+    values, gids = _variable_values(data, variable)
+    index = pd.DatetimeIndex(data.index)
+    labels, groups = np.unique(np.asarray(getattr(index, by)),
+                               return_inverse=True)
+    groups = groups.ravel()
+    # Sums per group as one matrix product with the group membership
+    membership = np.zeros((len(index), len(labels)))
+    membership[np.arange(len(index)), groups] = 1
+    sums = np.asarray(values, dtype=float).dot(membership)
+    return pd.DataFrame(data=sums / membership.sum(axis=0), index=gids,
+                        columns=labels)
+
+
+def interannual_variability(data, variable='v_wind'):
+    """
+    Returns the mean over all years and the standard deviation and
+    coefficient of variation of the annual means of variable of each
+    location of a multi-year WeatherCube (or FeedinMatrix).
+
+    Returns
+    -------
+    variability : DataFrame
+        indices: gids, columns: 'mean', 'std', 'cv'.
+    """
+    annual = climatology(data, variable, by='year').values
+    mean_value, std = annual.mean(axis=1), annual.std(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cv = std / mean_value
+    return pd.DataFrame(data={'mean': mean_value, 'std': std, 'cv': cv},
+                        index=data.gids, columns=['mean', 'std', 'cv'])